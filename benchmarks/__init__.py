@@ -0,0 +1,6 @@
+"""
+Benchmarks of the TOPAZ hot paths on synthetic data.
+
+Run them with airspeed velocity (``asv run``) from the repository root, or
+once at every scale without asv with ``python -m benchmarks``.
+"""
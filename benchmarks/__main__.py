@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+"""
+Run every benchmark once at each scale without asv.
+
+    python -m benchmarks [pattern]
+
+Times are the best of three calls, peak memory is the largest allocation
+traced by tracemalloc during one call (allocations in worker processes are
+not traced, use asv for those). The synthetic data is written to a
+temporary directory that is removed afterwards.
+"""
+from __future__ import print_function, division
+
+import os
+import re
+import sys
+import time
+import shutil
+import inspect
+import itertools
+import tempfile
+import tracemalloc
+
+from . import bench_analysis, bench_fortran
+
+MODULES = [bench_analysis, bench_fortran]
+
+
+def _suites(pattern=None):
+    for module in MODULES:
+        for name, suite in inspect.getmembers(module, inspect.isclass):
+            if suite.__module__ != module.__name__:
+                continue
+            methods = [m for m in sorted(vars(suite))
+                       if m.startswith(("time_", "peakmem_"))]
+            if pattern is not None:
+                methods = [m for m in methods
+                           if re.search(pattern, "{0}.{1}".format(name, m))]
+            if methods:
+                yield name, suite, methods
+
+
+def _measure(method, args):
+    if method.__name__.startswith("time_"):
+        best = float("inf")
+        for _ in range(3):
+            start = time.perf_counter()
+            method(*args)
+            best = min(best, time.perf_counter() - start)
+        return "{0:10.4f} s".format(best)
+
+    tracemalloc.start()
+    try:
+        method(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return "{0:10.1f} MB".format(peak / 1024**2)
+
+
+def main(pattern=None):
+    cwd = os.getcwd()
+    tmp_dir = tempfile.mkdtemp(prefix="topaz_bench_")
+    try:
+        os.chdir(tmp_dir)
+        for name, suite, methods in _suites(pattern):
+            bench = suite()
+            cache = bench.setup_cache() if hasattr(bench, "setup_cache") \
+                else None
+            for params in itertools.product(*getattr(suite, "params", [[]])):
+                args = ((cache,) if cache is not None else ()) + params
+                if hasattr(bench, "setup"):
+                    bench.setup(*args)
+                for method in methods:
+                    result = _measure(getattr(bench, method), args)
+                    label = ", ".join("{0}={1}".format(k, v) for k, v in
+                                      zip(suite.param_names, params))
+                    print("{0}.{1}({2}): {3}".format(name, method, label,
+                                                     result))
+                    sys.stdout.flush()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1] if len(sys.argv) > 1 else None)
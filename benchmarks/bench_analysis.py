@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+"""
+Benchmarks of the weighting, ion mean and dispersion measure functions in
+topaz.analysis.
+"""
+from __future__ import print_function, division
+
+import os
+
+from topaz import analysis
+
+from .synthetic import make_snapshot, make_ray, make_rays
+
+#  The number of gas particles in the synthetic snapshots
+PARTICLES = [10**4, 10**5, 10**6]
+
+#  The number of path elements along the synthetic rays
+CELLS = [10**3, 10**5, 10**6]
+
+
+class WeightSuite(object):
+    """
+    analysis.weight streaming a snapshot from disk.
+    """
+    params = [PARTICLES, ["volume", "mass"]]
+    param_names = ["n_particles", "weight_type"]
+    timeout = 600
+
+    def setup_cache(self):
+        snapshots = {}
+        for n in PARTICLES:
+            snapshot = make_snapshot(os.path.join("weight", str(n)), n)
+            snapshots[n] = analysis.snapshot_file(snapshot)
+        return snapshots
+
+    def time_weight(self, snapshots, n_particles, weight_type):
+        analysis.weight(snapshots[n_particles], "apHI", weight_type)
+
+    def peakmem_weight(self, snapshots, n_particles, weight_type):
+        analysis.weight(snapshots[n_particles], "apHI", weight_type)
+
+
+class IonMeanSuite(object):
+    """
+    analysis.ion_means over a series of snapshots.
+    """
+    params = [PARTICLES, [1, 4]]
+    param_names = ["n_particles", "nproc"]
+    timeout = 600
+
+    #  The number of snapshots in each series
+    n_snapshots = 4
+
+    def setup_cache(self):
+        series = {}
+        for n in PARTICLES:
+            snap_dir = os.path.join("ion_mean", str(n))
+            series[n] = [make_snapshot(snap_dir, n, snapnum=i,
+                                       redshift=float(self.n_snapshots - i),
+                                       seed=i)
+                         for i in range(self.n_snapshots)]
+        return series
+
+    def time_ion_mean(self, series, n_particles, nproc):
+        analysis.ion_mean(series[n_particles], ion="HI", weighting="volume",
+                          nproc=nproc)
+
+    def time_ion_means(self, series, n_particles, nproc):
+        analysis.ion_means(series[n_particles], ions=("HI", "HeI", "HeII"),
+                           weightings=("volume", "mass", None), nproc=nproc)
+
+    def peakmem_ion_means(self, series, n_particles, nproc):
+        analysis.ion_means(series[n_particles], ions=("HI", "HeI", "HeII"),
+                           weightings=("volume", "mass", None), nproc=nproc)
+
+
+class CalcDMSuite(object):
+    """
+    analysis.calc_DM of a single ray.
+    """
+    params = [CELLS]
+    param_names = ["n_cells"]
+
+    def setup_cache(self):
+        if not os.path.isdir("rays"):
+            os.makedirs("rays")
+        return dict((n, make_ray(os.path.join("rays", "ray_{0}.h5".format(n)),
+                                 n))
+                    for n in CELLS)
+
+    def time_calc_DM(self, rays, n_cells):
+        analysis.calc_DM(rays[n_cells])
+
+    def peakmem_calc_DM(self, rays, n_cells):
+        analysis.calc_DM(rays[n_cells])
+
+
+class DMBatchSuite(object):
+    """
+    analysis.calc_DM_batch and analysis.ray_profiles of many short rays.
+    """
+    params = [[100, 1000]]
+    param_names = ["n_rays"]
+    timeout = 600
+
+    #  The number of path elements along each ray
+    n_cells = 2000
+
+    def setup_cache(self):
+        return dict((n, make_rays(os.path.join("batch", str(n)), n,
+                                  self.n_cells))
+                    for n in self.params[0])
+
+    def time_calc_DM_batch(self, rays, n_rays):
+        analysis.calc_DM_batch(rays[n_rays], nproc=1)
+
+    def time_ray_profiles(self, rays, n_rays):
+        analysis.ray_profiles(rays[n_rays])
+
+    def peakmem_ray_profiles(self, rays, n_rays):
+        analysis.ray_profiles(rays[n_rays])
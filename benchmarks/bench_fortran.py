@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+"""
+Benchmarks of reading CLOUDY ionisation tables with topaz.fortran.
+"""
+from __future__ import print_function, division
+
+import os
+
+from topaz import fortran
+
+from .synthetic import make_cloudy_table
+
+#  The (nz, ntemp, nrho) shapes of the synthetic tables
+SHAPES = [(49, 141, 176), (98, 282, 352)]
+
+
+class ReadfSuite(object):
+    """
+    fortran.readf parsing the Fortran file, opening the .npy sidecar and
+    returning an open table.
+    """
+    params = [[str(shape) for shape in SHAPES]]
+    param_names = ["shape"]
+
+    def setup_cache(self):
+        tables = {}
+        for shape in SHAPES:
+            loc = os.path.join("tables", "x".join(map(str, shape))) + "/"
+            if not os.path.isdir(loc):
+                os.makedirs(loc)
+            make_cloudy_table(loc, nz=shape[0], ntemp=shape[1],
+                              nrho=shape[2])
+            tables[str(shape)] = loc
+        return tables
+
+    def setup(self, tables, shape):
+        #  Write the sidecar before timing
+        fortran.readf(tables[shape])
+
+    def time_parse(self, tables, shape):
+        fortran.readf(tables[shape], cache=False)
+
+    def peakmem_parse(self, tables, shape):
+        fortran.readf(tables[shape], cache=False)
+
+    def time_open_sidecar(self, tables, shape):
+        fortran._open_table.cache_clear()
+        ionbal = fortran.readf(tables[shape])[0]
+        ionbal.sum()
+
+    def time_open_table(self, tables, shape):
+        fortran.readf(tables[shape])
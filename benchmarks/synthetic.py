@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+"""
+Generators of synthetic Gadget HDF5 snapshots, trident rays and CLOUDY
+Fortran tables for the benchmarks.
+"""
+from __future__ import print_function, division
+
+import os
+import numpy as np
+import h5py
+
+#  The ions read by analysis.ion_means
+ION_FIELDS = ["apHI", "apHeI", "apHeII"]
+
+#  The species in a trident ray
+RAY_SPECIES = ["H_p0", "H_p1", "He_p0", "He_p1", "He_p2"]
+
+
+def make_snapshot(snap_dir, n_particles, snapnum=0, nfiles=1, box=25.0,
+                  redshift=0.0, seed=0):
+    """
+    Write a synthetic EAGLE-like Gadget HDF5 snapshot.
+
+    Parameters
+    ----------
+    snap_dir : string
+
+        The directory to create the snapshot directory (snapshot_XXX) in.
+
+    n_particles : integer
+
+        The number of gas particles.
+
+    snapnum : integer, optional
+
+        The snapshot number. Default: 0
+
+    nfiles : integer, optional
+
+        The number of files to split the snapshot over. Default: 1
+
+    box : float, optional
+
+        The box size in h**-1 cMpc. Default: 25.0
+
+    redshift : float, optional
+
+        The redshift of the snapshot. Default: 0.0
+
+    seed : integer, optional
+
+        The random seed. Default: 0
+
+    Returns
+    -------
+    snapshot : string
+
+        The path of the snapshot directory.
+    """
+    rng = np.random.RandomState(seed)
+    snapshot = os.path.join(snap_dir, "snapshot_{0:03d}".format(snapnum))
+    if not os.path.isdir(snapshot):
+        os.makedirs(snapshot)
+    base = os.path.join(snapshot, "snap_{0:03d}".format(snapnum))
+
+    mean_rho = n_particles / box**3
+    gas = {
+        "Coordinates": rng.uniform(0, box, (n_particles, 3)),
+        "Mass": np.ones(n_particles, dtype=np.float32),
+        "Density": (mean_rho * rng.lognormal(0, 1, n_particles)).astype(
+            np.float32),
+        "Temperature": 10**rng.uniform(3, 7, n_particles).astype(np.float32),
+        "ElementAbundance/Hydrogen": np.full(n_particles, 0.752,
+                                             dtype=np.float32),
+        "ElementAbundance/Helium": np.full(n_particles, 0.248,
+                                           dtype=np.float32),
+    }
+    gas["SmoothingLength"] = (2 * (gas["Mass"] / gas["Density"])**(1 / 3)
+                              ).astype(np.float32)
+    for field in ION_FIELDS:
+        gas[field] = rng.uniform(0, 1, n_particles).astype(np.float32)
+
+    for i, idx in enumerate(np.array_split(np.arange(n_particles), nfiles)):
+        if nfiles > 1:
+            filename = "{0}.{1}.hdf5".format(base, i)
+        else:
+            filename = base + ".hdf5"
+
+        with h5py.File(filename, "w") as f:
+            header = f.create_group("Header")
+            header.attrs["BoxSize"] = box
+            header.attrs["HubbleParam"] = 0.6777
+            header.attrs["Redshift"] = redshift
+            header.attrs["ExpansionFactor"] = 1 / (1 + redshift)
+            header.attrs["NumFilesPerSnapshot"] = nfiles
+            header.attrs["NumPart_ThisFile"] = [len(idx), 0, 0, 0, 0, 0]
+            header.attrs["NumPart_Total"] = [n_particles, 0, 0, 0, 0, 0]
+
+            part = f.create_group("PartType0")
+            for field, values in gas.items():
+                part.create_dataset(field, data=values[idx])
+
+    return snapshot
+
+
+def make_ray(filename, n_cells, length=25.0e6, seed=0):
+    """
+    Write a synthetic ray with the layout of a trident LightRay.
+
+    Parameters
+    ----------
+    filename : string
+
+        The filename of the ray.
+
+    n_cells : integer
+
+        The number of path elements along the ray.
+
+    length : float, optional
+
+        The length of the ray in pc. Default: 25 Mpc
+
+    seed : integer, optional
+
+        The random seed. Default: 0
+
+    Returns
+    -------
+    filename : string
+
+        The filename of the ray.
+    """
+    rng = np.random.RandomState(seed)
+    dl = rng.dirichlet(np.ones(n_cells)) * length * 3.0857e18
+    l = np.cumsum(dl) - dl / 2
+    nH = 10**rng.normal(-6, 1, n_cells)
+
+    with h5py.File(filename, "w") as f:
+        grid = f.create_group("grid")
+        grid.create_dataset("dl", data=dl)
+        grid.create_dataset("l", data=l)
+        grid.create_dataset("H_p0_number_density", data=1e-5 * nH)
+        grid.create_dataset("H_p1_number_density", data=nH)
+        grid.create_dataset("He_p0_number_density", data=1e-6 * nH)
+        grid.create_dataset("He_p1_number_density", data=1e-3 * nH)
+        grid.create_dataset("He_p2_number_density", data=0.08 * nH)
+
+    return filename
+
+
+def make_rays(ray_dir, n_rays, n_cells, seed=0):
+    """
+    Write n_rays synthetic rays named ray_XXXX.h5 and return their
+    filenames.
+    """
+    if not os.path.isdir(ray_dir):
+        os.makedirs(ray_dir)
+    return [make_ray(os.path.join(ray_dir, "ray_{0:04d}.h5".format(i)),
+                     n_cells, seed=seed + i)
+            for i in range(n_rays)]
+
+
+def make_cloudy_table(loc, ion="h1", cloudy="hm12", nz=49, ntemp=141,
+                      nrho=176, seed=0):
+    """
+    Write a synthetic CLOUDY ionisation table in the Fortran format read by
+    fortran.readf.
+
+    Parameters
+    ----------
+    loc : string
+
+        The directory prefix of the table, as given to fortran.readf.
+
+    ion, cloudy : string, optional
+
+        The ion and ionising background in the table name.
+        Default: 'h1', 'hm12'
+
+    nz, ntemp, nrho : integer, optional
+
+        The number of redshift, temperature and density intervals.
+        Default: 49, 141, 176
+
+    seed : integer, optional
+
+        The random seed. Default: 0
+
+    Returns
+    -------
+    filename : string
+
+        The filename of the table.
+    """
+    from scipy.io import FortranFile
+
+    rng = np.random.RandomState(seed)
+    filename = "".join([loc, ion, "_", cloudy])
+    ionbal = rng.uniform(0, 1, (nz, ntemp, nrho)).astype(np.float32)
+    values = np.concatenate([np.linspace(0, 9.5, nz),
+                             np.linspace(1, 9, ntemp),
+                             np.linspace(-8, 0, nrho)]).astype(np.float32)
+
+    header = np.array([(nz, ntemp, nrho)],
+                      dtype=[("nz", "<i4"), ("ntemp", "<i4"),
+                             ("nvel", "<i4")])
+    with FortranFile(filename, "w") as f:
+        f.write_record(header)
+        f.write_record(ionbal.ravel(order="F"))
+        f.write_record(values)
+
+    return filename
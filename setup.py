@@ -27,6 +27,7 @@ setuptools.setup(
     long_description_content_type="text/x-rst",
     url="https://github.com/abatten/topaz",
     packages=setuptools.find_packages(),
+    python_requires=">=3.7",
     classifiers=(
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: MIT License",
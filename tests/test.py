@@ -0,0 +1,592 @@
+#!/usr/bin/env python
+"""
+Tests of TOPAZ on small synthetic snapshots, rays and tables.
+
+Run with: python -m pytest tests/test.py
+"""
+from __future__ import print_function, division
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.synthetic import make_snapshot, make_rays, make_cloudy_table
+
+
+def _sightline_gas(n=2000, boxsize=10.0, seed=0):
+    rng = np.random.RandomState(seed)
+    gas = {
+        "position": rng.uniform(0, boxsize, (n, 3)),
+        "hsml": rng.uniform(0.2, 1.0, n),
+        "length_to_cm": 3.0857e24,
+        "boxsize": boxsize,
+        "volume": rng.uniform(0.5, 1.5, n) * 1e72,
+    }
+    for species in ["H_p0", "H_p1", "He_p0", "He_p1", "He_p2"]:
+        gas[species] = rng.uniform(0, 1e-4, n)
+    return gas
+
+
+def test_sightline_DM_matches_brute_force():
+    from topaz import sphray, constants as c
+
+    gas = _sightline_gas()
+    coords = np.random.RandomState(1).uniform(0, gas["boxsize"], (50, 2))
+    rays = list(sphray.integrate_sightlines(gas, coords, axis="z",
+                                            chunk_size=16))
+
+    ne = gas["H_p1"] + gas["He_p1"] + 2 * gas["He_p2"]
+    h_cm = gas["hsml"] * gas["length_to_cm"]
+    for ray, coord in zip(rays, coords):
+        delta = gas["position"][:, :2] - coord
+        delta -= gas["boxsize"] * np.round(delta / gas["boxsize"])
+        b = np.sqrt(np.sum(delta**2, axis=1)) / gas["hsml"]
+        dl = gas["volume"] * sphray.projected_kernel(b) / h_cm**2
+        expected = np.sum(ne * dl) * c.CM_TO_PC
+
+        DM = np.dot(ray["H_p1"] + ray["He_p1"] + 2 * ray["He_p2"],
+                    ray["dl"]) * c.CM_TO_PC
+        assert DM == pytest.approx(expected, rel=1e-10)
+        assert np.all(np.diff(ray["l"]) >= 0)
+
+
+def test_cell_index_is_capped():
+    from topaz import sphray
+
+    gas = _sightline_gas(n=500, boxsize=1e4)
+    gas["hsml"][:] = 1e-3
+    index = sphray._CellIndex(gas["position"][:, :2], gas["hsml"],
+                              gas["boxsize"])
+    assert index.ncell <= min(sphray.MAX_CELLS, int(np.sqrt(500)))
+
+
+def test_reduction_cache_sees_rewritten_snapshot(tmp_path):
+    from topaz.cache import ReductionCache
+
+    snapshot = make_snapshot(str(tmp_path), 100)
+    snap_file = os.path.join(snapshot, "snap_000")
+    cache = ReductionCache(str(tmp_path / "cache.sqlite"))
+    cache.put(snap_file, "HI", "volume", 0.0, 0.5)
+    assert cache.get(snap_file, "HI", "volume") == (0.0, 0.5)
+
+    make_snapshot(str(tmp_path), 200)
+    assert cache.get(snap_file, "HI", "volume") is None
+    cache.close()
+
+
+def test_fortran_cache_matches_uncached_read(tmp_path):
+    from topaz import fortran
+
+    loc = str(tmp_path) + "/"
+    make_cloudy_table(loc, nz=4, ntemp=6, nrho=8)
+    uncached = fortran.readf(loc, cache=False)
+    for _ in range(2):
+        cached = fortran.readf(loc)
+        for a, b in zip(cached, uncached):
+            np.testing.assert_array_equal(a, b)
+            assert not a.flags.writeable
+
+
+@pytest.mark.parametrize("redshift", [0.0, 3.3, 20.0])
+def test_ion_fractions_match_scipy(tmp_path, redshift):
+    from scipy.interpolate import RegularGridInterpolator
+    from topaz import ionbal
+
+    loc = str(tmp_path) + "/"
+    make_cloudy_table(loc, nz=5, ntemp=7, nrho=9)
+    table = ionbal.read_cloudy_table(loc)
+    grid = (table.redshift, table.logt, table.logd)
+    tables = {"h1": table,
+              "log": ionbal.IonTable(np.log10(table.ionbal), *grid, log=True)}
+
+    #  Particles on both sides of the edges of the table are clipped to it
+    rng = np.random.RandomState(0)
+    logt = rng.uniform(table.logt[0] - 1, table.logt[-1] + 1, 1000)
+    logd = rng.uniform(table.logd[0] - 1, table.logd[-1] + 1, 1000)
+    fractions = ionbal.ion_fractions(tables, redshift, 10**logt, 10**logd,
+                                     chunk_size=300, dtype=np.float64)
+
+    points = np.column_stack([np.full(len(logt), redshift), logt, logd])
+    for axis, values in enumerate(grid):
+        points[:, axis] = np.clip(points[:, axis], values[0], values[-1])
+    interp = RegularGridInterpolator(grid, np.asarray(table.ionbal,
+                                                      dtype=np.float64))
+    np.testing.assert_allclose(fractions["h1"], interp(points), rtol=1e-10)
+    logt_grid, logd_grid = np.meshgrid(table.logt, table.logd,
+                                       indexing="ij")
+    nodes = np.stack([np.full(logt_grid.shape, points[0, 0]), logt_grid,
+                      logd_grid], axis=-1)
+    np.testing.assert_allclose(table.at_redshift(redshift), interp(nodes),
+                               rtol=1e-10)
+
+    interp = RegularGridInterpolator(grid, np.asarray(tables["log"].ionbal,
+                                                      dtype=np.float64))
+    np.testing.assert_allclose(fractions["log"], 10**interp(points),
+                               rtol=1e-10)
+
+
+def test_archive_round_trip(tmp_path):
+    from topaz import analysis, archive
+
+    files = make_rays(str(tmp_path / "rays"), 7, 50)
+    archive_file = str(tmp_path / "rays.h5")
+    archive.pack_rays(files, archive_file, batch_size=3)
+
+    index = archive.read_index(archive_file)
+    assert list(index["name"]) == [os.path.basename(f) for f in files]
+
+    offsets, data = archive.read_rays(archive_file)
+    for i, ray_file in enumerate(files):
+        ray = archive.read_ray_file(ray_file)
+        for name, values in ray["grid"].items():
+            assert data[name].dtype == values.dtype
+            np.testing.assert_array_equal(
+                data[name][offsets[i]:offsets[i + 1]], values)
+
+    with pytest.raises(IOError):
+        archive.pack_rays(files, archive_file)
+    archive.pack_rays(files[:2], archive_file, overwrite=True)
+    assert len(archive.read_index(archive_file)["name"]) == 2
+    archive.pack_rays(files[2:], archive_file, append=True)
+    assert len(archive.read_index(archive_file)["name"]) == 7
+
+    os.mkdir(str(tmp_path / "unpacked"))
+    archive.unpack_rays(archive_file, str(tmp_path / "unpacked"))
+    for ray_file in files:
+        unpacked = str(tmp_path / "unpacked" / os.path.basename(ray_file))
+        assert analysis.calc_DM(unpacked) == analysis.calc_DM(ray_file)
+
+
+def test_DM_batch_matches_calc_DM(tmp_path):
+    import h5py
+    from topaz import analysis
+
+    files = make_rays(str(tmp_path / "rays"), 6, 50)
+    expected = [analysis.calc_DM(f) for f in files]
+
+    table = analysis.calc_DM_batch(str(tmp_path / "rays"),
+                                   output=str(tmp_path / "DM.npz"), nproc=1)
+    assert list(table["ray"]) == files
+    np.testing.assert_array_equal(table["DM"], expected)
+    saved = np.load(str(tmp_path / "DM.npz"))
+    assert list(saved["ray"]) == files
+    np.testing.assert_array_equal(saved["DM"], expected)
+
+    table = analysis.calc_DM_batch(files, output=str(tmp_path / "DM.h5"),
+                                   nproc=2, chunksize=2)
+    np.testing.assert_array_equal(table["DM"], expected)
+    with h5py.File(str(tmp_path / "DM.h5"), "r") as f:
+        assert [name.decode() for name in f["ray"][()]] == files
+        np.testing.assert_array_equal(f["DM"][()], expected)
+
+
+def test_ray_profiles_end_at_total_DM(tmp_path):
+    from topaz import analysis, archive
+
+    files = make_rays(str(tmp_path / "rays"), 7, 50)
+    archive_file = str(tmp_path / "rays.h5")
+    archive.pack_rays(files, archive_file)
+
+    profiles = analysis.ray_profiles(str(tmp_path / "rays"), bins=20)
+    assert profiles["DM"].shape == (7, 20)
+    assert list(profiles["names"]) == [os.path.basename(f) for f in files]
+    np.testing.assert_allclose(profiles["DM"][:, -1],
+                               [analysis.calc_DM(f) for f in files],
+                               rtol=1e-6)
+    assert np.all(np.diff(profiles["DM"], axis=1) >= 0)
+
+    #  The same profiles from the archive, in batches
+    packed = analysis.ray_profiles(archive_file, bins=profiles["edges"],
+                                   batch_size=3)
+    assert list(packed["names"]) == list(profiles["names"])
+    for name in ["edges", "DM", "H_p0", "He_p1"]:
+        np.testing.assert_array_equal(packed[name], profiles[name])
+
+
+def test_sightline_archive_matches_files(tmp_path):
+    from topaz import archive, sphray
+
+    snapshot = make_snapshot(str(tmp_path), 2000, box=5.0)
+    snap_file = os.path.join(snapshot, "snap_000")
+    files = sphray.make_sightlines(snap_file, n=5, seed=3,
+                                   output_data_dir=str(tmp_path))
+    archive_file = str(tmp_path / "sightlines.h5")
+    names = sphray.make_sightlines(snap_file, n=5, seed=3,
+                                   archive_file=archive_file)
+    assert names == [os.path.basename(f) for f in files]
+
+    offsets, data = archive.read_rays(archive_file)
+    for i, ray_file in enumerate(files):
+        ray = archive.read_ray_file(ray_file)
+        np.testing.assert_array_equal(data["dl"][offsets[i]:offsets[i + 1]],
+                                      ray["grid"]["dl"])
+
+    with pytest.raises(IOError):
+        sphray.make_sightlines(snap_file, n=5, seed=3,
+                               archive_file=archive_file)
+    sphray.make_sightlines(snap_file, n=5, seed=4, archive_file=archive_file,
+                           append=True)
+    assert len(archive.read_index(archive_file)["name"]) == 10
+
+    #  A box with only 121 positions at two decimals, so that random
+    #  draws collide
+    snapshot = make_snapshot(str(tmp_path / "small"), 200, box=0.1)
+    files = sphray.make_sightlines(os.path.join(snapshot, "snap_000"),
+                                   n=100, seed=3,
+                                   output_data_dir=str(tmp_path / "small"))
+    assert len(set(files)) == 100
+    assert all(os.path.isfile(f) for f in files)
+    with pytest.raises(ValueError):
+        sphray.make_sightlines(snap_file, coords=[[1.0, 2.0], [1.0, 2.0]])
+
+
+def test_quantile_sketch_accuracy(tmp_path):
+    from topaz.stats import StreamingStats
+
+    values = np.random.RandomState(2).lognormal(size=200000)
+    q = np.array([0.01, 0.1, 0.25, 0.5, 0.75, 0.9, 0.99])
+
+    #  Four partial statistics merged, one of them through a saved file
+    parts = []
+    for i, chunk in enumerate(np.array_split(values, 4)):
+        stats = StreamingStats(bins=np.linspace(0, 10, 11), seed=i)
+        for block in np.array_split(chunk, 10):
+            stats.update(block)
+        parts.append(stats)
+    parts[1].save(str(tmp_path / "part.npz"))
+    parts[1] = StreamingStats.load(str(tmp_path / "part.npz"))
+    stats = parts[0]
+    for part in parts[1:]:
+        stats.merge(part)
+
+    assert stats.count == len(values)
+    assert stats.mean == pytest.approx(np.mean(values), rel=1e-10)
+    assert stats.std == pytest.approx(np.std(values, ddof=1), rel=1e-10)
+    np.testing.assert_array_equal(stats.histogram()[0],
+                                  np.histogram(values, np.linspace(0, 10, 11))[0])
+
+    #  The rank error of the sketch is about 1 / k
+    ranks = np.searchsorted(np.sort(values), stats.quantile(q)) / len(values)
+    assert np.all(np.abs(ranks - q) < 0.02)
+
+
+def _snapshot_series(tmp_path, n_snapshots=4, n_particles=5000):
+    return [make_snapshot(str(tmp_path), n_particles, snapnum=i,
+                          redshift=3.0 - i, seed=i)
+            for i in range(n_snapshots)]
+
+
+def test_ion_means_keep_order_of_failed_snapshots(tmp_path):
+    from topaz import analysis
+
+    snapshots = _snapshot_series(tmp_path)
+    broken = str(tmp_path / "snapshot_009")
+    os.mkdir(broken)
+    snapshot_list = [snapshots[2], broken, snapshots[0], snapshots[1]]
+
+    with pytest.warns(UserWarning, match="Could not reduce"):
+        redshift, means = analysis.ion_means(snapshot_list, ["HI"],
+                                             ["volume"])
+    np.testing.assert_array_equal(redshift[[0, 2, 3]], [1.0, 3.0, 2.0])
+    assert np.isnan(redshift[1]) and np.isnan(means[("HI", "volume")][1])
+    assert np.all(np.isfinite(means[("HI", "volume")][[0, 2, 3]]))
+
+
+def test_ion_means_reduce_only_uncached_ions(tmp_path, monkeypatch):
+    from topaz import analysis
+
+    snapshots = _snapshot_series(tmp_path)
+    cache_file = str(tmp_path / "cache.sqlite")
+    redshift, means = analysis.ion_means(snapshots, ["HI", "HeII"],
+                                         ["volume", "mass"])
+    analysis.ion_means(snapshots, ["HI"], ["volume", "mass"],
+                       cache=cache_file)
+
+    reduced = []
+    reduce_snapshots = analysis._reduce_snapshots
+
+    def record(snap_files, ions, weightings, **kwargs):
+        reduced.append((len(snap_files), ions, weightings))
+        return reduce_snapshots(snap_files, ions, weightings, **kwargs)
+
+    monkeypatch.setattr(analysis, "_reduce_snapshots", record)
+    cached_redshift, cached_means = analysis.ion_means(
+        snapshots, ["HI", "HeII"], ["volume", "mass"], cache=cache_file)
+
+    assert reduced == [(4, ["HeII"], ["volume", "mass"])]
+    np.testing.assert_array_equal(cached_redshift, redshift)
+    for key, values in means.items():
+        np.testing.assert_allclose(cached_means[key], values, rtol=1e-12)
+
+
+def test_ion_means_match_in_memory_reduction(tmp_path):
+    from topaz import analysis, gadget
+
+    snapshots = _snapshot_series(tmp_path)
+    ions, weightings = ["HI", "HeI", "HeII"], ["volume", "mass", None]
+
+    expected = {}
+    for snap in snapshots:
+        gas = gadget.read_gas(analysis.snapshot_file(snap),
+                              ["Mass", "Density", "apHI", "apHeI", "apHeII"])
+        for weighting in weightings:
+            weights = analysis.particle_weights(gas["Mass"], gas["Density"],
+                                                weighting)
+            for ion in ions:
+                expected.setdefault((ion, weighting), []).append(
+                    np.dot(gas["ap" + ion], weights))
+
+    for kwargs in [dict(chunk_size=999), dict(prefetch=2, chunk_size=999),
+                   dict(prefetch=1, prefetch_bytes=1), dict(nproc=2)]:
+        redshift, means = analysis.ion_means(snapshots, ions, weightings,
+                                             **kwargs)
+        np.testing.assert_array_equal(redshift, [3.0, 2.0, 1.0, 0.0])
+        for key, values in expected.items():
+            np.testing.assert_allclose(means[key], values, rtol=1e-12)
+
+
+def test_projection_of_constant_quantity_is_constant():
+    from topaz import render
+
+    gas = _sightline_gas(n=3000)
+    volume = gas["volume"] / 1e72
+    images = render.render_images(gas["position"], gas["hsml"],
+                                  {"rho": 1 / volume,
+                                   "ratio": np.full(3000, 0.7)},
+                                  gas["boxsize"], resolution=64,
+                                  center=(5.0, 5.0), kind="proj",
+                                  volume=volume, average=["ratio"])
+
+    covered = images["rho"] > 0
+    np.testing.assert_allclose(images["ratio"][covered], 0.7, rtol=1e-12)
+    assert np.all(images["ratio"][~covered] == 0)
+
+
+def test_render_cache_keys_on_file_and_view(tmp_path):
+    from topaz.cache import RenderCache
+
+    snapshot = make_snapshot(str(tmp_path), 100)
+    snap_file = os.path.join(snapshot, "snap_000")
+    params = {"quantity": "rho", "center": None, "rotation": None}
+
+    cache = RenderCache(str(tmp_path / "renders"))
+    cache.put(snap_file, params, np.ones((4, 4)), 25.0)
+    assert cache.get(snap_file, params)[1] == 25.0
+
+    moved = dict(params, center=(12.5, 12.5, 12.5), rotation="faceon")
+    assert cache.get(snap_file, moved) is None
+
+    make_snapshot(str(tmp_path), 200)
+    assert cache.get(snap_file, params) is None
+
+
+def test_profile_merges_worker_stages(tmp_path):
+    from topaz import analysis, profiling
+
+    snapshots = _snapshot_series(tmp_path)
+    with profiling.profile(str(tmp_path / "trace.json")) as prof:
+        analysis.ion_means(snapshots, nproc=2)
+
+    reduce_records = [r for r in prof.records if r["stage"] == "reduce"]
+    assert len(reduce_records) == len(snapshots)
+    assert all(r["pid"] != os.getpid() for r in reduce_records)
+    assert all(r["peak_delta"] is None or r["peak_delta"] >= 0
+               for r in prof.records)
+    assert "reduce" in prof.report()
+
+    #  Streamed chunks are read in their own stage, nested in the reduction
+    with profiling.profile() as prof:
+        analysis.ion_means(snapshots, chunk_size=1000)
+    reads = [r for r in prof.records if r["stage"] == "read"]
+    assert len(reads) == 5 * len(snapshots)
+    assert all(r["parent"] == "reduce" for r in reads)
+
+
+def test_ion_history_reduces_rewritten_snapshots(tmp_path):
+    from topaz import analysis
+
+    output_dir = str(tmp_path / "output")
+    history_file = str(tmp_path / "ion_history.h5")
+    snapshots = _snapshot_series(output_dir, n_snapshots=3)
+    redshift, means = analysis.update_ion_history(output_dir, history_file)
+    np.testing.assert_array_equal(redshift, [3.0, 2.0, 1.0])
+
+    #  Rewrite one snapshot with different particles
+    make_snapshot(output_dir, 3000, snapnum=1, redshift=2.0, seed=7)
+    expected = analysis.ion_means(snapshots)[1][("HI", "volume")]
+    redshift, means = analysis.update_ion_history(output_dir, history_file)
+    np.testing.assert_allclose(means[("HI", "volume")], expected, rtol=1e-12)
+    assert analysis.read_ion_history(history_file)[0] == [
+        os.path.basename(snap) for snap in snapshots]
+
+
+def test_snapshot_map_wraps_and_averages(tmp_path):
+    from topaz import frames, constants as c
+
+    snapshot = make_snapshot(str(tmp_path), 5000, box=10.0)
+    snap_file = os.path.join(snapshot, "snap_000")
+
+    #  No mass is lost at the edges of the periodic box
+    image, extent, _ = frames.snapshot_map(snap_file, "rho", resolution=128)
+    assert extent == (0.0, 10.0, 0.0, 10.0)
+    assert np.sum(image) * (10.0 / 128)**2 == pytest.approx(5000, rel=1e-4)
+
+    #  A constant [X/H] projects to the same constant
+    image = frames.snapshot_map(snap_file, "HeXH", resolution=64)[0]
+    expected = (np.float32(0.248) / np.float32(0.752) *
+                c.XSOLH / c.SOLAR_ABUNDANCE["He"])
+    np.testing.assert_allclose(image, expected, rtol=1e-6)
+
+
+def test_render_frames(tmp_path, monkeypatch):
+    from topaz import frames
+
+    snapshots = _snapshot_series(tmp_path / "output", n_snapshots=2,
+                                 n_particles=2000)
+    maps = frames.render_frames(snapshots, str(tmp_path / "maps"),
+                                resolution=32, fmt="npy", nproc=1)
+    pngs = frames.render_frames(snapshots, str(tmp_path / "frames"),
+                                resolution=32, nproc=1)
+    assert all(os.path.isfile(f) for f in maps + pngs)
+    assert sorted(os.listdir(str(tmp_path / "frames"))) == [
+        "frame_0000.png", "frame_0001.png"]
+
+    #  The colour limits come from a low resolution pre-pass, skipped when
+    #  they are given
+    resolutions = []
+    snapshot_map = frames.snapshot_map
+
+    def recording_map(snap_file, qty, kind, resolution, width, center):
+        resolutions.append(resolution)
+        return snapshot_map(snap_file, qty, kind, resolution, width, center)
+
+    monkeypatch.setattr(frames, "snapshot_map", recording_map)
+    frames.render_frames(snapshots, str(tmp_path / "frames"),
+                         resolution=32, prepass_resolution=8, nproc=1)
+    assert resolutions == [8, 8, 32, 32]
+    del resolutions[:]
+    frames.render_frames(snapshots, str(tmp_path / "frames"),
+                         resolution=32, vmin=1e-3, vmax=1.0, nproc=1)
+    assert resolutions == [32, 32]
+
+
+@pytest.mark.parametrize("qty", ["rho", "HeXH"])
+def test_tiled_map_matches_full_render(tmp_path, qty):
+    import h5py
+    from topaz import frames, tiles
+
+    snapshot = make_snapshot(str(tmp_path), 3000, box=10.0)
+    snap_file = os.path.join(snapshot, "snap_000")
+    image = frames.snapshot_map(snap_file, qty, resolution=64)[0]
+
+    map_file = tiles.tiled_map(snap_file, str(tmp_path / "map.h5"), qty,
+                               resolution=64, tile_pixels=16,
+                               chunk_size=1000, nproc=1)
+    with h5py.File(map_file, "r") as f:
+        tiled = f["image"][()]
+    np.testing.assert_allclose(tiled, image, rtol=1e-5,
+                               atol=1e-6 * image.max())
+
+    #  An off-centre map with the default tiles
+    image = frames.snapshot_map(snap_file, qty, resolution=60, width=4.0,
+                                center=(2.0, 3.0, 5.0))[0]
+    map_file = tiles.tiled_map(snap_file, str(tmp_path / "map.h5"), qty,
+                               resolution=60, width=4.0, center=(2.0, 3.0),
+                               chunk_size=1000, nproc=1)
+    with h5py.File(map_file, "r") as f:
+        assert f.attrs["tile_pixels"] == 60
+        tiled = f["image"][()]
+    np.testing.assert_allclose(tiled, image, rtol=1e-5,
+                               atol=1e-6 * image.max())
+
+
+def test_default_tile_pixels():
+    from topaz.tiles import default_tile_pixels
+
+    assert default_tile_pixels(1000) == 1000
+    assert default_tile_pixels(8192) == 1024
+    assert default_tile_pixels(3000) == 1000
+    assert default_tile_pixels(48, max_pixels=20) == 16
+    assert default_tile_pixels(1031) == 1
+
+
+def test_import_topaz_is_light():
+    import subprocess
+
+    code = ("import sys, topaz; "
+            "print(sorted(m for m in ('pynbody', 'yt', 'trident', "
+            "'matplotlib') if m in sys.modules))")
+    output = subprocess.check_output(
+        [sys.executable, "-c", code],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    assert output.decode().strip() == "[]"
+
+
+def test_slice_keeps_true_support_along_z():
+    from topaz import render
+
+    #  Particles much smaller than a pixel, half a pixel above the slice
+    dx = 0.1
+    pos = np.array([[0.05, 0.05, 0.05], [0.25, 0.25, 0.0]])
+    hsml = np.array([0.01, 0.01])
+    image = render.render_images(pos, hsml, {"q": np.ones(2)}, 1.0,
+                                 resolution=10, center=(0.5, 0.5),
+                                 kind="slice")["q"]
+    assert image[0, 0] == 0
+    assert image[2, 2] > 0
+
+
+def test_ray_coordinates_are_unique(tmp_path):
+    from topaz.rayfiles import ray_coordinates, ray_files
+
+    #  121 possible coordinates, so most draws collide
+    coords = ray_coordinates(100, 0.1, seed=3)
+    assert coords.shape == (100, 2)
+    assert len(np.unique(coords, axis=0)) == 100
+    assert np.all((coords >= 0) & (coords <= 0.1))
+    assert np.array_equal(coords, ray_coordinates(100, 0.1, seed=3))
+
+    with pytest.raises(ValueError):
+        ray_coordinates(122, 0.1, seed=3)
+
+    open(str(tmp_path / "Ray_a.h5"), "w").close()
+    open(str(tmp_path / "Ray_b.part.h5"), "w").close()
+    assert ray_files(str(tmp_path)) == [str(tmp_path / "Ray_a.h5")]
+
+
+def test_ray_campaign_skips_done_rays(tmp_path):
+    pytest.importorskip("trident")
+    import json
+    import h5py
+    from topaz import rays
+
+    class FakeFactory(rays.RayFactory):
+        def __init__(self):
+            self.ds = type("Dataset", (), {"parameters": {"BoxSize": 10.0}})
+            self.made = []
+
+        def make_ray(self, ray_start, ray_end, line_list, filename, **kwargs):
+            with h5py.File(filename, "w") as f:
+                f.create_dataset("grid/dl", data=np.ones(4))
+            self.made.append(filename)
+
+    factory = FakeFactory()
+    manifest_file = rays.ray_campaign(factory, 6, str(tmp_path), seed=1)
+    assert len(factory.made) == 6
+
+    #  Interrupt two rays: one lost, one left half written
+    with open(manifest_file) as f:
+        manifest = json.load(f)
+    lost, partial = [ray["filename"] for ray in manifest["rays"][:2]]
+    os.remove(lost)
+    os.replace(partial, rays._part_filename(partial))
+
+    factory = FakeFactory()
+    rays.ray_campaign(factory, 6, str(tmp_path), seed=1)
+    assert sorted(factory.made) == sorted(rays._part_filename(name)
+                                          for name in [lost, partial])
+    assert len(os.listdir(str(tmp_path))) == 7
@@ -1,4 +1,23 @@
 __name__ = "topaz"
 __version__ = "0.0.7"
 
-from . import analysis, fortran, plot, rays, constants
+import importlib
+
+#  Submodules are imported the first time they are used, so importing
+#  topaz does not pull in yt, trident, pynbody or matplotlib. The [X/H]
+#  derived quantities (CXH, OXH, ...) are registered with pynbody when
+#  topaz.derived or topaz.plot is first imported.
+_submodules = ["analysis", "archive", "cache", "constants", "derived",
+               "fortran", "frames", "gadget", "ionbal", "plot", "profiling",
+               "rayfiles", "rays", "render", "sphray", "stats", "tiles"]
+
+
+def __getattr__(name):
+    if name in _submodules:
+        return importlib.import_module("." + name, __name__)
+    raise AttributeError("module {0!r} has no attribute {1!r}".format(
+        __name__, name))
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_submodules))
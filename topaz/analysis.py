@@ -1,29 +1,79 @@
 #!/usr/bin/env python
 from __future__ import print_function
 
+import os
+import re
+import collections
+import glob
+import warnings
+import multiprocessing
+
 import numpy as np
-import pynbody as pn
 from tqdm import tqdm
 
 import h5py
 
+from . import archive
 from . import constants as c
+from . import gadget
+from .cache import file_identity, reduction_cache
+from . import profiling
+from .profiling import stage
+from .rayfiles import ray_files, ray_info
+from .stats import StreamingStats
+
+#  The number of particles read at a time by the streaming reductions
+CHUNK_SIZE = 2**20
+
+#  The memory budget for snapshots read ahead by the reductions
+PREFETCH_BYTES = 2 * 1024**3
+
+
+class _CompensatedSum(object):
+    """
+    A running sum using Neumaier compensated summation.
+    """
+
+    def __init__(self):
+        self.total = 0.0
+        self.compensation = 0.0
+
+    def add(self, value):
+        value = float(value)
+        total = self.total + value
+        if abs(self.total) >= abs(value):
+            self.compensation += (self.total - total) + value
+        else:
+            self.compensation += (value - total) + self.total
+        self.total = total
+
+    @property
+    def value(self):
+        return self.total + self.compensation
 
-def weight(snapshot, qty, weight_type="volume"):
+
+def weight(snapshot, qty, weight_type="volume", chunk_size=CHUNK_SIZE):
     """
     Weights the quantity 'qty' in the simulation.
 
     Parameters
     ----------
 
-    snapshot : pynbody.snapshot
+    snapshot : pynbody.snapshot, dict or string
+
+        The snapshot that will have its quantity weighted. This can also be
+        a dictionary of gas arrays containing 'Mass' and 'Density', such as
+        the one returned by gadget.read_gas, or the path to a Gadget HDF5
+        snapshot. Any consistent units can be used for the arrays.
 
-        The snapshot that will have its quantity weighted.
+        If a path is given, the gas particles are read from disk in chunks
+        so the memory used does not depend on the size of the snapshot.
 
-    qty : pynbody.array.SimArray
+    qty : pynbody.array.SimArray, numpy.ndarray or string
     
         The quantity to calculated the weighted. This is usually specified by
-        using something similar to: s.g['rho']
+        using something similar to: s.g['rho']. If snapshot is a path, this
+        is the name of the PartType0 dataset, e.g. 'apHI'.
 
     weight_type : {'mass', 'volume', None}, optional
 
@@ -32,35 +82,354 @@ def weight(snapshot, qty, weight_type="volume"):
         simulations where all the particles are the same mass.
         Default: 'volume'
 
+    chunk_size : integer, optional
+
+        The number of particles read at a time when snapshot is a path.
+        Default: 2**20
+
     Returns
     -------
 
     weighted_qty : pynbody.array.SimArray
         The weighted quantity
     """
+    if isinstance(snapshot, str):
+        means = _stream_weighted_means(snapshot, [qty], [weight_type],
+                                       chunk_size=chunk_size)
+        return means[(qty, weight_type)]
+
+    if isinstance(snapshot, dict):
+        pweight = particle_weights(snapshot["Mass"], snapshot["Density"],
+                                   weight_type, normalise=False)
+        return np.dot(qty, pweight) / np.sum(pweight)
+
     if weight_type == "mass" or weight_type is None:
         pmass = snapshot.g["Mass"].in_units("m_p")
         total_mass = np.sum(pmass)
-        weighted_quant = np.sum(qty * pmass / total_mass)
+        weighted_qty = np.sum(qty * pmass / total_mass)
 
     elif weight_type == "volume":
         pmass = snapshot.g["Mass"].in_units("m_p")
         pvol = pmass / snapshot.g["Density"].in_units("m_p cm**-3")
         total_vol = np.sum(pvol)
-        weighted_quant = np.sum(qty * pvol / total_vol)
+        weighted_qty = np.sum(qty * pvol / total_vol)
 
     return weighted_qty
 
 
-def ion_mean(snapshot_list, ion="HI", weighting=None, verbose=False, **kwargs):
+def _stream_weighted_means(snap_file, fields, weightings,
+                           chunk_size=CHUNK_SIZE):
+    """
+    Calculate the weighted mean of several gas fields with several
+    weighting schemes in one chunked pass over a snapshot on disk.
+    """
+    chunks = gadget.iter_gas(snap_file, ["Mass", "Density"] + fields,
+                             chunk_size=chunk_size)
+    return _weighted_means(chunks, fields, weightings)
+
+
+def _weighted_means(chunks, fields, weightings):
+    """
+    Calculate the weighted mean of several gas fields with several
+    weighting schemes in one pass over chunks of the gas particles.
+
+    The weighted numerator and the total weight are accumulated per chunk
+    with compensated summation, so the result matches the in-memory
+    calculation.
+    """
+    numerators = dict(((field, weighting), _CompensatedSum())
+                      for field in fields for weighting in weightings)
+    denominators = dict((weighting, _CompensatedSum())
+                        for weighting in weightings)
+
+    for chunk in chunks:
+        for weighting in weightings:
+            pweight = particle_weights(chunk["Mass"], chunk["Density"],
+                                       weighting, normalise=False)
+            denominators[weighting].add(np.sum(pweight))
+            for field in fields:
+                numerators[(field, weighting)].add(
+                    np.dot(chunk[field], pweight))
+
+    return dict((key, numerator.value / denominators[key[1]].value)
+                for key, numerator in numerators.items())
+
+
+def snapshot_file(snap):
+    """
+    The base name of the snapshot inside a snapshot directory.
+
+    For example 'output/snapshot_012' contains 'snap_012'.
+    """
+    snap_suffix = snap.rstrip("/").split("_")[-1]
+    return "{0}/snap_{1}".format(snap, snap_suffix)
+
+
+def particle_weights(mass, density, weight_type="volume", normalise=True):
+    """
+    The weight of each particle.
+
+    Parameters
+    ----------
+    mass, density : numpy.ndarray
+
+        The particle masses and densities in any consistent units.
+
+    weight_type : {'mass', 'volume', None}, optional
+
+        The weighting scheme of the particles. Default: 'volume'
+
+    normalise : boolean, optional
+
+        If True, the weights are normalised to sum to 1. Default: True
+
+    Returns
+    -------
+    weights : numpy.ndarray
+
+        The weight of each particle.
+    """
+    if weight_type == "mass" or weight_type is None:
+        weights = np.array(mass, dtype=np.float64)
+    elif weight_type == "volume":
+        weights = np.divide(mass, density, dtype=np.float64)
+    else:
+        raise ValueError("Unknown weighting: {0}".format(weight_type))
+
+    if normalise:
+        weights /= np.sum(weights)
+    return weights
+
+
+def _reduce_snapshot(snap_file, ions, weightings, chunk_size=CHUNK_SIZE,
+                     gas=None):
+    """
+    Calculate the weighted mean of each ion with each weighting for one
+    snapshot.
+
+    If the gas arrays have already been read they are given as gas,
+    otherwise the snapshot is streamed from disk.
+    """
+    apions = ["ap{0}".format(ion) for ion in ions]
+    redshift = gadget.read_header(snap_file)["Redshift"]
+
+    with stage("reduce", snapshot=snap_file, streamed=gas is None):
+        if gas is None:
+            field_means = _stream_weighted_means(snap_file, apions,
+                                                 weightings,
+                                                 chunk_size=chunk_size)
+        else:
+            field_means = _weighted_means(gadget.iter_chunks(gas, chunk_size),
+                                          apions, weightings)
+
+    means = dict(((ion, weighting), field_means[(apion, weighting)])
+                 for ion, apion in zip(ions, apions)
+                 for weighting in weightings)
+    return redshift, means
+
+
+def _reduce_task(args):
+    """
+    Reduce one snapshot in a worker process, returning the error message
+    instead of raising if it fails.
+    """
+    i, snap_file, ions, weightings, chunk_size, gas = args
+    try:
+        return i, _reduce_snapshot(snap_file, ions, weightings, chunk_size,
+                                   gas=gas), None
+    except Exception as error:
+        return i, None, "{0}: {1}".format(type(error).__name__, error)
+
+
+def _reduce_snapshots(snap_files, ions, weightings, chunk_size=CHUNK_SIZE,
+                      prefetch=0, prefetch_bytes=PREFETCH_BYTES, nproc=1):
+    """
+    Reduce each snapshot, either in turn while reading the next ones in the
+    background, or in a process pool with one snapshot per task.
+
+    Yields (index, (redshift, means), error) for each snapshot as it
+    finishes. If a snapshot fails, the result is None and error describes
+    why.
+    """
+    if nproc is None:
+        nproc = multiprocessing.cpu_count()
+
+    if nproc > 1:
+        tasks = [(i, snap_file, ions, weightings, chunk_size, None)
+                 for i, snap_file in enumerate(snap_files)]
+        pool = multiprocessing.Pool(nproc)
+        try:
+            for item in profiling.imap(pool, _reduce_task, tasks):
+                yield item
+        finally:
+            pool.close()
+            pool.join()
+        return
+
+    if not prefetch:
+        for i, snap_file in enumerate(snap_files):
+            yield _reduce_task((i, snap_file, ions, weightings, chunk_size,
+                                None))
+        return
+
+    fields = ["Mass", "Density"] + ["ap{0}".format(ion) for ion in ions]
+    snapshots = gadget.prefetch_snapshots(snap_files, fields, ahead=prefetch,
+                                          max_bytes=prefetch_bytes)
+    for i, (snap_file, gas) in enumerate(snapshots):
+        result = _reduce_task((i, snap_file, ions, weightings, chunk_size,
+                               gas))
+        #  Drop the snapshot before asking for the next, so the memory held
+        #  stays within prefetch_bytes
+        del gas
+        yield result
+
+
+def ion_means(snapshot_list, ions=("HI",), weightings=("volume",),
+              verbose=False, cache=None, chunk_size=CHUNK_SIZE,
+              prefetch=0, prefetch_bytes=PREFETCH_BYTES, nproc=1):
+    """
+    Calculate the weighted mean fraction of several ions with several
+    weighting schemes as a function of redshift.
+
+    Each snapshot is read once and the particle weights are calculated once
+    per weighting scheme. The results are in the order of snapshot_list.
+    Snapshots that fail to reduce are reported with a warning and their
+    redshift and means are NaN.
+
+    Parameters
+    ----------
+    snapshot_list : list of strings
+
+        A list containing the paths for each snapshot directory.
+
+    ions : list of strings, optional
+
+        The ions to calculate the weighted mean abundance of.
+        Options: HI, HeI, HeII (Default: ['HI'])
+
+    weightings : list of {'mass', 'volume', None}, optional
+
+        The weighting schemes of the particles. Default: ['volume']
+
+    verbose : boolean, optional
+
+        If True, print progress information. Default: False
+
+    cache : boolean, string or cache.ReductionCache, optional
+
+        Store the reduction of each snapshot on disk and reuse it while the
+        snapshot files are unchanged. True uses the default store, a string
+        is the filename of a store. Default: None
+
+    chunk_size : integer, optional
+
+        The number of particles read from the snapshot at a time.
+        Default: 2**20
+
+    prefetch : integer, optional
+
+        The number of snapshots read ahead in a background thread while
+        the current one is reduced. 0 streams every snapshot from disk in
+        chunks of chunk_size, so the memory used does not depend on the
+        snapshot size. Default: 0
+
+    prefetch_bytes : integer, optional
+
+        The memory budget for the snapshots read ahead, including the one
+        being reduced. Snapshots larger than this are streamed from disk
+        in chunks instead. Default: 2 GB
+
+    nproc : integer, optional
+
+        The number of worker processes. With more than one, each snapshot
+        is reduced by its own worker and prefetch is not used. If None, use
+        all available cores. Default: 1
+
+    Returns
+    -------
+    redshift : numpy.ndarray
+
+        A numpy array containing the redshifts of each snapshot.
+
+    weighted_means : dict
+
+        The mean ion fraction at each of the redshifts keyed by
+        (ion, weighting), e.g. weighted_means[('HI', 'volume')].
+    """
+    ions = list(ions)
+    weightings = list(weightings)
+    keys = [(ion, weighting) for ion in ions for weighting in weightings]
+    cache = reduction_cache(cache)
+
+    snap_files = [snapshot_file(snap) for snap in snapshot_list]
+    redshift = np.full(len(snap_files), np.nan)
+    weighted_means = dict((key, np.full(len(snap_files), np.nan))
+                          for key in keys)
+
+    #  Snapshots are grouped by the ions and weightings they still need,
+    #  so a partial cache hit only reduces what is missing
+    todo = collections.OrderedDict()
+    for i, snap_file in enumerate(snap_files):
+        rows = [None] * len(keys)
+        if cache is not None:
+            with stage("cache", snapshot=snap_file):
+                rows = [cache.get(snap_file, key[0], key[1]) for key in keys]
+        for key, row in zip(keys, rows):
+            if row is not None:
+                redshift[i] = row[0]
+                weighted_means[key][i] = row[1]
+
+        missing = [key for key, row in zip(keys, rows) if row is None]
+        if missing:
+            group = (tuple(ion for ion in ions
+                           if any(key[0] == ion for key in missing)),
+                     tuple(weighting for weighting in weightings
+                           if any(key[1] == weighting for key in missing)))
+            todo.setdefault(group, []).append(i)
+
+    for (group_ions, group_weightings), indices in todo.items():
+        reductions = _reduce_snapshots([snap_files[i] for i in indices],
+                                       list(group_ions),
+                                       list(group_weightings),
+                                       chunk_size=chunk_size,
+                                       prefetch=prefetch,
+                                       prefetch_bytes=prefetch_bytes,
+                                       nproc=nproc)
+
+        for j, result, error in tqdm(reductions, total=len(indices),
+                                     desc=", ".join(group_ions),
+                                     disable=not verbose):
+            i = indices[j]
+            if error is not None:
+                warnings.warn("Could not reduce {0}: {1}".format(
+                    snap_files[i], error))
+                continue
+
+            snap_redshift, means = result
+            redshift[i] = snap_redshift
+            for key, value in means.items():
+                weighted_means[key][i] = value
+            if cache is not None:
+                with stage("cache", snapshot=snap_files[i]):
+                    for key, value in means.items():
+                        cache.put(snap_files[i], key[0], key[1],
+                                  snap_redshift, value)
+
+    return redshift, weighted_means
+
+
+def ion_mean(snapshot_list, ion="HI", weighting=None, verbose=False,
+             cache=None, **kwargs):
     """
     Calculated the weighted mean fraction as a function of redshift.
 
     Parameters
     ----------
-    snaplist : list of strings
+    snapshot_list : list of strings
 
-        A list containing the paths for each snapshot.
+        A list containing the paths for each snapshot directory. The
+        snapshot files are read directly with h5py and can be split over
+        several files (snap_XXX.N.hdf5).
 
     ion : string, optional
 
@@ -76,6 +445,15 @@ def ion_mean(snapshot_list, ion="HI", weighting=None, verbose=False, **kwargs):
         If True, print progress information.
         (Default: False)
 
+    cache : boolean, string or cache.ReductionCache, optional
+
+        Cache the reduction of each snapshot on disk. See ion_means.
+        Default: None
+
+    **kwargs
+
+        Passed on to ion_means, e.g. nproc, prefetch and chunk_size.
+
     Returns:
     --------
     redshift : numpy.darray
@@ -86,32 +464,640 @@ def ion_mean(snapshot_list, ion="HI", weighting=None, verbose=False, **kwargs):
 
         The mean ion fraction at each of the redshifts
     """
+    redshift, weighted_means = ion_means(snapshot_list, [ion], [weighting],
+                                         verbose=verbose, cache=cache,
+                                         **kwargs)
+
+    return redshift, weighted_means[(ion, weighting)]
+
+
+def snapshot_dirs(output_dir):
+    """
+    The snapshot directories (snapshot_XXX) in a simulation output
+    directory, in order of snapshot number.
+    """
+    dirs = [path for path in glob.glob(os.path.join(output_dir, "snapshot_*"))
+            if re.match(r"^snapshot_\d+$", os.path.basename(path)) and
+            os.path.isdir(path)]
+    return sorted(dirs, key=lambda path: int(path.rsplit("_", 1)[-1]))
+
+
+def _snapshot_complete(snap_file):
+    """
+    Whether every file of a snapshot has been written.
+    """
+    try:
+        files = gadget.snapshot_files(snap_file)
+        nfiles = gadget.read_header(files[0]).get("NumFilesPerSnapshot", 1)
+    except (IOError, OSError, KeyError):
+        return False
+    return len(files) == nfiles
 
-    weighted_mean = []
-    redshift = []
 
-    for snap in tqdm(snaplist, desc=ion, disable=not verbose):
-        snap_suffix = snap.split("_")[-1]
-        snap_file = "{0}/snap_{1}".format(snap, snap_suffix)
-        s = pn.load(snap_file)
-        apion = "ap{0}".format(ion)
-        weighted_mean.append(weight(s, s.g[apion], weight_type=weighting))
-        redshift.append(s.properties["Redshift"])
+def _weighting_name(weighting):
+    return "none" if weighting is None else weighting
 
-    return np.array(redshift), np.array(weighted_mean)
 
+def read_ion_history(history_file):
+    """
+    Read an ion history file written by update_ion_history.
 
-def calc_DM(ray):
-    data = h5py.File(ray, "r")
-    dl = np.array(data["grid"]["dl"]) * c.CM_TO_PC
+    Returns
+    -------
+    snapshots : list of strings
+
+        The names of the reduced snapshot directories.
+
+    redshift : numpy.ndarray
+
+        The redshift of each snapshot.
+
+    weighted_means : dict
+
+        The mean ion fraction of each snapshot keyed by (ion, weighting).
+        Snapshots that have not been reduced with a key are NaN.
+    """
+    with h5py.File(history_file, "r") as f:
+        snapshots = [name.decode() if isinstance(name, bytes) else name
+                     for name in f["snapshot"][()]]
+        redshift = f["redshift"][()]
+        weighted_means = {}
+        for ion, group in f["means"].items():
+            for name, dset in group.items():
+                weighting = None if name == "none" else name
+                weighted_means[(ion, weighting)] = dset[()]
+    return snapshots, redshift, weighted_means
+
+
+def _read_identities(history_file):
+    """
+    The file identity (see cache.file_identity) each snapshot in an ion
+    history file was reduced from, or None for histories written without
+    them.
+    """
+    with h5py.File(history_file, "r") as f:
+        if "identity" not in f:
+            return None
+        return [name.decode() if isinstance(name, bytes) else name
+                for name in f["identity"][()]]
+
+
+def _write_ion_history(history_file, rows, keys):
+    """
+    Write the reduced snapshots to an ion history file, replacing it only
+    once it is complete.
+    """
+    snapshots = sorted(rows, key=lambda name: int(name.rsplit("_", 1)[-1]))
+    tmp_file = history_file + ".tmp"
+    with h5py.File(tmp_file, "w") as f:
+        f.create_dataset("snapshot", data=np.array(snapshots, dtype=object),
+                         dtype=h5py.string_dtype())
+        f.create_dataset("identity",
+                         data=np.array([rows[name]["identity"]
+                                        for name in snapshots], dtype=object),
+                         dtype=h5py.string_dtype())
+        f.create_dataset("redshift", data=[rows[name]["redshift"]
+                                           for name in snapshots])
+        for ion, weighting in keys:
+            f.create_dataset("means/{0}/{1}".format(
+                ion, _weighting_name(weighting)),
+                data=[rows[name].get((ion, weighting), np.nan)
+                      for name in snapshots])
+    os.replace(tmp_file, history_file)
+
+
+def update_ion_history(output_dir, history_file, ions=("HI",),
+                       weightings=("volume",), verbose=False,
+                       chunk_size=CHUNK_SIZE, prefetch=0,
+                       prefetch_bytes=PREFETCH_BYTES, nproc=1):
+    """
+    Bring the ion history of a simulation up to date, reducing only the
+    snapshots that are not in the history file yet.
+
+    The reduced (redshift, mean) series is kept in history_file. Each call
+    looks for new snapshot directories in output_dir, reduces those whose
+    files have all been written, and adds them to the file, so following a
+    running simulation costs one snapshot's work per new output. Each
+    snapshot is stored with the size and modification time of its files,
+    and a snapshot that has been rewritten since is reduced again.
+    Snapshots that fail to reduce are reported with a warning and tried
+    again on the next call. Asking for a new ion or weighting reduces the
+    existing snapshots once with it.
+
+    Parameters
+    ----------
+    output_dir : string
+
+        The simulation output directory containing the snapshot_XXX
+        directories.
+
+    history_file : string
+
+        The HDF5 file the history is kept in, e.g. next to the analysis
+        rather than in the simulation output. It is created if it does not
+        exist.
+
+    ions : list of strings, optional
+
+        The ions to calculate the weighted mean abundance of.
+        Default: ['HI']
+
+    weightings : list of {'mass', 'volume', None}, optional
+
+        The weighting schemes of the particles. Default: ['volume']
 
+    verbose : boolean, optional
+
+        If True, show a progress bar. Default: False
+
+    chunk_size, prefetch, prefetch_bytes, nproc : optional
+
+        See ion_means.
+
+    Returns
+    -------
+    redshift : numpy.ndarray
+
+        The redshift of each snapshot, in decreasing order.
+
+    weighted_means : dict
+
+        The mean ion fraction at each of the redshifts keyed by
+        (ion, weighting).
+    """
+    keys = [(ion, weighting) for ion in ions for weighting in weightings]
+
+    rows = {}
+    stored_keys = []
+    if os.path.isfile(history_file):
+        snapshots, redshift, stored = read_ion_history(history_file)
+        identities = _read_identities(history_file)
+        stored_keys = list(stored)
+        for i, name in enumerate(snapshots):
+            rows[name] = dict((key, values[i])
+                              for key, values in stored.items()
+                              if not np.isnan(values[i]))
+            rows[name]["redshift"] = redshift[i]
+            rows[name]["identity"] = (None if identities is None
+                                      else identities[i])
+
+    all_keys = stored_keys + [key for key in keys if key not in stored_keys]
+    all_ions = sorted(set(key[0] for key in all_keys))
+    all_weightings = sorted(set(key[1] for key in all_keys), key=str)
+
+    dirs = snapshot_dirs(output_dir)
+    identities = {}
+    for path in dirs:
+        name = os.path.basename(path)
+        if not _snapshot_complete(snapshot_file(path)):
+            continue
+        identities[name] = repr(file_identity(snapshot_file(path)))
+
+        #  Forget snapshots that have been rewritten since they were reduced
+        if name in rows and rows[name]["identity"] != identities[name]:
+            del rows[name]
+
+    new = [path for path in dirs if os.path.basename(path) in identities and
+           os.path.basename(path) not in rows]
+    missing = [path for path in dirs if os.path.basename(path) in rows and
+               os.path.basename(path) in identities and
+               any(key not in rows[os.path.basename(path)] for key in keys)]
+
+    #  New snapshots are reduced with every key in the file, the others
+    #  only with the requested ions and weightings
+    groups = [(new, all_ions, all_weightings), (missing, ions, weightings)]
+    updated = False
+    for group_dirs, group_ions, group_weightings in groups:
+        if not group_dirs:
+            continue
+
+        snap_files = [snapshot_file(path) for path in group_dirs]
+        reductions = _reduce_snapshots(snap_files, list(group_ions),
+                                       list(group_weightings),
+                                       chunk_size=chunk_size,
+                                       prefetch=prefetch,
+                                       prefetch_bytes=prefetch_bytes,
+                                       nproc=nproc)
+        for j, result, error in tqdm(reductions, total=len(snap_files),
+                                     desc=", ".join(group_ions),
+                                     disable=not verbose):
+            if error is not None:
+                warnings.warn("Could not reduce {0}: {1}".format(
+                    snap_files[j], error))
+                continue
+
+            snap_redshift, means = result
+            name = os.path.basename(group_dirs[j])
+            row = rows.setdefault(name, {})
+            row["redshift"] = snap_redshift
+            row["identity"] = identities[name]
+            row.update(means)
+            updated = True
+
+    if updated:
+        _write_ion_history(history_file, rows, all_keys)
+
+    names = [name for name in rows if all(key in rows[name] for key in keys)]
+    names.sort(key=lambda name: -rows[name]["redshift"])
+
+    redshift = np.array([rows[name]["redshift"] for name in names])
+    weighted_means = dict((key, np.array([rows[name][key] for name in names]))
+                          for key in keys)
+
+    return redshift, weighted_means
+
+
+#  The ray datasets needed to calculate the electron number density
+DM_FIELDS = ["dl", "H_p1_number_density", "He_p1_number_density",
+             "He_p2_number_density"]
+
+
+def _grid_DM(grid):
+    """
+    Calculate the dispersion measure from the 'grid' group of a ray.
+    """
     #  1 electron from H II and He II and 2 electrons from He III
-    ne = (np.array(data["grid"]["H_p1_number_density"]) +
-          np.array(data["grid"]["He_p1_number_density"]) +
-          2 * np.array(data["grid"]["He_p2_number_density"]))
+    ne = grid["H_p1_number_density"][()]
+    ne += grid["He_p1_number_density"][()]
+    he_p2 = grid["He_p2_number_density"][()]
+    he_p2 *= 2
+    ne += he_p2
+
+    return np.dot(ne, grid["dl"][()]) * c.CM_TO_PC
+
+
+def calc_DM(ray):
+    """
+    Calculate the dispersion measure along a ray.
+
+    Parameters
+    ----------
+    ray : string
+
+        The filename of the ray HDF5 file.
+
+    Returns
+    -------
+    DM : float
 
-    DM = np.sum(ne * dl)
+        The dispersion measure of the ray in pc cm**-3.
+    """
+    with stage("calc_DM", ray=ray):
+        with h5py.File(ray, "r") as data:
+            DM = _grid_DM(data["grid"])
 
     return DM
 
 
+def _ray_DM_row(ray):
+    with stage("calc_DM", ray=ray):
+        with h5py.File(ray, "r") as data:
+            axis, start = ray_info(ray, data)
+            DM = _grid_DM(data["grid"])
+    return ray, axis, start, DM
+
+
+def save_table(table, output):
+    """
+    Save a table of ray results to a .npz or HDF5 file.
+
+    The type of file is determined by the extension of output.
+    """
+    if output.endswith(".npz"):
+        np.savez(output, **dict((name, table[name])
+                                for name in table.dtype.names))
+        return
+
+    with h5py.File(output, "w") as f:
+        for name in table.dtype.names:
+            column = table[name]
+            if column.dtype.kind == "U":
+                f.create_dataset(name, data=column.astype(object),
+                                 dtype=h5py.string_dtype())
+            else:
+                f.create_dataset(name, data=column)
+
+
+def calc_DM_batch(rays, output=None, nproc=None, chunksize=16,
+                  verbose=False):
+    """
+    Calculate the dispersion measure of many rays in parallel.
+
+    Parameters
+    ----------
+    rays : string or list of strings
+
+        A directory containing the ray files, a glob pattern matching the
+        ray files, or a list of ray filenames.
+
+    output : string, optional
+
+        If given, save the table to this file. Files ending in .npz are
+        saved with numpy, everything else as HDF5. Default: None
+
+    nproc : integer, optional
+
+        The number of worker processes. If None, use all available cores.
+        Default: None
+
+    chunksize : integer, optional
+
+        The number of rays given to a worker at a time. Default: 16
+
+    verbose : boolean, optional
+
+        If True, print progress information. Default: False
+
+    Returns
+    -------
+    table : numpy.ndarray
+
+        A structured array with the columns 'ray' (filename), 'axis',
+        'start' (x, y, z starting position) and 'DM' (pc cm**-3), in the
+        same order as the ray files.
+    """
+    files = ray_files(rays)
+    if nproc is None:
+        nproc = multiprocessing.cpu_count()
+
+    dtype = [("ray", "U{0}".format(max([len(f) for f in files] + [1]))),
+             ("axis", "U1"), ("start", np.float64, (3,)),
+             ("DM", np.float64)]
+    table = np.zeros(len(files), dtype=dtype)
+
+    if nproc == 1:
+        rows = map(_ray_DM_row, files)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(nproc)
+        rows = profiling.imap(pool, _ray_DM_row, files, ordered=True,
+                              chunksize=chunksize)
+
+    try:
+        for i, row in enumerate(tqdm(rows, total=len(files), desc="DM",
+                                     disable=not verbose)):
+            table[i] = row
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    if output is not None:
+        save_table(table, output)
+
+    return table
+
+
+def DM_statistics(rays, bins=None, stats=None, nproc=None, chunksize=16,
+                  buffer_size=1024, verbose=False):
+    """
+    Accumulate the DM distribution of many rays in constant memory.
+
+    The DM of each ray is calculated in a process pool and added to a
+    StreamingStats as the results arrive.
+
+    Parameters
+    ----------
+    rays : string or list of strings
+
+        A directory containing the ray files, a glob pattern matching the
+        ray files, or a list of ray filenames.
+
+    bins : array_like, optional
+
+        The edges of the DM histogram bins in pc cm**-3. Ignored if stats
+        is given. Default: None
+
+    stats : stats.StreamingStats, optional
+
+        Existing statistics to add the rays to, e.g. from another batch.
+        Default: None
+
+    nproc : integer, optional
+
+        The number of worker processes. If None, use all available cores.
+        Default: None
+
+    chunksize : integer, optional
+
+        The number of rays given to a worker at a time. Default: 16
+
+    buffer_size : integer, optional
+
+        The number of DM values collected before updating the statistics.
+        Default: 1024
+
+    verbose : boolean, optional
+
+        If True, print progress information. Default: False
+
+    Returns
+    -------
+    stats : stats.StreamingStats
+
+        The statistics of the DM of the rays.
+    """
+    files = ray_files(rays)
+    if stats is None:
+        stats = StreamingStats(bins=bins)
+    if nproc is None:
+        nproc = multiprocessing.cpu_count()
+
+    if nproc == 1:
+        values = map(calc_DM, files)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(nproc)
+        values = profiling.imap(pool, calc_DM, files, chunksize=chunksize)
+
+    buffer = []
+    try:
+        for DM in tqdm(values, total=len(files), desc="DM",
+                       disable=not verbose):
+            buffer.append(DM)
+            if len(buffer) == buffer_size:
+                stats.update(buffer)
+                buffer = []
+        stats.update(buffer)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    return stats
+
+
+def _path_midpoints(offsets, dl):
+    """
+    The midpoint of each path element along its ray, for rays without a
+    position field 'l'.
+    """
+    cs = np.cumsum(dl)
+    lengths = np.diff(offsets)
+    starts = offsets[:-1][lengths > 0]
+    before = np.repeat(cs[starts] - dl[starts], lengths[lengths > 0])
+    return cs - before - 0.5 * dl
+
+
+def _read_ray_batch(files, fields):
+    """
+    Read the grid fields of several ray files into concatenated arrays.
+
+    Returns the offsets of each ray (with one extra element at the end)
+    and the dictionary of concatenated arrays.
+    """
+    parts = dict((name, []) for name in fields)
+    lengths = []
+
+    for ray in files:
+        with h5py.File(ray, "r") as data:
+            grid = data["grid"]
+            lengths.append(grid["dl"].shape[0])
+            for name in fields:
+                parts[name].append(grid[name][()])
+
+    offsets = np.append(0, np.cumsum(lengths)).astype(np.int64)
+    data = dict((name, np.concatenate(arr) if arr else np.array([]))
+                for name, arr in parts.items())
+    return offsets, data
+
+
+def _is_archive(rays):
+    if not isinstance(rays, str) or not os.path.isfile(rays):
+        return False
+    with h5py.File(rays, "r") as f:
+        return "index" in f
+
+
+def _batch_profiles(offsets, data, edges, species):
+    """
+    Calculate the cumulative DM and column density profiles of a batch of
+    rays stored as concatenated arrays.
+    """
+    nrays = len(offsets) - 1
+    nbins = len(edges) - 1
+    ray_id = np.repeat(np.arange(nrays), np.diff(offsets))
+
+    #  Assign each path element to the first bin whose upper edge it is
+    #  within, dropping elements past the last edge
+    bin_id = np.searchsorted(edges[1:], data["l"] * c.CM_TO_PC, side="left")
+    keep = bin_id < nbins
+    flat = (ray_id * nbins + bin_id)[keep]
+    dl = data["dl"][keep]
+
+    def cumulative(values):
+        binned = np.bincount(flat, weights=values[keep] * dl,
+                             minlength=nrays * nbins)
+        profile = np.cumsum(binned.reshape(nrays, nbins), axis=1)
+        return profile.astype(np.float32)
+
+    #  1 electron from H II and He II and 2 electrons from He III
+    ne = (data["H_p1_number_density"] + data["He_p1_number_density"] +
+          2 * data["He_p2_number_density"])
+
+    profiles = {"DM": cumulative(ne * c.CM_TO_PC)}
+    for name in species:
+        profiles[name] = cumulative(data["{0}_number_density".format(name)])
+    return profiles
+
+
+def ray_profiles(rays, bins=100, species=("H_p0", "He_p1"), batch_size=1024,
+                 verbose=False):
+    """
+    Calculate the cumulative DM and column density profiles along many rays.
+
+    Each ray is read once, and all the profiles of a batch of rays are
+    calculated together.
+
+    Parameters
+    ----------
+    rays : string or list of strings
+
+        A ray archive (see archive.pack_rays), a directory containing the
+        ray files, a glob pattern matching the ray files, or a list of ray
+        filenames.
+
+    bins : integer or array_like, optional
+
+        The edges of the bins along the rays in pc, or the number of equal
+        bins between 0 and the end of the longest ray in the first batch.
+        Rays through the box all have the same length, so this covers
+        every ray of a campaign. Default: 100
+
+    species : list of strings, optional
+
+        The species to calculate the column densities of, named as in the
+        ray fields. Default: ['H_p0', 'He_p1'] (H I and He II)
+
+    batch_size : integer, optional
+
+        The number of rays processed together. Default: 1024
+
+    verbose : boolean, optional
+
+        If True, print progress information. Default: False
+
+    Returns
+    -------
+    profiles : dict
+
+        'edges' is the bin edges in pc. 'DM' (pc cm**-3) and each species
+        (cm**-2) are float32 arrays of shape (nrays, nbins) containing the
+        cumulative value at the upper edge of each bin. 'names' is the name
+        of each ray.
+    """
+    species = list(species)
+    fields = (["dl", "H_p1_number_density", "He_p1_number_density",
+               "He_p2_number_density"] +
+              ["{0}_number_density".format(name) for name in species])
+    fields = sorted(set(fields), key=fields.index)
+
+    if _is_archive(rays):
+        names = archive.read_index(rays)["name"]
+        with h5py.File(rays, "r") as f:
+            has_l = "l" in f["grid"]
+
+        def read(first, last):
+            return archive.read_rays(rays, first, last,
+                                     fields + ["l"] if has_l else fields)
+    else:
+        files = ray_files(rays)
+        names = np.array([os.path.basename(f) for f in files])
+        if files:
+            with h5py.File(files[0], "r") as f:
+                has_l = "l" in f["grid"]
+
+        def read(first, last):
+            return _read_ray_batch(files[first:last],
+                                   fields + ["l"] if has_l else fields)
+
+    nrays = len(names)
+    edges = None
+    if np.ndim(bins) != 0:
+        edges = np.asarray(bins, dtype=np.float64)
+
+    parts = dict((name, []) for name in ["DM"] + species)
+    for first in tqdm(range(0, nrays, batch_size), desc="Ray Profiles",
+                      disable=not verbose):
+        offsets, data = read(first, first + batch_size)
+        if "l" not in data:
+            data["l"] = _path_midpoints(offsets, data["dl"])
+
+        if edges is None:
+            longest = np.max(data["l"] + 0.5 * data["dl"], initial=0.0)
+            edges = np.linspace(0.0, longest * c.CM_TO_PC, int(bins) + 1)
+
+        for name, profile in _batch_profiles(offsets, data, edges,
+                                             species).items():
+            parts[name].append(profile)
+
+    if edges is None:
+        edges = np.zeros(int(bins) + 1)
+
+    profiles = {"edges": edges, "names": names}
+    for name, arr in parts.items():
+        if arr:
+            profiles[name] = np.concatenate(arr)
+        else:
+            profiles[name] = np.zeros((0, len(edges) - 1), dtype=np.float32)
+    return profiles
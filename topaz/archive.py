@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+"""
+A single-file archive for many rays.
+
+The per-ray arrays of every field are concatenated into one chunked and
+compressed HDF5 dataset (grid/<field>), with an index giving the offset and
+length of each ray along with its axis, start and end points and seed.
+A slice of consecutive rays can therefore be read with one contiguous read
+per field.
+"""
+from __future__ import print_function, division
+
+import os
+import json
+
+import numpy as np
+import h5py
+from tqdm import tqdm
+
+from .profiling import stage
+from .rayfiles import ray_files, ray_info
+
+#  The number of rays read from per-ray files before writing to the archive
+BATCH_SIZE = 1024
+
+
+def _index_columns(f, dtypes, compression):
+    """
+    Create the resizable index datasets of a new archive, with a grid
+    dataset of each dtype in dtypes keyed by field name.
+    """
+    index = f.create_group("index")
+    index.create_dataset("offset", (0,), maxshape=(None,), dtype=np.int64)
+    index.create_dataset("length", (0,), maxshape=(None,), dtype=np.int64)
+    index.create_dataset("axis", (0,), maxshape=(None,), dtype="S1")
+    index.create_dataset("ray_start", (0, 3), maxshape=(None, 3),
+                         dtype=np.float64)
+    index.create_dataset("ray_end", (0, 3), maxshape=(None, 3),
+                         dtype=np.float64)
+    index.create_dataset("seed", (0,), maxshape=(None,), dtype=np.int64)
+    index.create_dataset("name", (0,), maxshape=(None,),
+                         dtype=h5py.string_dtype())
+
+    grid = f.create_group("grid")
+    for name, dtype in sorted(dtypes.items()):
+        grid.create_dataset(name, (0,), maxshape=(None,), dtype=dtype,
+                            chunks=(2**16,), compression=compression,
+                            shuffle=compression is not None)
+
+
+def _append(dset, data):
+    """
+    Append data to a resizable dataset along its first axis.
+    """
+    n = dset.shape[0]
+    dset.resize(n + len(data), axis=0)
+    dset[n:] = data
+
+
+def write_rays(archive_file, rays, append=True, compression="gzip"):
+    """
+    Write a batch of rays to an archive.
+
+    Parameters
+    ----------
+    archive_file : string
+
+        The filename of the archive. It is created if it does not exist.
+
+    rays : list of dict
+
+        The rays to write. Each ray is a dictionary with a 'grid'
+        dictionary of 1D arrays, and optionally 'name', 'axis',
+        'ray_start', 'ray_end' and 'seed'. Every ray must have the same
+        fields. A new archive stores each field with the dtype it has in
+        the first ray.
+
+    append : boolean, optional
+
+        If False, an existing archive is overwritten. Default: True
+
+    compression : string, optional
+
+        The compression of the ray data. Default: 'gzip'
+    """
+    if not rays:
+        return
+
+    mode = "a" if append else "w"
+    with stage("write", archive=archive_file, rays=len(rays)), \
+            h5py.File(archive_file, mode) as f:
+        if "index" not in f:
+            _index_columns(f, dict((name, np.asarray(arr).dtype)
+                                   for name, arr in rays[0]["grid"].items()),
+                           compression)
+
+        index = f["index"]
+        lengths = np.array([len(ray["grid"]["dl"]) for ray in rays])
+        n = index["offset"].shape[0]
+        if n == 0:
+            first = 0
+        else:
+            first = index["offset"][n - 1] + index["length"][n - 1]
+
+        _append(index["offset"], first + np.cumsum(lengths) - lengths)
+        _append(index["length"], lengths)
+        _append(index["axis"], np.array([ray.get("axis", "")
+                                         for ray in rays], dtype="S1"))
+        _append(index["ray_start"], np.array([ray.get("ray_start",
+                                                      np.full(3, np.nan))
+                                              for ray in rays]))
+        _append(index["ray_end"], np.array([ray.get("ray_end",
+                                                    np.full(3, np.nan))
+                                            for ray in rays]))
+        _append(index["seed"], np.array([ray.get("seed", -1)
+                                         for ray in rays], dtype=np.int64))
+        _append(index["name"], np.array([ray.get("name", "")
+                                         for ray in rays], dtype=object))
+
+        for name, dset in f["grid"].items():
+            _append(dset, np.concatenate([ray["grid"][name]
+                                          for ray in rays]))
+
+
+def read_ray_file(ray_file, fields=None):
+    """
+    Read a trident layout ray file into the dictionary used by write_rays.
+
+    Parameters
+    ----------
+    ray_file : string
+
+        The filename of the ray.
+
+    fields : list of strings, optional
+
+        The fields of the 'grid' group to read. If None, every 1D field is
+        read. Default: None
+    """
+    with h5py.File(ray_file, "r") as data:
+        grid = data["grid"]
+        if fields is None:
+            fields = [name for name, dset in grid.items()
+                      if isinstance(dset, h5py.Dataset) and dset.ndim == 1]
+        axis, start = ray_info(ray_file, data)
+        ray = {
+            "name": os.path.basename(ray_file),
+            "axis": axis,
+            "ray_start": start,
+            "grid": dict((name, grid[name][()]) for name in fields),
+        }
+        if "ray_end" in data.attrs:
+            ray["ray_end"] = np.array(data.attrs["ray_end"])
+    return ray
+
+
+def pack_rays(rays, archive_file, fields=None, manifest=None,
+              compression="gzip", append=False, overwrite=False,
+              batch_size=BATCH_SIZE, verbose=False):
+    """
+    Pack many per-ray HDF5 files into one archive.
+
+    Parameters
+    ----------
+    rays : string or list of strings
+
+        A directory containing the ray files, a glob pattern matching the
+        ray files, or a list of ray filenames.
+
+    archive_file : string
+
+        The filename of the archive.
+
+    fields : list of strings, optional
+
+        The fields of the 'grid' group to store. If None, the 1D fields of
+        the first ray are stored. 'dl' is always stored. Default: None
+
+    manifest : string, optional
+
+        The manifest written by rays.ray_campaign. If given, the start and
+        end points and seed of each ray are taken from it. Default: None
+
+    compression : string, optional
+
+        The compression of the ray data. Default: 'gzip'
+
+    append : boolean, optional
+
+        If True, add the rays to an existing archive. Default: False
+
+    overwrite : boolean, optional
+
+        If True, replace an existing archive. If neither append nor
+        overwrite is True and archive_file exists, an IOError is raised.
+        Default: False
+
+    batch_size : integer, optional
+
+        The number of rays written to the archive at a time.
+        Default: 1024
+
+    verbose : boolean, optional
+
+        If True, print progress information. Default: False
+    """
+    if os.path.isfile(archive_file) and not (append or overwrite):
+        raise IOError("The archive {0} already exists, use append=True or "
+                      "overwrite=True".format(archive_file))
+
+    files = ray_files(rays)
+
+    if fields is None and files:
+        fields = sorted(read_ray_file(files[0])["grid"])
+    elif fields is not None and "dl" not in fields:
+        fields = ["dl"] + list(fields)
+
+    campaign = {}
+    if manifest is not None:
+        with open(manifest, "r") as f:
+            manifest = json.load(f)
+        for ray in manifest["rays"]:
+            campaign[os.path.basename(ray["filename"])] = (
+                ray["ray_start"], ray["ray_end"], manifest["seed"])
+
+    if not append and os.path.isfile(archive_file):
+        os.remove(archive_file)
+
+    for first in tqdm(range(0, len(files), batch_size), desc="Packing Rays",
+                      disable=not verbose):
+        batch = []
+        for ray_file in files[first:first + batch_size]:
+            ray = read_ray_file(ray_file, fields)
+            if ray["name"] in campaign:
+                ray["ray_start"], ray["ray_end"], ray["seed"] = \
+                    campaign[ray["name"]]
+            batch.append(ray)
+        write_rays(archive_file, batch, compression=compression)
+
+
+def read_index(archive_file):
+    """
+    Read the index of an archive.
+
+    Returns
+    -------
+    index : dict
+
+        The 'offset', 'length', 'axis', 'ray_start', 'ray_end', 'seed'
+        and 'name' of every ray.
+    """
+    with h5py.File(archive_file, "r") as f:
+        index = dict((name, dset[()]) for name, dset in f["index"].items())
+    index["axis"] = index["axis"].astype("U1")
+    index["name"] = np.array([name.decode() if isinstance(name, bytes)
+                              else name for name in index["name"]])
+    return index
+
+
+def read_rays(archive_file, start=0, stop=None, fields=None):
+    """
+    Read a slice of consecutive rays from an archive.
+
+    Each field is read with one contiguous read.
+
+    Parameters
+    ----------
+    archive_file : string
+
+        The filename of the archive.
+
+    start, stop : integer, optional
+
+        The slice of rays to read. Default: all rays
+
+    fields : list of strings, optional
+
+        The fields to read. If None, every field is read. Default: None
+
+    Returns
+    -------
+    offsets : numpy.ndarray
+
+        The offsets of the rays in the returned arrays, with one extra
+        element at the end, so ray i is data[offsets[i]:offsets[i + 1]].
+
+    data : dict
+
+        The concatenated array of each field.
+    """
+    with h5py.File(archive_file, "r") as f:
+        nrays = f["index"]["offset"].shape[0]
+        if stop is None or stop > nrays:
+            stop = nrays
+
+        offset = f["index"]["offset"][start:stop]
+        length = f["index"]["length"][start:stop]
+        if len(offset) == 0:
+            first, last = 0, 0
+        else:
+            first, last = offset[0], offset[-1] + length[-1]
+
+        if fields is None:
+            fields = list(f["grid"].keys())
+        data = dict((name, f["grid"][name][first:last]) for name in fields)
+
+    offsets = np.append(offset - first, last - first)
+    return offsets, data
+
+
+def iter_rays(archive_file, fields=None, batch_size=BATCH_SIZE):
+    """
+    Iterate over the rays of an archive, reading batch_size rays at a time.
+
+    Yields
+    ------
+    name : string
+
+        The name of the ray.
+
+    grid : dict
+
+        The array of each field of the ray.
+    """
+    index = read_index(archive_file)
+    nrays = len(index["offset"])
+
+    for first in range(0, nrays, batch_size):
+        offsets, data = read_rays(archive_file, first, first + batch_size,
+                                  fields)
+        for i in range(len(offsets) - 1):
+            grid = dict((name, arr[offsets[i]:offsets[i + 1]])
+                        for name, arr in data.items())
+            yield index["name"][first + i], grid
+
+
+def unpack_rays(archive_file, output_data_dir, fields=None, verbose=False):
+    """
+    Export the rays of an archive to per-ray files in the trident layout.
+
+    Returns the filenames of the written rays.
+    """
+    index = read_index(archive_file)
+    filenames = []
+
+    rays = iter_rays(archive_file, fields)
+    for i, (name, grid) in enumerate(tqdm(rays, total=len(index["name"]),
+                                          desc="Unpacking Rays",
+                                          disable=not verbose)):
+        filename = os.path.join(output_data_dir, name or
+                                "ray_{0}.h5".format(i))
+        with h5py.File(filename, "w") as f:
+            group = f.create_group("grid")
+            for field, arr in grid.items():
+                group.create_dataset(field, data=arr)
+            if index["axis"][i]:
+                f.attrs["axis"] = str(index["axis"][i])
+                f.attrs["ray_start"] = index["ray_start"][i]
+                f.attrs["ray_end"] = index["ray_end"][i]
+        filenames.append(filename)
+
+    return filenames
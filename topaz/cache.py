@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+"""
+On-disk caches for expensive per-snapshot results.
+"""
+from __future__ import print_function, division
+
+import os
+import time
+import hashlib
+import sqlite3
+
+import numpy as np
+
+from . import gadget
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "topaz")
+
+
+def file_identity(snap_file):
+    """
+    Identify the files of a snapshot by their path, size and modification
+    time.
+
+    Parameters
+    ----------
+    snap_file : string
+
+        The path to the snapshot. See gadget.snapshot_files.
+
+    Returns
+    -------
+    identity : tuple
+
+        A tuple of (path, size, mtime) for each file in the snapshot.
+    """
+    identity = []
+    for filename in gadget.snapshot_files(snap_file):
+        stat = os.stat(filename)
+        identity.append((os.path.abspath(filename), stat.st_size,
+                         stat.st_mtime_ns))
+    return tuple(identity)
+
+
+
+class ReductionCache(object):
+    """
+    A SQLite store of scalar per-snapshot reductions.
+
+    Entries are keyed by the identity of the snapshot files (path, size and
+    modification time), the reduced quantity and the weighting, so a
+    snapshot that is rewritten is reduced again. When the store grows
+    larger than max_bytes the least recently used entries are evicted.
+
+    Parameters
+    ----------
+    path : string, optional
+
+        The filename of the store. Default: ~/.cache/topaz/reductions.sqlite
+
+    max_bytes : integer, optional
+
+        The maximum size of the store in bytes. Default: 64 MB
+    """
+
+    def __init__(self, path=None, max_bytes=64 * 1024**2):
+        if path is None:
+            path = os.path.join(DEFAULT_CACHE_DIR, "reductions.sqlite")
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.path = path
+        self.max_bytes = max_bytes
+        self._db = sqlite3.connect(path)
+        self._db.execute("""CREATE TABLE IF NOT EXISTS reductions (
+                            key TEXT PRIMARY KEY,
+                            path TEXT,
+                            quantity TEXT,
+                            weighting TEXT,
+                            redshift REAL,
+                            value REAL,
+                            atime REAL)""")
+        self._db.commit()
+
+    def _key(self, snap_file, quantity, weighting):
+        #  The files are stat'ed on every lookup so a snapshot rewritten
+        #  while the cache is open is not matched to its old results
+        identity = repr((file_identity(snap_file), quantity,
+                         str(weighting)))
+        return hashlib.sha1(identity.encode()).hexdigest()
+
+    def get(self, snap_file, quantity, weighting):
+        """
+        Return the cached (redshift, value) of a reduction, or None.
+        """
+        key = self._key(snap_file, quantity, weighting)
+        row = self._db.execute(
+            "SELECT redshift, value FROM reductions WHERE key = ?",
+            (key,)).fetchone()
+        if row is None:
+            return None
+
+        self._db.execute("UPDATE reductions SET atime = ? WHERE key = ?",
+                         (time.time(), key))
+        self._db.commit()
+        return row
+
+    def put(self, snap_file, quantity, weighting, redshift, value):
+        """
+        Store the redshift and value of a reduction.
+
+        Older entries for the same snapshot path, quantity and weighting
+        are replaced.
+        """
+        key = self._key(snap_file, quantity, weighting)
+        path = os.path.abspath(snap_file)
+        self._db.execute("""DELETE FROM reductions WHERE path = ? AND
+                            quantity = ? AND weighting = ?""",
+                         (path, quantity, str(weighting)))
+        self._db.execute("INSERT INTO reductions VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         (key, path, quantity, str(weighting),
+                          float(redshift), float(value), time.time()))
+        self._db.commit()
+        self._evict()
+
+    def size(self):
+        """
+        The size of the store in bytes.
+        """
+        page_count = self._db.execute("PRAGMA page_count").fetchone()[0]
+        page_size = self._db.execute("PRAGMA page_size").fetchone()[0]
+        return page_count * page_size
+
+    def _evict(self):
+        if self.size() <= self.max_bytes:
+            return
+
+        #  Drop the least recently used quarter of the entries
+        count = self._db.execute(
+            "SELECT COUNT(*) FROM reductions").fetchone()[0]
+        self._db.execute("""DELETE FROM reductions WHERE key IN (
+                            SELECT key FROM reductions ORDER BY atime
+                            LIMIT ?)""", (max(1, count // 4),))
+        self._db.commit()
+        self._db.execute("VACUUM")
+
+    def clear(self):
+        """
+        Remove every entry from the store.
+        """
+        self._db.execute("DELETE FROM reductions")
+        self._db.commit()
+        self._db.execute("VACUUM")
+
+    def close(self):
+        self._db.close()
+
+
+def reduction_cache(cache):
+    """
+    Convert the cache argument of the analysis functions to a
+    ReductionCache.
+
+    cache can be None (no caching), True (the default store), the filename
+    of a store, or a ReductionCache.
+    """
+    if cache is None or cache is False:
+        return None
+    if cache is True:
+        return ReductionCache()
+    if isinstance(cache, str):
+        return ReductionCache(cache)
+    return cache
+
+
+class RenderCache(object):
+    """
+    A directory of rendered images.
+
+    Each image is stored in its own .npz file together with the width it
+    covers, keyed by the identity of the snapshot files, checked on every
+    lookup, and the render parameters (quantity, units, width, resolution,
+    slice or projection, ...). The parameters should describe anything
+    changed in memory after loading, such as the center and rotation of a
+    transformed snapshot. Reading an entry updates its modification time,
+    and when the directory grows larger than max_bytes the least recently
+    used images are removed.
+
+    Parameters
+    ----------
+    path : string, optional
+
+        The cache directory. Default: ~/.cache/topaz/renders
+
+    max_bytes : integer, optional
+
+        The maximum total size of the images in bytes. Default: 1 GB
+    """
+
+    def __init__(self, path=None, max_bytes=1024**3):
+        if path is None:
+            path = os.path.join(DEFAULT_CACHE_DIR, "renders")
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        self.path = path
+        self.max_bytes = max_bytes
+
+    def _filename(self, snap_file, params):
+        identity = repr((file_identity(snap_file),
+                         sorted((k, str(v)) for k, v in params.items())))
+        key = hashlib.sha1(identity.encode()).hexdigest()
+        return os.path.join(self.path, key + ".npz")
+
+    def get(self, snap_file, params):
+        """
+        Return the cached (image, width) for the render parameters, or
+        None.
+        """
+        filename = self._filename(snap_file, params)
+        try:
+            with np.load(filename) as data:
+                image, width = data["image"], float(data["width"])
+        except (IOError, OSError, KeyError, ValueError):
+            return None
+
+        os.utime(filename, None)
+        return image, width
+
+    def put(self, snap_file, params, image, width):
+        """
+        Store a rendered image and the width it covers.
+        """
+        filename = self._filename(snap_file, params)
+        partial = filename[:-len(".npz")] + ".part.npz"
+        np.savez(partial, image=np.asarray(image), width=float(width))
+        os.replace(partial, filename)
+        self._evict()
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith(".npz") or name.endswith(".part.npz"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        return sorted(entries)
+
+    def size(self):
+        """
+        The total size of the cached images in bytes.
+        """
+        return sum(size for _, size, _ in self._entries())
+
+    def _evict(self):
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        """
+        Remove every image from the cache.
+        """
+        for _, _, name in self._entries():
+            os.remove(os.path.join(self.path, name))
+
+
+def render_cache(cache):
+    """
+    Convert the cache argument of the plot functions to a RenderCache.
+
+    cache can be None (no caching), True (the default directory), a
+    directory name, or a RenderCache.
+    """
+    if cache is None or cache is False:
+        return None
+    if cache is True:
+        return RenderCache()
+    if isinstance(cache, str):
+        return RenderCache(cache)
+    return cache
@@ -14,3 +14,39 @@ XSOLS = 4.0898522E-4
 XSOLCa = 6.4355E-5
 XSOLFe = 1.1032152E-3
 
+# Solar mass fraction of each element
+SOLAR_ABUNDANCE = {
+    "H": XSOLH,
+    "He": XSOLHe,
+    "C": XSOLC,
+    "N": XSOLN,
+    "O": XSOLO,
+    "Ne": XSOLNe,
+    "Mg": XSOLMg,
+    "Si": XSOLSi,
+    "S": XSOLS,
+    "Ca": XSOLCa,
+    "Fe": XSOLFe,
+}
+
+
+# The name of each element in the ElementAbundance group of a snapshot
+ELEMENT_NAMES = {
+    "H": "Hydrogen",
+    "He": "Helium",
+    "C": "Carbon",
+    "N": "Nitrogen",
+    "O": "Oxygen",
+    "Ne": "Neon",
+    "Mg": "Magnesium",
+    "Si": "Silicon",
+    "S": "Sulphur",
+    "Ca": "Calcium",
+    "Fe": "Iron",
+}
+
+
+# Physical constants in cgs
+M_P = 1.6726219E-24          # Proton mass (g)
+M_HE = 4.002602 * 1.6605390E-24  # Helium atom mass (g)
+CM_TO_PC = 3.2407793E-19     # Centimetres to parsecs
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+"""
+The [X/H] abundance ratios of the gas, registered as pynbody derived
+quantities (CXH, OXH, ...) of Gadget HDF5 snapshots.
+
+The quantities are registered when this module (or topaz.plot) is first
+imported, e.g. with "import topaz.derived", after which s.g["OXH"] works.
+"""
+from __future__ import print_function, division
+
+import numpy as np
+
+import pynbody as pn
+from pynbody.snapshot.gadgethdf import SubFindHDFSnap
+from pynbody.snapshot.gadgethdf import GadgetHDFSnap
+
+from . import constants as c
+
+#  The elements with an [X/H] derived quantity
+METALS = ["C", "He", "Fe", "Mg", "N", "O", "Si"]
+
+
+def metallicity(sim, elements=METALS, dtype=np.float64, log=False,
+                store=False, chunk_size=2**20):
+    """
+    Calculate the [X/H] abundance ratio of several elements in one pass
+    over the gas particles.
+
+    The inverse of the hydrogen abundance is calculated once per chunk of
+    particles and shared by every element.
+
+    Parameters
+    ----------
+    sim : pynbody.snapshot
+
+        The snapshot.
+
+    elements : list of strings, optional
+
+        The elements to calculate [X/H] for. Default: METALS
+
+    dtype : numpy.dtype, optional
+
+        The type of the output arrays. numpy.float32 halves the memory.
+        Default: numpy.float64
+
+    log : boolean, optional
+
+        If True, return log10 of the ratios. Default: False
+
+    store : boolean, optional
+
+        If True, store the ratios in the snapshot as the <X>XH arrays so
+        later access to the derived quantities does not recalculate them.
+        Only possible with log=False. Default: False
+
+    chunk_size : integer, optional
+
+        The number of particles processed at a time. Default: 2**20
+
+    Returns
+    -------
+    ratios : dict
+
+        The [X/H] array of each element, relative to solar.
+    """
+    if store and log:
+        raise ValueError("Only linear ratios can be stored in the snapshot")
+
+    hydrogen = np.asarray(sim.g["H"])
+    abundances = dict((element, np.asarray(sim.g[element]))
+                      for element in elements)
+    scale = dict((element, c.XSOLH / c.SOLAR_ABUNDANCE[element])
+                 for element in elements)
+    ratios = dict((element, np.empty(len(hydrogen), dtype=dtype))
+                  for element in elements)
+
+    for start in range(0, len(hydrogen), chunk_size):
+        chunk = slice(start, start + chunk_size)
+        inv_h = np.divide(1, hydrogen[chunk], dtype=dtype)
+        for element in elements:
+            out = ratios[element][chunk]
+            np.multiply(abundances[element][chunk], inv_h, out=out,
+                        dtype=dtype)
+            out *= scale[element]
+            if log:
+                np.log10(out, out=out)
+
+    if store:
+        for element in elements:
+            sim.g["{0}XH".format(element)] = pn.array.SimArray(
+                ratios[element], units="1")
+
+    return ratios
+
+
+def _xh(sim, element):
+    """
+    The [X/H] SimArray of one element. Use metallicity(sim, store=True)
+    to calculate several elements in one pass.
+    """
+    ratio = pn.array.SimArray(metallicity(sim, [element])[element],
+                              units="1")
+    ratio.sim = sim
+    return ratio
+
+
+@GadgetHDFSnap.derived_quantity
+@SubFindHDFSnap.derived_quantity
+def CXH(sim):
+    return _xh(sim, "C")
+
+@GadgetHDFSnap.derived_quantity
+@SubFindHDFSnap.derived_quantity
+def HeXH(sim):
+    return _xh(sim, "He")
+
+@GadgetHDFSnap.derived_quantity
+@SubFindHDFSnap.derived_quantity
+def FeXH(sim):
+    return _xh(sim, "Fe")
+
+@GadgetHDFSnap.derived_quantity
+@SubFindHDFSnap.derived_quantity
+def MgXH(sim):
+    return _xh(sim, "Mg")
+
+@GadgetHDFSnap.derived_quantity
+@SubFindHDFSnap.derived_quantity
+def NXH(sim):
+    return _xh(sim, "N")
+
+@GadgetHDFSnap.derived_quantity
+@SubFindHDFSnap.derived_quantity
+def OXH(sim):
+    return _xh(sim, "O")
+
+@GadgetHDFSnap.derived_quantity
+@SubFindHDFSnap.derived_quantity
+def SiXH(sim):
+    return _xh(sim, "Si")
@@ -1,17 +1,17 @@
-from scipy.io import FortranFile
+import os
+import functools
+
 import numpy as np
 
-def readf(loc, ion='h1',cloudy='hm12', verbose=False, log=False):
-    
-    if log:
-        file = "".join([loc + ion + '_' + cloudy + "_log"])
-    else:
-        file = "".join([loc + ion + '_' + cloudy])
-    
-    if verbose:
-        print("Reading ", ion, " with background ", cloudy)
-        print("Open file", file)
-    
+
+def _parse(file, ion, log=False, verbose=False):
+    """
+    Parse a Fortran CLOUDY ionisation table.
+
+    The ionisation fractions are returned as a C-contiguous array.
+    """
+    from scipy.io import FortranFile
+
     with FortranFile(file, 'r') as f:
         # Define the header array, 3 integers
         headertype = np.dtype([('nz', '<i4'), ('ntemp', '<i4'), ('nvel', '<i4')])
@@ -34,6 +34,7 @@ def readf(loc, ion='h1',cloudy='hm12', verbose=False, log=False):
     
         # Read it and reshape the desired array
         ionbal = f.read_reals( dtype=ionbaltype ).reshape([nz, ntemp, nrho], order='F')
+        ionbal = np.ascontiguousarray(ionbal)
 
         # Output the values for redshift, temp and rho that correspond to the grids in ionbal
         valtype = np.dtype( np.float32, (nz+ntemp+nrho) )   
@@ -44,8 +45,135 @@ def readf(loc, ion='h1',cloudy='hm12', verbose=False, log=False):
         tarr = valarr[nz: (nz + ntemp) ]
         rarr = valarr[(nz+ntemp) : (nz + ntemp+ nrho)]
  
-        if not log:
-            for i in range(3):
-                if len(np.where(ionbal < 0)[i]) > 0:
-                    raise Exception(ion + ": This is a log file without log in file name") 
+    if not log and np.any(ionbal < 0):
+        raise Exception(ion + ": This is a log file without log in file name") 
     return ionbal, zarr, tarr, rarr
+
+
+def _sidecar(file, cache_dir=None):
+    """
+    The filenames of the .npy ionisation fractions and .npz axes stored
+    alongside a table.
+    """
+    if cache_dir is not None:
+        file = os.path.join(cache_dir, os.path.basename(file))
+    return file + ".ionbal.npy", file + ".axes.npz"
+
+
+def convert(file, ion, log=False, cache_dir=None, verbose=False):
+    """
+    Convert a Fortran table into a memory-mappable .npy sidecar with the
+    redshift, temperature and density axes stored in a .npz file next to it.
+
+    Returns the filenames of the two sidecar files.
+    """
+    ionbal, zarr, tarr, rarr = _parse(file, ion, log=log, verbose=verbose)
+    ionbal_file, axes_file = _sidecar(file, cache_dir)
+
+    if cache_dir is not None and not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    # Write to temporary files first so a partial sidecar is never opened
+    with open(ionbal_file + ".tmp", "wb") as f:
+        np.save(f, ionbal)
+    with open(axes_file + ".tmp", "wb") as f:
+        np.savez(f, zarr=zarr, tarr=tarr, rarr=rarr)
+    os.replace(axes_file + ".tmp", axes_file)
+    os.replace(ionbal_file + ".tmp", ionbal_file)
+
+    return ionbal_file, axes_file
+
+
+@functools.lru_cache(maxsize=32)
+def _open_table(file, mtime, ion, log, cache_dir):
+    """
+    Open the sidecar of a table, converting the table first if the sidecar
+    is missing or older than the table. The modification time of the table
+    is part of the key of the in-process cache.
+    """
+    ionbal_file, axes_file = _sidecar(file, cache_dir)
+
+    table = None
+    if (not os.path.isfile(ionbal_file) or
+            os.path.getmtime(ionbal_file) < mtime):
+        try:
+            convert(file, ion, log=log, cache_dir=cache_dir)
+        except (IOError, OSError):
+            # The sidecar can not be written, keep the parsed table in memory
+            table = _parse(file, ion, log=log)
+
+    if table is None:
+        ionbal = np.load(ionbal_file, mmap_mode="r")
+        with np.load(axes_file) as axes:
+            zarr, tarr, rarr = axes["zarr"], axes["tarr"], axes["rarr"]
+        table = (ionbal, zarr, tarr, rarr)
+
+    # The arrays are shared by every later call, so they must not be changed
+    for arr in table:
+        arr.flags.writeable = False
+    return table
+
+
+def readf(loc, ion='h1',cloudy='hm12', verbose=False, log=False,
+          cache=True, cache_dir=None):
+    """
+    Read a CLOUDY ionisation table.
+
+    Parameters
+    ----------
+    loc : string
+
+        The directory prefix of the table files.
+
+    ion : string, optional
+
+        The ion to read. Default: 'h1'
+
+    cloudy : string, optional
+
+        The ionising background of the table. Default: 'hm12'
+
+    verbose : boolean, optional
+
+        If True, print progress information. Default: False
+
+    log : boolean, optional
+
+        If True, read the '_log' version of the table. Default: False
+
+    cache : boolean, optional
+
+        If True, the table is converted once into a C-contiguous .npy
+        sidecar that later calls open with a memory map, and the open
+        tables are kept in memory. The returned arrays are then read-only.
+        If False, the Fortran file is parsed on every call. Default: True
+
+    cache_dir : string, optional
+
+        The directory to write the sidecar files to. If None, they are
+        written next to the table. Default: None
+
+    Returns
+    -------
+    ionbal : numpy.ndarray
+
+        The ionisation fractions with shape (nz, ntemp, nrho).
+
+    zarr, tarr, rarr : numpy.ndarray
+
+        The redshift, temperature and density of the grid.
+    """
+    
+    if log:
+        file = "".join([loc + ion + '_' + cloudy + "_log"])
+    else:
+        file = "".join([loc + ion + '_' + cloudy])
+    
+    if verbose:
+        print("Reading ", ion, " with background ", cloudy)
+        print("Open file", file)
+
+    if not cache:
+        return _parse(file, ion, log=log, verbose=verbose)
+
+    return _open_table(file, os.path.getmtime(file), ion, log, cache_dir)
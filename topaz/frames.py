@@ -0,0 +1,412 @@
+#!/usr/bin/env python
+"""
+Render sequences of maps across snapshots in parallel, e.g. for movies.
+
+Each frame is read with h5py, rendered with topaz.render and drawn on an
+object-oriented matplotlib Figure with the Agg canvas in its own worker
+process, so no pyplot state is shared and no display or LaTeX is needed.
+"""
+from __future__ import print_function, division
+
+import os
+import warnings
+import multiprocessing
+
+import numpy as np
+from tqdm import tqdm
+
+from . import constants as c
+from . import gadget
+from . import profiling
+from . import render
+from .analysis import snapshot_file
+
+
+def _element(qty):
+    """
+    The element of an [X/H] quantity such as 'CXH', or None for 'rho'.
+    """
+    if qty == "rho":
+        return None
+    if qty.endswith("XH") and qty[:-2] in c.ELEMENT_NAMES:
+        return qty[:-2]
+    raise ValueError("Unknown map quantity: {0}".format(qty))
+
+
+def map_fields(qty):
+    """
+    The gas fields needed to render a map of qty (see snapshot_map).
+    """
+    element = _element(qty)
+    fields = ["Coordinates", "SmoothingLength", "Mass", "Density"]
+    if element is not None:
+        fields += ["ElementAbundance/Hydrogen",
+                   "ElementAbundance/{0}".format(c.ELEMENT_NAMES[element])]
+    return fields
+
+
+def map_values(gas, qty):
+    """
+    The value of qty (see snapshot_map) of each particle in gas, a
+    dictionary of the fields from map_fields.
+    """
+    element = _element(qty)
+    if element is None:
+        return gas["Density"]
+    return (gas["ElementAbundance/{0}".format(c.ELEMENT_NAMES[element])] /
+            gas["ElementAbundance/Hydrogen"] *
+            (c.XSOLH / c.SOLAR_ABUNDANCE[element]))
+
+
+def snapshot_map(snap_file, qty="rho", kind="proj", resolution=500,
+                 width=None, center=None):
+    """
+    Render a map of one snapshot.
+
+    Parameters
+    ----------
+    snap_file : string
+
+        The path to the snapshot. See gadget.snapshot_files.
+
+    qty : string, optional
+
+        'rho' for the density (slice) or surface density (projection), or
+        an [X/H] ratio relative to solar such as 'CXH'. Default: 'rho'
+
+    kind : {'slice', 'proj'}, optional
+
+        A slice through the center of the map or a projection along z. An
+        [X/H] projection is the volume-weighted mean along the line of
+        sight. Default: 'proj'
+
+    resolution : integer, optional
+
+        The number of pixels along each side of the map. Default: 500
+
+    width : float, optional
+
+        The width of the map in code units. Default: the box size
+
+    center : tuple of floats, optional
+
+        The (x, y, z) center of the map in code units. Default: the center
+        of the box
+
+    Returns
+    -------
+    image : numpy.ndarray
+
+        The (resolution, resolution) map in code units, indexed [y, x].
+
+    extent : tuple of floats
+
+        The (left, right, bottom, top) edges of the map in code units.
+
+    redshift : float
+
+        The redshift of the snapshot.
+    """
+    header = gadget.read_header(snap_file)
+    box = float(header["BoxSize"])
+    if width is None:
+        width = box
+    if center is None:
+        center = (box / 2, box / 2, box / 2)
+
+    gas = gadget.read_gas(snap_file, map_fields(qty))
+
+    #  The box is periodic, so kernels that cross its faces are completed
+    #  on the opposite side
+    pos, index = render.periodic_images(
+        gas["Coordinates"], gas["SmoothingLength"], box, center,
+        axes=(0, 1) if kind == "proj" else (0, 1, 2))
+
+    #  SmoothingLength is the radius of the compact support of the kernel
+    image = render.render_images(pos, gas["SmoothingLength"][index],
+                                 {qty: map_values(gas, qty)[index]}, width,
+                                 resolution=resolution,
+                                 center=center[:2], kind=kind,
+                                 z_slice=center[2],
+                                 volume=(gas["Mass"] / gas["Density"])[index],
+                                 average=([qty] if _element(qty) is not None
+                                          and kind == "proj" else None))[qty]
+    extent = (center[0] - width / 2, center[0] + width / 2,
+              center[1] - width / 2, center[1] + width / 2)
+    return image, extent, float(header["Redshift"])
+
+
+def _limits(image, log):
+    """
+    The range of the pixel values of an image, ignoring the extreme
+    0.5 per cent at each end (and non-positive values if log).
+    """
+    values = image[np.isfinite(image)]
+    if log:
+        values = values[values > 0]
+    if len(values) == 0:
+        return None
+    return tuple(np.percentile(values, [0.5, 99.5]))
+
+
+def _label(qty, kind):
+    element = _element(qty)
+    if element is not None:
+        return "[{0}/H]".format(element)
+    if kind == "proj":
+        return r"$\Sigma\ (\mathrm{code\ units})$"
+    return r"$\rho\ (\mathrm{code\ units})$"
+
+
+def draw_frame(image, extent, filename, qty="rho", kind="proj", cmap=None,
+               log=True, vmin=None, vmax=None, redshift=None, dpi=100):
+    """
+    Draw a map and save it to an image file without pyplot.
+
+    Parameters
+    ----------
+    image : numpy.ndarray
+
+        The map, indexed [y, x].
+
+    extent : tuple of floats
+
+        The (left, right, bottom, top) edges of the map. See snapshot_map.
+
+    filename : string
+
+        The output file. The format is given by its extension.
+
+    qty, kind : string, optional
+
+        The quantity and kind of map, used for the labels. See
+        snapshot_map.
+
+    cmap : string, optional
+
+        The colour map. Default: 'inferno' for 'rho', 'RdPu' otherwise
+
+    log : boolean, optional
+
+        If True, use a logarithmic colour scale. Default: True
+
+    vmin, vmax : float, optional
+
+        The colour limits. Default: the range of the map
+
+    redshift : float, optional
+
+        If given, the redshift is shown in the title. Default: None
+
+    dpi : integer, optional
+
+        The resolution of the output file. Default: 100
+    """
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.colors import LogNorm, Normalize
+
+    if cmap is None:
+        cmap = "inferno" if qty == "rho" else "RdPu"
+
+    fig = Figure(figsize=(6, 5))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+
+    if log:
+        image = np.ma.masked_less_equal(image, 0)
+        norm = LogNorm(vmin=vmin, vmax=vmax)
+    else:
+        norm = Normalize(vmin=vmin, vmax=vmax)
+
+    im = ax.imshow(image, origin="lower", extent=extent, cmap=cmap, norm=norm)
+    cbar = fig.colorbar(im, ax=ax)
+    cbar.set_label(_label(qty, kind))
+
+    ax.set_xlabel(r"$x\ (h^{-1}\,\mathrm{cMpc})$")
+    ax.set_ylabel(r"$y\ (h^{-1}\,\mathrm{cMpc})$")
+    if redshift is not None:
+        ax.set_title(r"$z = {0: .3f}$".format(redshift))
+
+    fig.savefig(filename, dpi=dpi)
+
+
+def _render(snap_file, spec, resolution):
+    return snapshot_map(snap_file, spec["qty"], spec["kind"], resolution,
+                        spec["width"], spec["center"])
+
+
+def _limits_task(args):
+    """
+    Render a low resolution map of one snapshot and return its range, or
+    the error message instead of raising if it fails.
+    """
+    i, snap_file, spec = args
+    try:
+        image, _, _ = _render(snap_file, spec, spec["prepass_resolution"])
+        return i, _limits(image, spec["log"]), None
+    except Exception as error:
+        return i, None, "{0}: {1}".format(type(error).__name__, error)
+
+
+def _frame_task(args):
+    """
+    Render the map of one snapshot and write its frame, returning the
+    error message instead of raising if it fails.
+    """
+    i, snap_file, spec, filename = args
+    try:
+        image, extent, redshift = _render(snap_file, spec,
+                                          spec["resolution"])
+        if spec["fmt"] == "npy":
+            np.save(filename, image)
+        else:
+            draw_frame(image, extent, filename, spec["qty"], spec["kind"],
+                       spec["cmap"], spec["log"], spec["vmin"],
+                       spec["vmax"], redshift, spec["dpi"])
+        return i, filename, None
+    except Exception as error:
+        return i, None, "{0}: {1}".format(type(error).__name__, error)
+
+
+def _imap(func, tasks, nproc):
+    """
+    Run the tasks in turn, or in a process pool yielding the results as
+    they finish.
+    """
+    if nproc == 1:
+        for task in tasks:
+            yield func(task)
+        return
+
+    pool = multiprocessing.Pool(nproc)
+    try:
+        for result in profiling.imap(pool, func, tasks):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+
+def render_frames(snapshot_list, output_dir, qty="rho", kind="proj",
+                  resolution=1000, width=None, center=None, cmap=None,
+                  log=True, vmin=None, vmax=None, prepass_resolution=64,
+                  fmt="png", prefix="frame", dpi=100, nproc=None,
+                  verbose=False):
+    """
+    Render a map of each snapshot as a numbered frame.
+
+    Unless vmin and vmax are given, the colour limits shared by every
+    frame are first taken from a cheap low resolution map of each
+    snapshot. The full resolution maps are then rendered in a process
+    pool, one snapshot per task, and each frame is drawn and written by
+    the same worker as soon as its map is finished. Each worker holds one
+    snapshot in memory at a time.
+
+    Parameters
+    ----------
+    snapshot_list : list of strings
+
+        The paths of the snapshot directories, in frame order.
+
+    output_dir : string
+
+        The directory to write the frames to.
+
+    qty, kind, resolution, width, center : optional
+
+        The map of each snapshot. See snapshot_map. Default: a 1000 pixel
+        density projection of the whole box
+
+    cmap : string, optional
+
+        The colour map. Default: 'inferno' for 'rho', 'RdPu' otherwise
+
+    log : boolean, optional
+
+        If True, use a logarithmic colour scale. Default: True
+
+    vmin, vmax : float, optional
+
+        The colour limits. Default: the lowest 0.5 and highest 99.5
+        percentile of the pixels of any low resolution map
+
+    prepass_resolution : integer, optional
+
+        The number of pixels along each side of the maps the colour
+        limits are taken from. Default: 64
+
+    fmt : {'png', 'npy'}, optional
+
+        Write drawn frames, or the raw maps as .npy arrays (nothing is
+        drawn). Default: 'png'
+
+    prefix : string, optional
+
+        The frames are named <prefix>_XXXX.<fmt>. Default: 'frame'
+
+    dpi : integer, optional
+
+        The resolution of the drawn frames. Default: 100
+
+    nproc : integer, optional
+
+        The number of worker processes. If None, use all available cores.
+        Default: None
+
+    verbose : boolean, optional
+
+        If True, show progress bars. Default: False
+
+    Returns
+    -------
+    frames : list of strings
+
+        The filename of each frame, or None for snapshots that failed to
+        render (which are reported with a warning).
+    """
+    if fmt not in ("png", "npy"):
+        raise ValueError("Unknown frame format: {0}".format(fmt))
+    _element(qty)
+
+    if nproc is None:
+        nproc = multiprocessing.cpu_count()
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    snap_files = [snapshot_file(snap) for snap in snapshot_list]
+    spec = {"qty": qty, "kind": kind, "resolution": resolution,
+            "width": width, "center": center, "cmap": cmap, "log": log,
+            "vmin": vmin, "vmax": vmax,
+            "prepass_resolution": prepass_resolution, "fmt": fmt,
+            "dpi": dpi}
+
+    if fmt == "png" and (vmin is None or vmax is None):
+        limits = []
+        tasks = [(i, snap_file, spec)
+                 for i, snap_file in enumerate(snap_files)]
+        for i, limit, error in tqdm(_imap(_limits_task, tasks, nproc),
+                                    total=len(tasks), desc="Limits",
+                                    disable=not verbose):
+            if limit is not None:
+                limits.append(limit)
+        if limits:
+            if vmin is None:
+                spec["vmin"] = min(limit[0] for limit in limits)
+            if vmax is None:
+                spec["vmax"] = max(limit[1] for limit in limits)
+
+    frames = [None] * len(snap_files)
+    tasks = [(i, snap_file, spec,
+              os.path.join(output_dir, "{0}_{1:04d}.{2}".format(prefix, i,
+                                                                fmt)))
+             for i, snap_file in enumerate(snap_files)]
+    for i, filename, error in tqdm(_imap(_frame_task, tasks, nproc),
+                                   total=len(tasks), desc="Frames",
+                                   disable=not verbose):
+        if error is not None:
+            warnings.warn("Could not render {0}: {1}".format(snap_files[i],
+                                                            error))
+        frames[i] = filename
+
+    return frames
@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+"""
+Lightweight readers for Gadget/EAGLE style HDF5 snapshots using h5py.
+"""
+from __future__ import print_function, division
+
+import os
+import glob
+import re
+import threading
+
+import numpy as np
+import h5py
+
+from .profiling import stage
+
+
+def snapshot_files(snap_file):
+    """
+    Find the HDF5 files that make up a snapshot.
+
+    Parameters
+    ----------
+    snap_file : string
+
+        The path to the snapshot. This can be a single HDF5 file, one file
+        of a multi-file set (e.g. snap_012.0.hdf5), or the base name of the
+        snapshot without the extension (e.g. snap_012).
+
+    Returns
+    -------
+    files : list of strings
+
+        The paths of every file in the snapshot, in file number order.
+    """
+    multi = re.match(r"^(.*)\.(\d+)\.hdf5$", snap_file)
+    if multi:
+        base = multi.group(1)
+    elif snap_file.endswith(".hdf5"):
+        return [snap_file]
+    elif os.path.isfile(snap_file + ".hdf5"):
+        return [snap_file + ".hdf5"]
+    else:
+        base = snap_file
+
+    files = glob.glob("{0}.*.hdf5".format(glob.escape(base)))
+    numbered = [(int(re.match(r"^.*\.(\d+)\.hdf5$", f).group(1)), f)
+                for f in files if re.match(r"^.*\.(\d+)\.hdf5$", f)]
+
+    if not numbered:
+        raise IOError("No snapshot files found for {0}".format(snap_file))
+
+    return [f for _, f in sorted(numbered)]
+
+
+def read_header(snap_file):
+    """
+    Read the Header attributes of a snapshot.
+
+    Parameters
+    ----------
+    snap_file : string
+
+        The path to the snapshot. See snapshot_files.
+
+    Returns
+    -------
+    header : dict
+
+        The Header attributes of the first file in the snapshot.
+    """
+    with h5py.File(snapshot_files(snap_file)[0], "r") as f:
+        header = dict(f["Header"].attrs)
+    return header
+
+
+def cgs_factor(dataset, header):
+    """
+    The factor converting a dataset to physical cgs units.
+
+    Uses the CGSConversionFactor, h-scale-exponent and aexp-scale-exponent
+    attributes written by Gadget/EAGLE. Datasets without them are assumed
+    to be dimensionless.
+    """
+    attrs = dataset.attrs
+    factor = float(attrs.get("CGSConversionFactor", 1.0))
+    factor *= header["HubbleParam"]**float(attrs.get("h-scale-exponent", 0.0))
+    factor *= header["ExpansionFactor"]**float(
+        attrs.get("aexp-scale-exponent", 0.0))
+    return factor
+
+
+def read_gas(snap_file, fields, cgs=False, ptype="PartType0"):
+    """
+    Read a set of gas particle datasets from a snapshot.
+
+    Only the requested datasets are read. Multi-file snapshots are
+    concatenated in file number order.
+
+    Parameters
+    ----------
+    snap_file : string
+
+        The path to the snapshot. See snapshot_files.
+
+    fields : list of strings
+
+        The names of the datasets in the particle group to read,
+        e.g. ["Mass", "Density", "ElementAbundance/Hydrogen"].
+
+    cgs : boolean, optional
+
+        If True, convert each field to physical cgs units. Otherwise the
+        fields are returned in code units. Default: False
+
+    ptype : string, optional
+
+        The particle group to read from. Default: 'PartType0'
+
+    Returns
+    -------
+    gas : dict
+
+        A dictionary of numpy arrays keyed by field name.
+    """
+    header = read_header(snap_file)
+    parts = dict((field, []) for field in fields)
+
+    with stage("read", snapshot=snap_file):
+        for filename in snapshot_files(snap_file):
+            with h5py.File(filename, "r") as f:
+                if ptype not in f:
+                    continue
+                for field in fields:
+                    dset = f[ptype][field]
+                    arr = dset[()]
+                    if cgs:
+                        arr = arr * cgs_factor(dset, header)
+                    parts[field].append(arr)
+
+    gas = {}
+    for field in fields:
+        if len(parts[field]) == 0:
+            gas[field] = np.array([])
+        elif len(parts[field]) == 1:
+            gas[field] = parts[field][0]
+        else:
+            gas[field] = np.concatenate(parts[field])
+    return gas
+
+
+def iter_gas(snap_file, fields, chunk_size=2**20, ptype="PartType0"):
+    """
+    Iterate over a set of gas particle datasets in fixed-size chunks.
+
+    Only chunk_size particles of each field are held in memory at a time.
+    Chunks do not span the files of a multi-file snapshot.
+
+    Parameters
+    ----------
+    snap_file : string
+
+        The path to the snapshot. See snapshot_files.
+
+    fields : list of strings
+
+        The names of the datasets in the particle group to read.
+
+    chunk_size : integer, optional
+
+        The number of particles in each chunk. Default: 2**20
+
+    ptype : string, optional
+
+        The particle group to read from. Default: 'PartType0'
+
+    Yields
+    ------
+    chunk : dict
+
+        A dictionary of numpy arrays in code units keyed by field name.
+    """
+    for filename in snapshot_files(snap_file):
+        with h5py.File(filename, "r") as f:
+            if ptype not in f:
+                continue
+            group = f[ptype]
+            npart = group[fields[0]].shape[0]
+            for start in range(0, npart, chunk_size):
+                stop = min(start + chunk_size, npart)
+                #  The stage ends before the chunk is handed over, so the
+                #  caller's work on it is not counted as reading
+                with stage("read", snapshot=filename, start=start):
+                    chunk = dict((field, group[field][start:stop])
+                                 for field in fields)
+                yield chunk
+
+
+def iter_chunks(gas, chunk_size=2**20):
+    """
+    Iterate over a dictionary of gas arrays in fixed-size chunks.
+
+    The chunks are views of the arrays, so no data is copied.
+    """
+    fields = list(gas.keys())
+    npart = len(gas[fields[0]]) if fields else 0
+    for start in range(0, npart, chunk_size):
+        yield dict((field, gas[field][start:start + chunk_size])
+                   for field in fields)
+
+
+def gas_nbytes(snap_file, fields, ptype="PartType0"):
+    """
+    The number of bytes needed to read a set of gas datasets into memory.
+    """
+    nbytes = 0
+    for filename in snapshot_files(snap_file):
+        with h5py.File(filename, "r") as f:
+            if ptype not in f:
+                continue
+            for field in fields:
+                dset = f[ptype][field]
+                nbytes += dset.size * dset.dtype.itemsize
+    return nbytes
+
+
+def prefetch_snapshots(snap_files, fields, ahead=1, max_bytes=None):
+    """
+    Iterate over snapshots while the next ones are read in the background.
+
+    While the caller works on one snapshot, a background thread reads the
+    requested gas datasets of up to 'ahead' following snapshots, so the
+    disk reads overlap with the computation.
+
+    Parameters
+    ----------
+    snap_files : list of strings
+
+        The paths to the snapshots. See snapshot_files.
+
+    fields : list of strings
+
+        The names of the PartType0 datasets to read.
+
+    ahead : integer, optional
+
+        The maximum number of snapshots read ahead. Default: 1
+
+    max_bytes : integer, optional
+
+        The maximum number of bytes held by the snapshots that have been
+        read ahead, counting the one the caller is working on until it asks
+        for the next. A snapshot larger than this is not read; it is
+        yielded with gas set to None so the caller can stream it from disk
+        instead. Default: None (no limit)
+
+    Yields
+    ------
+    snap_file : string
+
+        The path to the snapshot.
+
+    gas : dict or None
+
+        The gas arrays in code units, as returned by read_gas. None if the
+        snapshot is over the memory budget or could not be read, in which
+        case the caller reads it itself.
+    """
+    state = {"pending": [], "nbytes": 0, "done": False, "stop": False}
+    condition = threading.Condition()
+
+    def reader():
+        for snap_file in snap_files:
+            try:
+                nbytes = gas_nbytes(snap_file, fields)
+                if max_bytes is not None and nbytes > max_bytes:
+                    nbytes = 0
+
+                with condition:
+                    while not state["stop"] and (
+                            len(state["pending"]) >= ahead or
+                            (max_bytes is not None and
+                             state["nbytes"] + nbytes > max_bytes)):
+                        condition.wait()
+                    if state["stop"]:
+                        return
+
+                if nbytes == 0:
+                    gas = None
+                else:
+                    gas = read_gas(snap_file, fields)
+                item = (snap_file, gas, nbytes)
+            except Exception:
+                #  Leave the snapshot to the caller, which will report the
+                #  error when it reads it
+                item = (snap_file, None, 0)
+
+            with condition:
+                state["pending"].append(item)
+                state["nbytes"] += item[2]
+                condition.notify_all()
+
+        with condition:
+            state["done"] = True
+            condition.notify_all()
+
+    thread = threading.Thread(target=reader)
+    thread.daemon = True
+    thread.start()
+
+    try:
+        while True:
+            with condition:
+                while not state["pending"] and not state["done"]:
+                    condition.wait()
+                if not state["pending"]:
+                    break
+                snap_file, gas, nbytes = state["pending"].pop(0)
+                condition.notify_all()
+
+            yield snap_file, gas
+
+            #  The caller has finished with the snapshot and must not hold
+            #  on to it, so its memory can be given to the next one
+            gas = None
+            with condition:
+                state["nbytes"] -= nbytes
+                condition.notify_all()
+    finally:
+        with condition:
+            state["stop"] = True
+            condition.notify_all()
+        thread.join()
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+"""
+Vectorised interpolation of ionisation balance tables onto gas particles.
+
+The tables give the fraction of an element in an ionisation state as a
+function of redshift, temperature and hydrogen number density. They can be
+read from the OWLS HDF5 tables in data/owls_ion_data or from the Fortran
+CLOUDY tables read by fortran.readf.
+"""
+from __future__ import print_function, division
+
+import os
+
+import numpy as np
+import h5py
+
+from . import constants as c
+from . import fortran
+from . import gadget
+
+OWLS_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, "data", "owls_ion_data")
+
+
+class IonTable(object):
+    """
+    An ionisation balance table.
+
+    Parameters
+    ----------
+    ionbal : numpy.ndarray, shape (nz, ntemp, nrho)
+
+        The ionisation fraction on the grid.
+
+    redshift : numpy.ndarray
+
+        The redshifts of the grid.
+
+    logt : numpy.ndarray
+
+        The log10 temperatures (K) of the grid.
+
+    logd : numpy.ndarray
+
+        The log10 hydrogen number densities (cm**-3) of the grid.
+
+    log : boolean, optional
+
+        True if ionbal holds log10 fractions. The interpolation is then done
+        in log space and the fractions returned are linear. Default: False
+    """
+
+    def __init__(self, ionbal, redshift, logt, logd, log=False):
+        self.ionbal = ionbal
+        self.redshift = np.asarray(redshift, dtype=np.float64)
+        self.logt = np.asarray(logt, dtype=np.float64)
+        self.logd = np.asarray(logd, dtype=np.float64)
+        self.log = log
+
+    def at_redshift(self, redshift):
+        """
+        The (ntemp, nrho) table linearly interpolated to a redshift.
+
+        Redshifts outside of the table are clamped to its edges.
+        """
+        z = self.redshift
+        if len(z) == 1 or redshift <= z[0]:
+            return np.asarray(self.ionbal[0], dtype=np.float64)
+        if redshift >= z[-1]:
+            return np.asarray(self.ionbal[-1], dtype=np.float64)
+
+        i = np.searchsorted(z, redshift) - 1
+        frac = (redshift - z[i]) / (z[i + 1] - z[i])
+        return ((1 - frac) * np.asarray(self.ionbal[i], dtype=np.float64) +
+                frac * np.asarray(self.ionbal[i + 1], dtype=np.float64))
+
+
+def read_owls_table(ion, data_dir=OWLS_DATA_DIR):
+    """
+    Read an OWLS HDF5 ionisation table, e.g. ion='h1'.
+    """
+    with h5py.File(os.path.join(data_dir, "{0}.hdf5".format(ion)), "r") as f:
+        # Stored as (nrho, ntemp, nz)
+        ionbal = np.ascontiguousarray(np.transpose(f["ionbal"][()],
+                                                   (2, 1, 0)))
+        table = IonTable(ionbal, f["redshift"][()], f["logt"][()],
+                         f["logd"][()])
+    return table
+
+
+def read_cloudy_table(loc, ion="h1", cloudy="hm12", log=False):
+    """
+    Read a Fortran CLOUDY ionisation table with fortran.readf.
+
+    The temperature and density axes are assumed to be log10 T and
+    log10 nH.
+    """
+    ionbal, zarr, tarr, rarr = fortran.readf(loc, ion=ion, cloudy=cloudy,
+                                             log=log)
+    return IonTable(ionbal, zarr, tarr, rarr, log=log)
+
+
+def _bins(grid, values):
+    """
+    The lower bin index and fractional position of each value on a grid.
+
+    Values outside of the grid are clamped to its edges.
+    """
+    i = np.clip(np.searchsorted(grid, values) - 1, 0, len(grid) - 2)
+    frac = (values - grid[i]) / (grid[i + 1] - grid[i])
+    np.clip(frac, 0, 1, out=frac)
+    return i, frac
+
+
+def ion_fractions(tables, redshift, temperature, nH, chunk_size=2**20,
+                  dtype=np.float32):
+    """
+    Interpolate the ionisation fractions of many ions onto gas particles.
+
+    The tables are interpolated to the redshift once. The bin indices of
+    the particles are found once per chunk and shared by every table with
+    the same temperature and density grid.
+
+    Parameters
+    ----------
+    tables : dict
+
+        The IonTable of each ion, keyed by ion name.
+
+    redshift : float
+
+        The redshift of the snapshot.
+
+    temperature : numpy.ndarray
+
+        The temperature of each particle in K.
+
+    nH : numpy.ndarray
+
+        The hydrogen number density of each particle in cm**-3.
+
+    chunk_size : integer, optional
+
+        The number of particles interpolated at a time. Default: 2**20
+
+    dtype : numpy.dtype, optional
+
+        The type of the returned arrays. Default: numpy.float32
+
+    Returns
+    -------
+    fractions : dict
+
+        The ionisation fraction of each particle for each ion.
+    """
+    npart = len(temperature)
+    slices = dict((ion, table.at_redshift(redshift))
+                  for ion, table in tables.items())
+    fractions = dict((ion, np.empty(npart, dtype=dtype)) for ion in tables)
+
+    # Tables that share a grid share the bin indices
+    grids = {}
+    for ion, table in tables.items():
+        key = (table.logt.tobytes(), table.logd.tobytes())
+        grids.setdefault(key, (table.logt, table.logd, []))[2].append(ion)
+
+    for start in range(0, npart, chunk_size):
+        stop = min(start + chunk_size, npart)
+        logt = np.log10(np.asarray(temperature[start:stop],
+                                   dtype=np.float64))
+        logd = np.log10(np.asarray(nH[start:stop], dtype=np.float64))
+
+        for grid_t, grid_d, ions in grids.values():
+            it, ft = _bins(grid_t, logt)
+            id_, fd = _bins(grid_d, logd)
+
+            for ion in ions:
+                table = slices[ion]
+                value = ((1 - ft) * (1 - fd) * table[it, id_] +
+                         (1 - ft) * fd * table[it, id_ + 1] +
+                         ft * (1 - fd) * table[it + 1, id_] +
+                         ft * fd * table[it + 1, id_ + 1])
+                if tables[ion].log:
+                    value = 10**value
+                fractions[ion][start:stop] = value
+
+    return fractions
+
+
+def snapshot_ion_fractions(snap_file, tables, chunk_size=2**20):
+    """
+    Calculate the ionisation fractions of the gas particles in a snapshot.
+
+    Parameters
+    ----------
+    snap_file : string
+
+        The path to the snapshot. See gadget.snapshot_files.
+
+    tables : dict
+
+        The IonTable of each ion, keyed by ion name.
+
+    chunk_size : integer, optional
+
+        The number of particles interpolated at a time. Default: 2**20
+
+    Returns
+    -------
+    fractions : dict
+
+        The ionisation fraction of each gas particle for each ion.
+    """
+    redshift = gadget.read_header(snap_file)["Redshift"]
+    gas = gadget.read_gas(snap_file, ["Temperature", "Density",
+                                      "ElementAbundance/Hydrogen"], cgs=True)
+    nH = gas["Density"] * gas["ElementAbundance/Hydrogen"] / c.M_P
+
+    return ion_fractions(tables, redshift, gas["Temperature"], nH,
+                         chunk_size=chunk_size)
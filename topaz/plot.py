@@ -23,27 +23,231 @@ from pynbody.snapshot.gadgethdf import GadgetHDFSnap
 
 from . import analysis
 from . import constants as c
+from . import render
+from . import tiles
+from .cache import render_cache
+from .profiling import stage
+from .derived import METALS, metallicity
 
-mpl.rc("xtick", labelsize=12)
-mpl.rc("ytick", labelsize=12)
-mpl.rc("font", size=16, family="serif",
-       serif=[r"cmr10"], style="normal",
-       variant="normal", stretch="normal")
-mpl.rcParams["axes.unicode_minus"] = False
-plt.rcParams['text.usetex'] = True
+_style_applied = False
+
+#  The keyword arguments of pynbody.plot.sph.image that only change how an
+#  image is drawn, not the rendered pixels
+DRAW_KWARGS = ["vmin", "vmax", "log", "clear", "title", "qtytitle",
+               "subplot", "ret_im", "filename", "fill_nan", "fill_val",
+               "noplot"]
+
+
+def _apply_style():
+    """
+    Set the matplotlib style used by the plots.
+
+    This is done the first time a plotting function is called rather than
+    on import, so importing topaz does not change the global rcParams.
+    """
+    global _style_applied
+    if _style_applied:
+        return
+
+    mpl.rc("xtick", labelsize=12)
+    mpl.rc("ytick", labelsize=12)
+    mpl.rc("font", size=16, family="serif",
+           serif=[r"cmr10"], style="normal",
+           variant="normal", stretch="normal")
+    mpl.rcParams["axes.unicode_minus"] = False
+    plt.rcParams['text.usetex'] = True
+    _style_applied = True
+
+
+def _width(sim, width=None):
+    """
+    The width of a map in the position units of the gas. Defaults to the
+    box size.
+    """
+    if width is None:
+        width = sim.properties["boxsize"]
+    if isinstance(width, str):
+        width = pn.units.Unit(width)
+    if hasattr(width, "ratio"):
+        width = width.ratio(sim.g["pos"].units, **sim.conversion_context())
+    return float(width)
+
+
+def render_maps(sim, qtys, resolution=1000, width=None, kind="slice",
+                units=None, arrays=None):
+    """
+    Render several maps of the gas with one SPH kernel pass.
+
+    Parameters
+    ----------
+    sim : pynbody.snapshot
+
+        The snapshot.
+
+    qtys : list of strings
+
+        The gas quantities to render, e.g. ['rho', 'CXH', 'OXH']. 'rho'
+        gives the density (slice) or surface density (projection), every
+        other quantity its kernel-weighted value (slice) or its
+        volume-weighted mean along the line of sight (projection).
+
+    resolution : integer, optional
+
+        The number of pixels along each side of the maps. Default: 1000
+
+    width : float or string, optional
+
+        The width of the maps. Default: the box size
+
+    kind : {'slice', 'proj'}, optional
+
+        Render a slice through z = 0 or a projection along z.
+        Default: 'slice'
+
+    units : string, optional
+
+        The units of the 'rho' map, e.g. 'Msol kpc^-3' for a slice or
+        'Msol kpc^-2' for a projection. Default: the simulation units
+
+    arrays : dict, optional
+
+        The per-particle values of some of the quantities, keyed by name,
+        if they have already been calculated (e.g. by metallicity). The
+        others are taken from the snapshot. Default: None
+
+    Returns
+    -------
+    images : dict
+
+        The (resolution, resolution) map of each quantity.
+    """
+    gas = sim.g
+    width = _width(sim, width)
+    if arrays is None:
+        arrays = {}
+
+    with stage("load", snapshot=sim.filename, quantities=list(qtys)):
+        quantities = dict((qty, np.asarray(arrays[qty] if qty in arrays
+                                           else gas[qty]))
+                          for qty in qtys)
+        volume = np.asarray(gas["mass"]) / np.asarray(gas["rho"])
+    average = ([qty for qty in qtys if qty != "rho"] if kind == "proj"
+               else None)
+
+    # The pynbody kernel has compact support of twice the smoothing length
+    with stage("render", snapshot=sim.filename, quantities=list(qtys),
+               resolution=resolution):
+        images = render.render_images(np.asarray(gas["pos"]),
+                                      2 * np.asarray(gas["smooth"]),
+                                      quantities, width,
+                                      resolution=resolution, kind=kind,
+                                      volume=volume, average=average)
+
+    if units is not None and "rho" in images:
+        dim = 3 if kind == "slice" else 2
+        sim_units = gas["mass"].units / gas["pos"].units**dim
+        images["rho"] *= sim_units.ratio(units, **sim.conversion_context())
+
+    return images
+
+
+def _draw_image(im, width, cmap="inferno", log=True, ax=None, vmin=None,
+                vmax=None):
+    """
+    Draw a rendered map centered on the origin.
+    """
+    if ax is None:
+        ax = plt.gca()
+
+    if log:
+        im = np.ma.masked_less_equal(im, 0)
+        norm = mpl.colors.LogNorm(vmin=vmin, vmax=vmax)
+    else:
+        norm = mpl.colors.Normalize(vmin=vmin, vmax=vmax)
+
+    extent = (-width / 2, width / 2, -width / 2, width / 2)
+    return ax.imshow(im, origin="lower", extent=extent, cmap=cmap, norm=norm)
+
+
+def _draw_kwargs(kwargs):
+    """
+    The keyword arguments understood by _draw_image.
+    """
+    return dict((key, kwargs[key]) for key in ["vmin", "vmax", "log"]
+                if key in kwargs)
+
+
+def _cache_params(cache, kwargs, center, rotation, **params):
+    """
+    The render parameters that key an image in the cache, or None if
+    there is no cache.
+
+    The snapshot files are identified by the cache itself. Transforms
+    applied in memory can not be seen without reading the particles, so
+    they are keyed by the center and rotation given by the caller. The
+    drawing keyword arguments are left out, so changing them only redraws
+    the cached image.
+    """
+    if cache is None:
+        return None
+    key = dict((name, value) for name, value in kwargs.items()
+               if name not in DRAW_KWARGS)
+    key.update(params, center=center, rotation=rotation)
+    return key
+
+
+def _lookup_image(sim, image, cache, params):
+    """
+    The (image, width) to draw, taken from the image argument or the
+    render cache, or (None, None) if the particles have to be rendered.
+    """
+    if image is not None:
+        return image, _width(sim)
+    if cache is not None:
+        cached = cache.get(sim.filename, params)
+        if cached is not None:
+            return cached
+    return None, None
 
 
 def rho_slice(sim, resolution=1000, cmap="inferno",
               units="Msol kpc^-3", show_cbar=False,
-              ax_passed=None, **kwargs):
+              ax_passed=None, image=None, cache=None, center=None,
+              rotation=None, **kwargs):
     """
     Make a density slice plot
+
+    If image is given (e.g. from render_maps), it is drawn instead of
+    rendering the particles again. If cache is given (True, a directory
+    or a cache.RenderCache), the rendered image is stored on disk and
+    later calls with the same snapshot files and render parameters only
+    redraw it. If sim has been centred or rotated in memory, describe the
+    transform with center and rotation (e.g. the halo center and 'faceon')
+    so that the cache tells the views apart. The pixel array is returned.
     """
+    _apply_style()
     redshift = sim.properties['Redshift'] 
     boxsize = sim.properties["boxsize"] 
 
-    im = sph.image(sim.g, width=boxsize, resolution=resolution, 
-                       cmap=cmap, units=units, show_cbar=show_cbar, **kwargs)
+    cache = render_cache(cache)
+    params = _cache_params(cache, kwargs, center, rotation, quantity="rho",
+                           kind="slice", units=units, width=boxsize,
+                           resolution=resolution)
+    image, width = _lookup_image(sim, image, cache, params)
+
+    if image is None:
+        with stage("sph.image", snapshot=sim.filename, quantity="rho",
+                   resolution=resolution):
+            im = sph.image(sim.g, width=boxsize, resolution=resolution, 
+                               cmap=cmap, units=units, show_cbar=show_cbar,
+                               **kwargs)
+        if cache is not None:
+            cache.put(sim.filename, params, im, _width(sim))
+    else:
+        im = image
+        _draw_image(image, width, cmap=cmap, **_draw_kwargs(kwargs))
+        if show_cbar:
+            plt.colorbar()
  
     if not show_cbar:
         cbar = plt.colorbar()
@@ -56,13 +260,77 @@ def rho_slice(sim, resolution=1000, cmap="inferno",
 
 
 def rho_proj(sim, resolution=1000, cmap="inferno", 
-             units="Msol kpc^-2", show_cbar=False, **kwargs):
- 
+             units="Msol kpc^-2", show_cbar=False, image=None, cache=None,
+             center=None, rotation=None, tiled_file=None, tile_pixels=None,
+             nproc=None, **kwargs):
+    """
+    Make a density projection plot
+
+    image, cache, center and rotation are as for rho_slice. The pixel
+    array is returned.
+
+    If tiled_file is given, the projection is rendered tile by tile in
+    nproc processes into that HDF5 file (see tiles.tiled_map), which allows
+    resolutions too large to fit in memory, and a preview of at most 2048
+    pixels is drawn. tile_pixels defaults to the largest divisor of
+    resolution up to 1024. The tiled map is rendered from the snapshot
+    file, so it is centred on center (in the code units of the file), or
+    on the origin of the file if center is None, to match the projection
+    of sim centred on center in memory. The tiled map is kept in the units
+    of the snapshot file and the preview is converted to units. It can not
+    be combined with cache or rotation, and only the vmin, vmax and log
+    keyword arguments are used.
+    """
+    _apply_style()
     redshift = sim.properties['Redshift']
     boxsize = sim.properties["boxsize"]
  
-    im = sph.image(sim.g, width=boxsize, resolution=resolution, 
-                       cmap=cmap, units=units, show_cbar=show_cbar, **kwargs)
+    if tiled_file is not None:
+        if cache is not None and cache is not False:
+            raise ValueError("cache can not be used with tiled_file")
+        if rotation is not None:
+            raise ValueError("rotation can not be used with tiled_file")
+        unsupported = sorted(set(kwargs) - set(_draw_kwargs(kwargs)))
+        if unsupported:
+            raise TypeError("Keyword arguments not supported with "
+                            "tiled_file: {0}".format(", ".join(unsupported)))
+
+        #  sph.image centres the map on the origin of the coordinates in
+        #  memory
+        if center is None:
+            center = (0.0, 0.0)
+        tiles.tiled_map(sim.filename, tiled_file, qty="rho",
+                        resolution=resolution, tile_pixels=tile_pixels,
+                        center=tuple(float(x) for x in center[:2]),
+                        nproc=nproc)
+        image, width = tiles.read_tiled_map(tiled_file)
+
+        #  The tiled map is rendered from the file, not from the snapshot
+        #  in memory, so it is in the original units of the file
+        file_units = (sim.infer_original_units("Msol") /
+                      sim.infer_original_units("kpc")**2)
+        image = image * file_units.ratio(units, **sim.conversion_context())
+        width = _width(sim, width * sim.infer_original_units("kpc"))
+    else:
+        cache = render_cache(cache)
+        params = _cache_params(cache, kwargs, center, rotation,
+                               quantity="rho", kind="proj", units=units,
+                               width=boxsize, resolution=resolution)
+        image, width = _lookup_image(sim, image, cache, params)
+
+    if image is None:
+        with stage("sph.image", snapshot=sim.filename, quantity="rho",
+                   resolution=resolution):
+            im = sph.image(sim.g, width=boxsize, resolution=resolution, 
+                               cmap=cmap, units=units, show_cbar=show_cbar,
+                               **kwargs)
+        if cache is not None:
+            cache.put(sim.filename, params, im, _width(sim))
+    else:
+        im = image
+        _draw_image(image, width, cmap=cmap, **_draw_kwargs(kwargs))
+        if show_cbar:
+            plt.colorbar()
  
     if not show_cbar:
         cbar = plt.colorbar()
@@ -75,34 +343,151 @@ def rho_proj(sim, resolution=1000, cmap="inferno",
     return(im)
 
 
-def metal_map(sim, metal, **kwargs):
+def metal_map(sim, metal, image=None, cache=None, center=None,
+              rotation=None, **kwargs):
+    """
+    Make an [X/H] slice plot of a metal
+
+    image, cache, center and rotation are as for rho_slice. The pixel
+    array is returned.
+    """
+    _apply_style()
     redshift = sim.properties["Redshift"]
-    metal_arr = sim.g[metal]
-    metal_tot = np.sum(metal_arr)
 
     metallicity = "{0}XH".format(metal)
-    if metal_tot != 0:
-        im = sph.image(sim.g, qty=metallicity, width=sim.properties["boxsize"],
-                  cmap="RdPu", show_cbar=False, approximate_fast=False, 
-                  **kwargs)
-        cbar = plt.colorbar()
-        cbar.set_label(label="[{0}/{1}]".format(metal, "H"), fontsize=16)
-        plt.title("z = {1: .3f}".format(metal, redshift), fontsize=18)
-        plt.ylabel(r"$y\ (\mathrm{cMpc})$", fontsize=16)
-        plt.xlabel(r"$x\ (\mathrm{cMpc})$", fontsize=16)
-        return(im)
+    cache = render_cache(cache)
+    params = _cache_params(cache, kwargs, center, rotation,
+                           quantity=metallicity, kind="slice",
+                           width=sim.properties["boxsize"])
+    image, width = _lookup_image(sim, image, cache, params)
+
+    if image is None:
+        metal_arr = sim.g[metal]
+        metal_tot = np.sum(metal_arr)
+        if metal_tot == 0:
+            print("Zero metals found! Can not make metallicity \
+                  plot for: {0}".format(sim))
+            return
+
+        with stage("sph.image", snapshot=sim.filename, quantity=metallicity):
+            im = sph.image(sim.g, qty=metallicity, width=sim.properties["boxsize"],
+                      cmap="RdPu", show_cbar=False, approximate_fast=False, 
+                      **kwargs)
+        if cache is not None:
+            cache.put(sim.filename, params, im, _width(sim))
     else:
-        print("Zero metals found! Can not make metallicity \
-              plot for: {0}".format(sim))
+        im = image
+        _draw_image(image, width, cmap="RdPu", **_draw_kwargs(kwargs))
+
+    cbar = plt.colorbar()
+    cbar.set_label(label="[{0}/{1}]".format(metal, "H"), fontsize=16)
+    plt.title("z = {1: .3f}".format(metal, redshift), fontsize=18)
+    plt.ylabel(r"$y\ (\mathrm{cMpc})$", fontsize=16)
+    plt.xlabel(r"$x\ (\mathrm{cMpc})$", fontsize=16)
+    return(im)
+
+
+def metal_maps(sim, metals=None, resolution=500, ncols=4, kind="slice",
+               cmap="RdPu", **kwargs):
+    """
+    Plot [X/H] maps of several metals rendered with one SPH kernel pass.
+
+    Parameters
+    ----------
+    sim : pynbody.snapshot
+
+        The snapshot.
+
+    metals : list of strings, optional
+
+        The metals to map. Default: METALS
+
+    resolution : integer, optional
+
+        The number of pixels along each side of the maps. Default: 500
+
+    ncols : integer, optional
+
+        The number of panels in each row of the figure. Default: 4
+
+    kind : {'slice', 'proj'}, optional
+
+        Render slices, or projections of the volume-weighted mean [X/H]
+        along the line of sight. Default: 'slice'
+
+    cmap : string, optional
+
+        The colour map. Default: 'RdPu'
+
+    Returns
+    -------
+    fig, axes
+
+        The figure and its axes.
+
+    images : dict
+
+        The rendered map of each metal.
+    """
+    _apply_style()
+    if metals is None:
+        metals = METALS
+
+    redshift = sim.properties["Redshift"]
+    width = _width(sim)
+    qtys = ["{0}XH".format(metal) for metal in metals]
+    with stage("metallicity", snapshot=sim.filename, metals=list(metals)):
+        ratios = metallicity(sim, metals)
+    images = render_maps(sim, qtys, resolution=resolution, kind=kind,
+                         arrays=dict(("{0}XH".format(metal), ratios[metal])
+                                     for metal in metals),
+                         **kwargs)
+
+    nrows = int(np.ceil(len(metals) / ncols))
+    fig, axes = plt.subplots(nrows, ncols, figsize=(4 * ncols, 4 * nrows),
+                             squeeze=False)
+    for ax, metal, qty in zip(axes.flat, metals, qtys):
+        im = _draw_image(images[qty], width, cmap=cmap, ax=ax)
+        cbar = fig.colorbar(im, ax=ax)
+        cbar.set_label(label="[{0}/{1}]".format(metal, "H"), fontsize=16)
+        ax.set_xlabel(r"$x\ (\mathrm{cMpc})$", fontsize=16)
+        ax.set_ylabel(r"$y\ (\mathrm{cMpc})$", fontsize=16)
+    for ax in list(axes.flat)[len(metals):]:
+        ax.set_visible(False)
+    fig.suptitle(r"$z = {0: .3f}$".format(redshift), fontsize=18)
+
+    return fig, axes, images
 
 
 def ion_history(redshifts=None, ion_history=None, snapshots=None, 
                 ion="HI", weighting="volume", half_line=False,
                 verbose=False, return_arrays=False,
-                ax_passed=None, **kwargs):
+                ax_passed=None, cache=None, nproc=1, output_dir=None,
+                history_file=None, **kwargs):
+    """
+    Plot the mean ion fraction as a function of redshift.
+
+    The history is given as redshifts and ion_history, calculated from a
+    list of snapshots, or followed incrementally from the snapshots in
+    output_dir. In that case history_file must be given, and only the
+    snapshots that are not yet in it (or have been rewritten since) are
+    reduced. See analysis.update_ion_history.
+    """
+    _apply_style()
+
+    if output_dir is not None:
+        if history_file is None:
+            raise ValueError("A history_file is needed to follow the "
+                             "snapshots in {0}".format(output_dir))
+        redshifts, means = analysis.update_ion_history(
+            output_dir, history_file, ions=[ion], weightings=[weighting],
+            verbose=verbose, nproc=nproc)
+        ion_history = means[(ion, weighting)]
 
-    if snapshots is not None:
-        redshifts, ion_history = analysis.ion_mean(snapshots, ion,  weighting, verbose)
+    elif snapshots is not None:
+        redshifts, ion_history = analysis.ion_mean(snapshots, ion,  weighting,
+                                                   verbose, cache=cache,
+                                                   nproc=nproc)
 
     if ion_history is None and redshifts is None:
         print("If HI history and redshifts are not provided, then snapshots must be.")
@@ -141,38 +526,3 @@ XSOLSi = 6.825874E-4
 XSOLS = 4.0898522E-4
 XSOLCa = 6.4355E-5
 XSOLFe = 1.1032152E-3
-
-@GadgetHDFSnap.derived_quantity
-@SubFindHDFSnap.derived_quantity
-def CXH(sim):
-    return (sim.g["C"] / sim.g["H"]) / (c.XSOLC/c.XSOLH)
-
-@GadgetHDFSnap.derived_quantity
-@SubFindHDFSnap.derived_quantity
-def HeXH(sim):
-    return sim.g["He"] / sim.g["H"] / (c.XSOLHe/c.XSOLH)
-
-@GadgetHDFSnap.derived_quantity
-@SubFindHDFSnap.derived_quantity
-def FeXH(sim):
-    return sim.g["Fe"] / sim.g["H"] / (c.XSOLFe/c.XSOLH) 
-
-@GadgetHDFSnap.derived_quantity
-@SubFindHDFSnap.derived_quantity
-def MgXH(sim):
-    return sim.g["Mg"] / sim.g["H"] / (c.XSOLMg/c.XSOLH)
-
-@GadgetHDFSnap.derived_quantity
-@SubFindHDFSnap.derived_quantity
-def NXH(sim):
-    return sim.g["N"] / sim.g["H"] / (c.XSOLN/c.XSOLH)
-
-@GadgetHDFSnap.derived_quantity
-@SubFindHDFSnap.derived_quantity
-def OXH(sim):
-    return sim.g["O"] / sim.g["H"] / (c.XSOLO/c.XSOLH)
-
-@GadgetHDFSnap.derived_quantity
-@SubFindHDFSnap.derived_quantity
-def SiXH(sim):
-    return sim.g["Si"] / sim.g["H"] / (c.XSOLSi/c.XSOLH)
@@ -0,0 +1,392 @@
+#!/usr/bin/env python
+"""
+Opt-in timing and memory instrumentation of the expensive stages.
+
+Reading and reducing snapshots, loading datasets with yt, adding ion
+fields, making rays and rendering images are wrapped in stage() blocks
+that do nothing unless profiling is enabled. Enable it around a block of
+code with
+
+    with profiling.profile("trace.json") as prof:
+        analysis.ion_means(snapshots)
+    print(prof.report())
+
+or, without changing any code, by setting the TOPAZ_PROFILE environment
+variable to the filename of a JSON or CSV trace. The trace is written and
+a summary printed to stderr when the interpreter exits.
+
+Every stage records its wall time, the bytes read by its thread while it
+ran (from /proc/thread-self/io, Linux only), the change of the resident set
+size of the process across the stage (rss_delta) and how much it raised
+the peak resident set size of the process (peak_delta). The memory is
+measured per process, so the deltas of a stage include allocations made
+by other threads at the same time, e.g. a snapshot being read ahead.
+
+Stages run in the worker processes of the nproc > 1 functions are
+recorded in the worker and merged into the profiler of the parent as each
+task finishes (see imap). This relies on the workers being forked from
+the profiled process, the default on Linux.
+"""
+from __future__ import print_function, division
+
+import os
+import sys
+import csv
+import json
+import time
+import atexit
+import threading
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def _bytes_read():
+    """
+    The number of bytes this thread has read, or None if unknown.
+    """
+    try:
+        with open("/proc/thread-self/io") as f:
+            for line in f:
+                if line.startswith("rchar:"):
+                    return int(line.split()[1])
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def _rss():
+    """
+    The current resident set size of this process in bytes, or None if
+    unknown.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+def _peak_rss():
+    """
+    The peak resident set size of this process in bytes, or None if
+    unknown.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #  ru_maxrss is in bytes on macOS and kilobytes elsewhere
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _delta(before, after):
+    return None if before is None or after is None else after - before
+
+
+class Profiler(object):
+    """
+    A record of the stages run while profiling is enabled.
+
+    Each record is a dictionary of the stage name, the enclosing stage
+    (parent), the process it ran in (pid), the start time in seconds since
+    the profiler was created, the wall time, the time not spent in nested
+    stages (self), the bytes read, the change of the RSS (rss_delta), the
+    growth of the peak RSS (peak_delta) and the tags given to the stage
+    (e.g. the snapshot or ray).
+    """
+
+    FIELDS = ("stage", "parent", "pid", "start", "wall", "self",
+              "bytes_read", "rss_delta", "peak_delta", "tags")
+
+    def __init__(self):
+        self.records = []
+        self._start = time.perf_counter()
+        self._local = threading.local()
+
+    def stage(self, name, **tags):
+        """
+        A context manager that records one run of a stage.
+        """
+        return _Stage(self, name, tags)
+
+    def summary(self):
+        """
+        The totals of each stage.
+
+        Returns
+        -------
+        summary : dict
+
+            For each stage name: the number of runs (count), the total wall
+            and self time, the total bytes read, the largest rss_delta of
+            a run and the total peak_delta.
+        """
+        summary = {}
+        for record in self.records:
+            stats = summary.setdefault(record["stage"], {
+                "count": 0, "wall": 0.0, "self": 0.0, "bytes_read": None,
+                "rss_delta": None, "peak_delta": None})
+            stats["count"] += 1
+            stats["wall"] += record["wall"]
+            stats["self"] += record["self"]
+            if record["bytes_read"] is not None:
+                stats["bytes_read"] = ((stats["bytes_read"] or 0) +
+                                       record["bytes_read"])
+            if record["rss_delta"] is not None:
+                stats["rss_delta"] = max(record["rss_delta"],
+                                         stats["rss_delta"]
+                                         if stats["rss_delta"] is not None
+                                         else record["rss_delta"])
+            if record["peak_delta"] is not None:
+                stats["peak_delta"] = ((stats["peak_delta"] or 0) +
+                                       record["peak_delta"])
+        return summary
+
+    def dominant_stage(self):
+        """
+        The name of the stage with the largest self time, or None if
+        nothing has been recorded.
+        """
+        summary = self.summary()
+        if not summary:
+            return None
+        return max(summary, key=lambda name: summary[name]["self"])
+
+    def report(self):
+        """
+        A table of the stages ordered by their self time, naming the
+        dominant stage.
+        """
+        summary = self.summary()
+        if not summary:
+            return "No stages recorded"
+
+        total = sum(stats["self"] for stats in summary.values())
+        lines = ["{0:<20} {1:>7} {2:>10} {3:>10} {4:>6} {5:>10} {6:>10} "
+                 "{7:>10}".format("stage", "count", "wall (s)", "self (s)",
+                                  "%", "read (MB)", "RSS +(MB)",
+                                  "peak +(MB)")]
+        for name in sorted(summary, key=lambda name: -summary[name]["self"]):
+            stats = summary[name]
+            lines.append(
+                "{0:<20} {1:>7d} {2:>10.3f} {3:>10.3f} {4:>6.1f} {5:>10} "
+                "{6:>10} {7:>10}".format(
+                    name, stats["count"], stats["wall"], stats["self"],
+                    100 * stats["self"] / total if total else 0.0,
+                    _megabytes(stats["bytes_read"]),
+                    _megabytes(stats["rss_delta"]),
+                    _megabytes(stats["peak_delta"])))
+
+        dominant = self.dominant_stage()
+        lines.append("Dominant stage: {0} ({1:.1f}% of the profiled time)"
+                     .format(dominant, 100 * summary[dominant]["self"] / total
+                             if total else 0.0))
+        return "\n".join(lines)
+
+    def save(self, filename):
+        """
+        Write the records to a CSV file (if filename ends in .csv) or a
+        JSON file with the records and the summary.
+        """
+        if filename.endswith(".csv"):
+            with open(filename, "w") as f:
+                writer = csv.DictWriter(f, fieldnames=self.FIELDS)
+                writer.writeheader()
+                for record in self.records:
+                    row = dict(record)
+                    row["tags"] = json.dumps(record["tags"], default=str)
+                    writer.writerow(row)
+        else:
+            with open(filename, "w") as f:
+                json.dump({"records": self.records,
+                           "summary": self.summary(),
+                           "dominant_stage": self.dominant_stage()},
+                          f, indent=1, default=str)
+
+
+class _Stage(object):
+    """
+    One run of a stage, recorded by its profiler on exit.
+    """
+
+    def __init__(self, profiler, name, tags):
+        self.profiler = profiler
+        self.name = name
+        self.tags = tags
+
+    def __enter__(self):
+        stack = self.profiler._local.__dict__.setdefault("stack", [])
+        self.parent = stack[-1] if stack else None
+        stack.append(self)
+        self.nested = 0.0
+        self.bytes_read = _bytes_read()
+        self.rss = _rss()
+        self.peak_rss = _peak_rss()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        wall = time.perf_counter() - self.start
+        bytes_read = _bytes_read()
+        self.profiler._local.stack.pop()
+        if self.parent is not None:
+            self.parent.nested += wall
+
+        self.profiler.records.append({
+            "stage": self.name,
+            "parent": None if self.parent is None else self.parent.name,
+            "pid": os.getpid(),
+            "start": self.start - self.profiler._start,
+            "wall": wall,
+            "self": wall - self.nested,
+            "bytes_read": _delta(self.bytes_read, bytes_read),
+            "rss_delta": _delta(self.rss, _rss()),
+            "peak_delta": _delta(self.peak_rss, _peak_rss()),
+            "tags": self.tags,
+        })
+        return False
+
+
+class _NoStage(object):
+    """
+    The stage used while profiling is disabled.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NO_STAGE = _NoStage()
+
+_profiler = None
+
+
+def _megabytes(nbytes):
+    return "-" if nbytes is None else "{0:.1f}".format(nbytes / 1024**2)
+
+
+def stage(name, **tags):
+    """
+    A context manager that records one run of a stage if profiling is
+    enabled.
+
+    Parameters
+    ----------
+    name : string
+
+        The name of the stage, e.g. 'read' or 'make_simple_ray'.
+
+    **tags
+
+        Extra information saved with the record, e.g. snapshot=snap_file.
+    """
+    if _profiler is None:
+        return _NO_STAGE
+    return _profiler.stage(name, **tags)
+
+
+class _WorkerTask(object):
+    """
+    Run a task in a worker process and return its result together with the
+    records of the stages it ran there.
+    """
+
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, args):
+        result = self.func(args)
+        if _profiler is None:
+            return result, []
+
+        #  A forked worker inherits the records of its parent, so only
+        #  hand back those of this process
+        pid = os.getpid()
+        records = [r for r in _profiler.records if r["pid"] == pid]
+        _profiler.records = [r for r in _profiler.records if r["pid"] != pid]
+        return result, records
+
+
+def merge(records):
+    """
+    Add the records of stages run in another process to the profiler.
+    """
+    if _profiler is not None:
+        _profiler.records.extend(records)
+
+
+def imap(pool, func, tasks, ordered=False, chunksize=1):
+    """
+    Map func over tasks in a multiprocessing pool like pool.imap_unordered
+    (or pool.imap if ordered), merging the stages recorded in the workers
+    into the profiler as the results arrive.
+    """
+    method = pool.imap if ordered else pool.imap_unordered
+    for result, records in method(_WorkerTask(func), tasks,
+                                  chunksize=chunksize):
+        merge(records)
+        yield result
+
+
+def enable(profiler=None):
+    """
+    Start recording stages with profiler (a new Profiler by default) and
+    return it.
+    """
+    global _profiler
+    _profiler = Profiler() if profiler is None else profiler
+    return _profiler
+
+
+def disable():
+    """
+    Stop recording stages and return the profiler that recorded them.
+    """
+    global _profiler
+    profiler, _profiler = _profiler, None
+    return profiler
+
+
+class profile(object):
+    """
+    Record the stages run inside a with block.
+
+    Parameters
+    ----------
+    filename : string, optional
+
+        If given, the trace is saved to this JSON or CSV file at the end
+        of the block. Default: None
+    """
+
+    def __init__(self, filename=None):
+        self.filename = filename
+
+    def __enter__(self):
+        self.previous = _profiler
+        return enable()
+
+    def __exit__(self, *exc_info):
+        profiler = disable()
+        if self.previous is not None:
+            enable(self.previous)
+        if self.filename is not None:
+            profiler.save(self.filename)
+        return False
+
+
+def _write_trace(filename):
+    profiler = disable()
+    if profiler is not None and profiler.records:
+        profiler.save(filename)
+        print(profiler.report(), file=sys.stderr)
+
+
+if os.environ.get("TOPAZ_PROFILE"):
+    enable()
+    atexit.register(_write_trace, os.environ["TOPAZ_PROFILE"])
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+"""
+Find ray files, draw unique sightline coordinates and find the axis and
+starting position of each ray.
+"""
+from __future__ import print_function, division
+
+import os
+import re
+import glob
+
+import numpy as np
+
+
+#  A ray is written to <name>.part.h5 and renamed when complete
+PART_SUFFIX = ".part.h5"
+
+
+def ray_files(rays):
+    """
+    Expand a directory, glob pattern or list of ray files into a sorted
+    list of filenames.
+
+    Partial rays left by an interrupted campaign (*.part.h5) are skipped.
+    """
+    if not isinstance(rays, str):
+        return list(rays)
+    if os.path.isdir(rays):
+        files = glob.glob(os.path.join(rays, "*.h5"))
+    else:
+        files = glob.glob(rays)
+    return sorted(f for f in files if not f.endswith(PART_SUFFIX))
+
+
+def ray_coordinates(n, width, seed, decimals=2):
+    """
+    Draw the coordinates of n unique sightlines in one vectorised draw.
+
+    The coordinates are rounded to the given number of decimals, as they
+    appear in the ray filenames. Duplicates are removed and replaced with
+    new draws, so every sightline has its own file.
+
+    Parameters
+    ----------
+    n : integer
+
+        The number of sightlines.
+
+    width : float
+
+        The width of the box in code length units.
+
+    seed : integer
+
+        The seed of the random number generator.
+
+    decimals : integer, optional
+
+        The number of decimals the coordinates are rounded to. Default: 2
+
+    Returns
+    -------
+    coords : numpy.ndarray, shape (n, 2)
+
+        The coordinates of each sightline in the plane perpendicular to
+        its axis.
+    """
+    if n > (round(width * 10**decimals) + 1)**2:
+        raise ValueError("Can not draw {0} unique sightlines with {1} "
+                         "decimals".format(n, decimals))
+
+    rng = np.random.RandomState(seed)
+    coords = np.empty((0, 2))
+
+    while len(coords) < n:
+        draw = rng.uniform(low=0.0, high=1.0, size=(n - len(coords), 2))
+        coords = np.concatenate([coords, np.round(draw * width, decimals)])
+        _, first = np.unique(coords, axis=0, return_index=True)
+        coords = coords[np.sort(first)]
+
+    return coords
+
+
+def ray_info(ray, data=None):
+    """
+    Find the axis and starting position of a ray.
+
+    Rays written by sphray store these as attributes. For the trident rays
+    written by rays.random_ray they are parsed from the filename.
+
+    Parameters
+    ----------
+    ray : string
+
+        The filename of the ray.
+
+    data : h5py.File, optional
+
+        The open ray file. If None, only the filename is used.
+
+    Returns
+    -------
+    axis : string
+
+        The axis of the ray, or '' if it could not be determined.
+
+    start : numpy.ndarray
+
+        The (x, y, z) starting position of the ray in code length units.
+        NaN if it could not be determined.
+    """
+    if data is not None and "axis" in data.attrs:
+        axis = data.attrs["axis"]
+        if isinstance(axis, bytes):
+            axis = axis.decode()
+        return axis, np.array(data.attrs["ray_start"], dtype=np.float64)
+
+    match = re.search(r"_([xyz])axis_([xyz])([-\d.]+)_([xyz])([-\d.]+)\.h5$",
+                      os.path.basename(ray))
+    if match is None:
+        return "", np.full(3, np.nan)
+
+    axis = match.group(1)
+    start = dict([("x", 0.0), ("y", 0.0), ("z", 0.0),
+                  (match.group(2), float(match.group(3))),
+                  (match.group(4), float(match.group(5)))])
+    start[axis] = 0.0
+    return axis, np.array([start["x"], start["y"], start["z"]])
@@ -1,11 +1,20 @@
 #!/usr/bin/env python
 from __future__ import print_function, division
 
+import os
+import json
+import multiprocessing
+
 import numpy as np
+import h5py
 from tqdm import tqdm
 import trident
 import yt
 
+from . import profiling
+from .profiling import stage
+from .rayfiles import ray_coordinates, PART_SUFFIX
+
 #yt.mylog.disabled = True
 yt.funcs.mylog.setLevel(50)
 
@@ -62,89 +71,173 @@ def make_ray(dataset_file, ray_start, ray_end, line_list=["H I", "H II"],
         return_ray = False: Returns None
     """
 
-    # If supplied a path name, load the snapshot first
-    if isinstance(dataset_file, str):
-        ds = yt.load(dataset_file)
-    else:
-        ds = dataset_file
+    factory = RayFactory(dataset_file, field_list=field_list)
+    return factory.make_ray(ray_start, ray_end, line_list=line_list,
+                            filename=filename, return_ray=return_ray,
+                            **kwargs)
 
-    if field_list is None:
-        field_list = []
 
-    field_list.extend([('PartType0', 'SmoothingLength'),
-                       ('PartType0', 'ParticleIDs')])
+#  The particle fields always added to the rays
+RAY_FIELDS = (('PartType0', 'SmoothingLength'),
+              ('PartType0', 'ParticleIDs'))
 
-    trident.add_ion_fields(ds, ions=line_list)
 
-    ray = trident.make_simple_ray(ds,
-                                  start_position=ray_start,
-                                  end_position=ray_end,
-                                  lines=line_list,
-                                  ftype='PartType0',
-                                  fields=field_list,
-                                  data_filename=filename,
-                                  **kwargs)
-    if return_ray:
-        return ray
-    else:
-        return None
+class RayFactory(object):
+    """
+    Make many rays from one dataset.
 
+    The dataset is loaded once and the trident ion fields are registered
+    once for each unique line list, so each ray only pays for
+    trident.make_simple_ray.
 
-def random_ray(dataset_file, output_data_dir="", axis="z",
-               ray_prefix="Ray", return_ray=False):
-    """
-    Generate a ray with a random start and end point.
+    Parameters
+    ----------
+    dataset_file : string or YT Dataset object
 
-    """
-    if isinstance(dataset_file, str):
-        ds = yt.load(dataset_file)
-    else:
-        ds = dataset_file
+        Either a YT dataset object or the filename of a dataset on disk.
 
-    width = ds.parameters['BoxSize']
+    field_list : list of string, optional
 
-    #  Generate 2 random numbers for the coordinates of the rays
-    rand_0 = round(np.random.uniform(low=0.0, high=1.0) * width, 2)
-    rand_1 = round(np.random.uniform(low=0.0, high=1.0) * width, 2)
+        The list of which additional fields to add to every ray.
+        Default: None
+    """
 
+    def __init__(self, dataset_file, field_list=None):
+        # If supplied a path name, load the snapshot first
+        if isinstance(dataset_file, str):
+            with stage("yt.load", dataset=dataset_file):
+                self.ds = yt.load(dataset_file)
+        else:
+            self.ds = dataset_file
+
+        fields = []
+        for field in list(field_list or []) + list(RAY_FIELDS):
+            if field not in fields:
+                fields.append(field)
+        self.field_list = tuple(fields)
+
+        self._ion_lines = set()
+
+    def add_ion_fields(self, line_list):
+        """
+        Register the trident ion fields of a line list with the dataset,
+        unless they have already been registered.
+        """
+        key = frozenset(line_list)
+        if key not in self._ion_lines:
+            with stage("add_ion_fields", lines=list(line_list)):
+                trident.add_ion_fields(self.ds, ions=list(line_list))
+            self._ion_lines.add(key)
+
+    def make_ray(self, ray_start, ray_end, line_list=["H I", "H II"],
+                 filename="ray.h5", return_ray=False, **kwargs):
+        """
+        Make a ray with trident.make_simple_ray. See rays.make_ray.
+        """
+        self.add_ion_fields(line_list)
+
+        with stage("make_simple_ray", ray=filename):
+            ray = trident.make_simple_ray(self.ds,
+                                          start_position=ray_start,
+                                          end_position=ray_end,
+                                          lines=list(line_list),
+                                          ftype='PartType0',
+                                          fields=list(self.field_list),
+                                          data_filename=filename,
+                                          **kwargs)
+        if return_ray:
+            return ray
+        else:
+            return None
+
+
+#  The lines added to the random rays
+RAY_LINE_LIST = ["H", "He"]
+
+
+def _ray_endpoints(axis, rand_0, rand_1, width):
+    """
+    The start and end points of a ray along an axis through the whole box.
+    """
     #  Generate starting and end point for the rays
     if axis == "x":
         xi, yi, zi = 0.00, rand_0, rand_1
         xf, yf, zf = round(width, 2), rand_0, rand_1
-        ray_start = [xi, yi, zi]
-        ray_end = [xf, yf, zf]
 
     elif axis == "y":
         xi, yi, zi = rand_0, 0.00, rand_1
         xf, yf, zf = rand_0, round(width, 2), rand_1
-        ray_start = [xi, yi, zi]
-        ray_end = [xf, yf, zf]
 
     elif axis == "z":
         xi, yi, zi = rand_0, rand_1, 0.00
         xf, yf, zf = rand_0, rand_1, round(width, 2)
-        ray_start = [xi, yi, zi]
-        ray_end = [xf, yf, zf]
 
-    #line_list = ["H I", "H II", "He I", "He II", "He III"]
+    return [xi, yi, zi], [xf, yf, zf]
 
-    line_list = ["H", "He"]
 
+def _ray_filename(output_data_dir, ray_prefix, line_list, axis,
+                  rand_0, rand_1):
+    """
+    The filename of a ray, e.g. Ray_H_He_zaxis_x1.23_y4.56.h5
+    """
     #  Determine which two axis to add to filename
     xyz = ["x", "y", "z"]
     xyz.remove(axis)
 
-    filename = "{0}/{1}_{2}_{3}_{4}.h5".format(
+    return "{0}/{1}_{2}_{3}_{4}.h5".format(
         output_data_dir, ray_prefix, "_".join(line_list), axis + "axis",
         "_".join(["{0}{1}".format(xyz[0], rand_0),
         "{0}{1}".format(xyz[1], rand_1)]))
-                                       
-    ray = make_ray(ds, 
-                   ray_start=ray_start,
-                   ray_end=ray_end,
-                   line_list=line_list,
-                   filename=filename, 
-                   return_ray=return_ray)
+
+
+def random_ray(dataset_file, output_data_dir="", axis="z",
+               ray_prefix="Ray", return_ray=False, seed=None):
+    """
+    Generate a ray with a random start and end point.
+
+    Parameters
+    ----------
+    dataset_file : string, YT Dataset object or RayFactory
+
+        Either a YT dataset object, the filename of a dataset on disk, or a
+        RayFactory to reuse between rays.
+
+    seed : integer, optional
+
+        Seed for the random coordinates of this ray. If None, the global
+        numpy random state is used. Default: None
+
+    """
+    if isinstance(dataset_file, RayFactory):
+        factory = dataset_file
+    else:
+        factory = RayFactory(dataset_file)
+
+    if seed is None:
+        rng = np.random
+    else:
+        rng = np.random.RandomState(seed)
+
+    width = factory.ds.parameters['BoxSize']
+
+    #  Generate 2 random numbers for the coordinates of the rays
+    rand_0 = round(rng.uniform(low=0.0, high=1.0) * width, 2)
+    rand_1 = round(rng.uniform(low=0.0, high=1.0) * width, 2)
+
+    ray_start, ray_end = _ray_endpoints(axis, rand_0, rand_1, width)
+
+    #line_list = ["H I", "H II", "He I", "He II", "He III"]
+
+    line_list = RAY_LINE_LIST
+
+    filename = _ray_filename(output_data_dir, ray_prefix, line_list, axis,
+                             rand_0, rand_1)
+
+    ray = factory.make_ray(ray_start=ray_start,
+                           ray_end=ray_end,
+                           line_list=line_list,
+                           filename=filename,
+                           return_ray=return_ray)
     
     if return_ray:
         return ray
@@ -152,12 +245,46 @@ def random_ray(dataset_file, output_data_dir="", axis="z",
         return None
   
   
+#  The ray factory of each worker process of make_n_random_rays
+_worker_factory = None
+
+
+def _init_worker(dataset_file):
+    """
+    Load and index the dataset once in a worker process.
+    """
+    global _worker_factory
+    yt.funcs.mylog.setLevel(50)
+    _worker_factory = RayFactory(dataset_file)
+    _worker_factory.ds.index
+
+
+def _dataset_filename(dataset_file):
+    """
+    The filename of a dataset given as a filename, YT dataset or RayFactory.
+    """
+    if isinstance(dataset_file, RayFactory):
+        dataset_file = dataset_file.ds
+    if not isinstance(dataset_file, str):
+        dataset_file = dataset_file.parameter_filename
+    return dataset_file
+
+
+def _worker_random_ray(args):
+    output_data_dir, axis, ray_prefix, seed = args
+    random_ray(_worker_factory, output_data_dir, axis=axis,
+               ray_prefix=ray_prefix, return_ray=False, seed=seed)
+
+
 def make_n_random_rays(dataset_file, n, output_data_dir, ray_prefix="Ray",
-                       verbose=False):
+                       axis="z", nproc=1, verbose=False):
 
     """
     Generate n random rays with the rays.random_ray function.
 
+    The dataset is loaded and indexed once (once per worker when
+    nproc > 1) and reused for every ray.
+
     Parameters
     ----------
     dataset_file : string or YT Dataset object
@@ -178,16 +305,238 @@ def make_n_random_rays(dataset_file, n, output_data_dir, ray_prefix="Ray",
         The ray_prefix will becone the first part of the filename when the 
         rays are saved. Default: 'Ray'
 
+    axis : {'x', 'y', 'z'}, optional
+
+        The axis the rays travel along. Default: 'z'
+
+    nproc : optional, integer
+
+        The number of worker processes used to generate the rays. Each
+        worker loads its own copy of the dataset. If None, use all
+        available cores. Default: 1
+
     verbose : optional, boolean
         Default: False
     """
 
-    for i in tqdm(range(n), desc="Generating Random Ray"):
-        random_ray(dataset_file, 
-                   output_data_dir, 
-                   ray_prefix="Ray_Aurora_L012N0128",
-                   return_ray=False)
+    if nproc is None:
+        nproc = multiprocessing.cpu_count()
+
+    if nproc == 1:
+        if isinstance(dataset_file, RayFactory):
+            factory = dataset_file
+        else:
+            factory = RayFactory(dataset_file)
+        factory.ds.index
+
+        for i in tqdm(range(n), desc="Generating Random Ray",
+                      disable=not verbose):
+            random_ray(factory,
+                       output_data_dir,
+                       axis=axis,
+                       ray_prefix=ray_prefix,
+                       return_ray=False)
+        return None
+
+    #  Workers load the dataset from disk themselves
+    dataset_file = _dataset_filename(dataset_file)
+
+    #  Each ray gets its own seed so forked workers do not share a
+    #  random state and produce the same coordinates.
+    seeds = np.random.randint(0, 2**31 - 1, size=n)
+    tasks = [(output_data_dir, axis, ray_prefix, seed) for seed in seeds]
+
+    pool = multiprocessing.Pool(nproc, initializer=_init_worker,
+                                initargs=(dataset_file,))
+    try:
+        for _ in tqdm(profiling.imap(pool, _worker_random_ray, tasks),
+                      total=n, desc="Generating Random Ray",
+                      disable=not verbose):
+            pass
+    finally:
+        pool.close()
+        pool.join()
 
     return None
 
-        
+
+def valid_ray(filename):
+    """
+    Check that a ray file exists and contains the ray data.
+    """
+    if not os.path.isfile(filename):
+        return False
+    try:
+        with h5py.File(filename, "r") as f:
+            return "grid" in f and "dl" in f["grid"]
+    except (IOError, OSError):
+        return False
+
+
+def _campaign_manifest(manifest_file, dataset_file, n, output_data_dir,
+                       seed, axis, ray_prefix):
+    """
+    Load the manifest of a ray campaign, or create it if it does not exist.
+    """
+    #  numpy integers can not be written to JSON
+    n = int(n)
+    seed = None if seed is None else int(seed)
+
+    if os.path.isfile(manifest_file):
+        with open(manifest_file, "r") as f:
+            manifest = json.load(f)
+
+        for key, value in [("n", n), ("seed", seed), ("axis", axis),
+                           ("ray_prefix", ray_prefix)]:
+            if manifest[key] != value:
+                raise ValueError("The manifest {0} was created with {1}={2}, "
+                                 "not {3}".format(manifest_file, key,
+                                                  manifest[key], value))
+        return manifest
+
+    if isinstance(dataset_file, RayFactory):
+        ds = dataset_file.ds
+    elif isinstance(dataset_file, str):
+        with stage("yt.load", dataset=dataset_file):
+            ds = yt.load(dataset_file)
+    else:
+        ds = dataset_file
+    width = float(ds.parameters['BoxSize'])
+
+    rays = []
+    for i, (rand_0, rand_1) in enumerate(ray_coordinates(n, width, seed)):
+        ray_start, ray_end = _ray_endpoints(axis, rand_0, rand_1, width)
+        rays.append({
+            "index": i,
+            "ray_start": [float(x) for x in ray_start],
+            "ray_end": [float(x) for x in ray_end],
+            "filename": _ray_filename(output_data_dir, ray_prefix,
+                                      RAY_LINE_LIST, axis, rand_0, rand_1),
+        })
+
+    manifest = {"n": n, "seed": seed, "axis": axis,
+                "ray_prefix": ray_prefix, "line_list": RAY_LINE_LIST,
+                "rays": rays}
+
+    with open(manifest_file + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(manifest_file + ".tmp", manifest_file)
+
+    return manifest
+
+
+def _part_filename(filename):
+    return filename[:-len(".h5")] + PART_SUFFIX
+
+
+def _campaign_ray(factory, ray):
+    """
+    Make one ray of a campaign. The ray is written to a temporary file and
+    renamed when complete, so an interrupted ray is never seen as valid.
+
+    yt adds .h5 to any filename that does not end with it, so the temporary
+    file ends with .part.h5. rayfiles.ray_files skips these files.
+    """
+    tmp_filename = _part_filename(ray["filename"])
+    factory.make_ray(ray_start=ray["ray_start"],
+                     ray_end=ray["ray_end"],
+                     line_list=RAY_LINE_LIST,
+                     filename=tmp_filename)
+    os.replace(tmp_filename, ray["filename"])
+
+
+def _worker_campaign_ray(ray):
+    _campaign_ray(_worker_factory, ray)
+
+
+def ray_campaign(dataset_file, n, output_data_dir, seed, axis="z",
+                 ray_prefix="Ray", nproc=1, verbose=False):
+    """
+    Generate n random rays reproducibly, resuming an interrupted campaign.
+
+    All the sightline coordinates are drawn up front from the seed and
+    recorded in a manifest (<ray_prefix>_manifest.json in output_data_dir).
+    When the campaign is run again, rays whose output file already exists
+    and is valid are skipped, and partial files left by interrupted rays
+    are removed.
+
+    Parameters
+    ----------
+    dataset_file : string or YT Dataset object
+
+        Either a YT dataset object or the filename of a dataset on disk.
+
+    n : integer
+
+        The number of random rays to generate.
+
+    output_data_dir : string
+
+        The location on disk where the rays and the manifest are saved.
+
+    seed : integer
+
+        The seed used to draw the coordinates of the rays.
+
+    axis : {'x', 'y', 'z'}, optional
+
+        The axis the rays travel along. Default: 'z'
+
+    ray_prefix : optional, string
+
+        The first part of the filename of each ray. Default: 'Ray'
+
+    nproc : optional, integer
+
+        The number of worker processes used to generate the rays. If None,
+        use all available cores. Default: 1
+
+    verbose : optional, boolean
+
+        If True, print progress information. Default: False
+
+    Returns
+    -------
+    manifest_file : string
+
+        The filename of the campaign manifest.
+    """
+    if nproc is None:
+        nproc = multiprocessing.cpu_count()
+
+    if nproc == 1 and not isinstance(dataset_file, RayFactory):
+        dataset_file = RayFactory(dataset_file)
+
+    manifest_file = os.path.join(output_data_dir,
+                                 "{0}_manifest.json".format(ray_prefix))
+    manifest = _campaign_manifest(manifest_file, dataset_file, n,
+                                  output_data_dir, seed, axis, ray_prefix)
+
+    todo = [ray for ray in manifest["rays"] if not valid_ray(ray["filename"])]
+    for ray in todo:
+        tmp_filename = _part_filename(ray["filename"])
+        if os.path.isfile(tmp_filename):
+            os.remove(tmp_filename)
+    if verbose:
+        print("{0} of {1} rays already done".format(n - len(todo), n))
+
+    if nproc == 1:
+        for ray in tqdm(todo, desc="Generating Random Ray",
+                        disable=not verbose):
+            _campaign_ray(dataset_file, ray)
+        return manifest_file
+
+    dataset_file = _dataset_filename(dataset_file)
+
+    pool = multiprocessing.Pool(nproc, initializer=_init_worker,
+                                initargs=(dataset_file,))
+    try:
+        for _ in tqdm(profiling.imap(pool, _worker_campaign_ray, todo),
+                      total=len(todo), desc="Generating Random Ray",
+                      disable=not verbose):
+            pass
+    finally:
+        pool.close()
+        pool.join()
+
+    return manifest_file
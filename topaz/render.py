@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+"""
+Multi-channel SPH image rendering with numpy.
+
+The kernel of each particle is evaluated once per pixel it covers, and the
+result is deposited into the images of every requested quantity, so
+several maps cost about the same as one.
+"""
+from __future__ import print_function, division
+
+import numpy as np
+
+from .sphray import cubic_spline, projected_kernel
+
+#  The maximum number of (particle, pixel) pairs evaluated at a time
+PAIR_CHUNK = 2**22
+
+
+def _pixel_grid(width, resolution, center):
+    """
+    The lower left corner and pixel size of the image.
+    """
+    dx = width / resolution
+    x0 = center[0] - width / 2
+    y0 = center[1] - width / 2
+    return x0, y0, dx
+
+
+def periodic_images(pos, hsml, boxsize, center, axes=(0, 1)):
+    """
+    Wrap the particles of a periodic box into the box centred on center,
+    and add copies, shifted by the box size, of the particles whose kernels
+    cross its faces so that no kernel is cut off at the edges.
+
+    Parameters
+    ----------
+    pos : numpy.ndarray, shape (n, 3)
+
+        The particle positions.
+
+    hsml : numpy.ndarray
+
+        The radius of the compact support of each particle's kernel.
+
+    boxsize : float
+
+        The size of the periodic box.
+
+    center : tuple of floats
+
+        The center of the wrapped box along each of the axes.
+
+    axes : tuple of integers, optional
+
+        The periodic axes to wrap, e.g. (0, 1) for a projection along z.
+        Default: (0, 1)
+
+    Returns
+    -------
+    pos : numpy.ndarray
+
+        The positions of the wrapped particles followed by their copies.
+
+    index : numpy.ndarray
+
+        The index of the original particle of each position.
+    """
+    pos = np.array(pos, dtype=np.float64)
+    hsml = np.asarray(hsml, dtype=np.float64)
+    index = np.arange(len(pos))
+
+    #  Wrapping one axis at a time also copies the copies, which covers
+    #  kernels that cross a corner
+    for axis in axes:
+        low = center[axis] - boxsize / 2
+        pos[:, axis] = low + np.mod(pos[:, axis] - low, boxsize)
+
+        near_low = np.nonzero(pos[:, axis] - hsml[index] < low)[0]
+        near_high = np.nonzero(pos[:, axis] + hsml[index] >
+                               low + boxsize)[0]
+        above = pos[near_low]
+        above[:, axis] += boxsize
+        below = pos[near_high]
+        below[:, axis] -= boxsize
+
+        pos = np.concatenate([pos, above, below])
+        index = np.concatenate([index, index[near_low], index[near_high]])
+
+    return pos, index
+
+
+def render_images(pos, hsml, quantities, width, resolution=500,
+                  center=(0.0, 0.0), kind="slice", z_slice=0.0,
+                  volume=None, average=None):
+    """
+    Render images of several SPH quantities in one kernel pass.
+
+    Each image is sum_i q_i V_i W(r - r_i, h_i), where V_i is the particle
+    volume m_i / rho_i and W is the cubic spline kernel (projected along z
+    for kind='proj'). A quantity of rho therefore gives the density (or
+    surface density). The images of the quantities in average are divided
+    by sum_i V_i W(r - r_i, h_i), which gives the kernel-weighted mean
+    (along the line of sight for a projection) of quantities such as
+    abundance ratios whose projection would otherwise be an integral.
+
+    Parameters
+    ----------
+    pos : numpy.ndarray, shape (n, 3)
+
+        The particle positions. The image is in the x-y plane.
+
+    hsml : numpy.ndarray
+
+        The radius of the compact support of each particle's kernel, in
+        the same units as pos.
+
+    quantities : dict
+
+        The per-particle value of each quantity to render, keyed by name.
+
+    width : float
+
+        The width of the image in the units of pos.
+
+    resolution : integer, optional
+
+        The number of pixels along each side of the image. Default: 500
+
+    center : tuple of floats, optional
+
+        The (x, y) center of the image. Default: (0, 0)
+
+    kind : {'slice', 'proj'}, optional
+
+        Render a slice at z = z_slice, or a projection along z.
+        Default: 'slice'
+
+    z_slice : float, optional
+
+        The z position of the slice. Default: 0
+
+    volume : numpy.ndarray, optional
+
+        The volume of each particle, m / rho. Default: None (unit volume)
+
+    average : list of strings, optional
+
+        The quantities to render as kernel-weighted means. Pixels that no
+        kernel covers are 0. Default: None
+
+    Returns
+    -------
+    images : dict
+
+        The (resolution, resolution) image of each quantity, indexed as
+        image[y, x].
+    """
+    pos = np.asarray(pos, dtype=np.float64)
+    hsml = np.asarray(hsml, dtype=np.float64)
+    x0, y0, dx = _pixel_grid(width, resolution, center)
+
+    #  Make the footprint of every kernel in the image plane cover at least
+    #  one pixel so no particle is lost. Along z (for slices) the kernel
+    #  keeps its true support.
+    hplane = np.maximum(hsml, dx)
+
+    select = ((pos[:, 0] + hplane > x0) & (pos[:, 0] - hplane < x0 + width) &
+              (pos[:, 1] + hplane > y0) & (pos[:, 1] - hplane < y0 + width))
+    if kind == "slice":
+        select &= np.abs(pos[:, 2] - z_slice) < hsml
+    elif kind != "proj":
+        raise ValueError("Unknown kind of image: {0}".format(kind))
+
+    index = np.nonzero(select)[0]
+    names = list(quantities)
+    average = [] if average is None else list(average)
+    columns = [np.asarray(quantities[name])[index] for name in names]
+
+    #  The weight sum_i V_i W is rendered as one more channel in the same
+    #  pass
+    if average:
+        columns.append(np.ones(len(index)))
+    coefficients = np.empty((len(columns), len(index)))
+    for j, column in enumerate(columns):
+        coefficients[j] = column
+    if volume is not None:
+        coefficients *= np.asarray(volume)[index]
+
+    pos, hsml, hplane = pos[index], hsml[index], hplane[index]
+    images = np.zeros((len(columns), resolution * resolution))
+
+    #  Group the particles by the number of pixels their kernels span
+    radius = np.ceil(hplane / dx).astype(np.int64)
+    for r in np.unique(radius):
+        group = np.nonzero(radius == r)[0]
+        offsets = np.arange(-r, r + 1)
+        ox, oy = [o.ravel() for o in np.meshgrid(offsets, offsets)]
+        step = max(1, PAIR_CHUNK // len(ox))
+
+        for first in range(0, len(group), step):
+            part = group[first:first + step]
+            h = hplane[part][:, None]
+            ix = np.floor((pos[part, 0] - x0) / dx).astype(np.int64)[:, None]
+            iy = np.floor((pos[part, 1] - y0) / dx).astype(np.int64)[:, None]
+            px = ix + ox[None, :]
+            py = iy + oy[None, :]
+
+            #  Distance from each particle to the pixel centers
+            dxp = x0 + (px + 0.5) * dx - pos[part, 0][:, None]
+            dyp = y0 + (py + 0.5) * dx - pos[part, 1][:, None]
+            if kind == "slice":
+                #  A kernel stretched in the plane to the footprint h and
+                #  of the true support hz along z, still normalised to 1
+                hz = hsml[part][:, None]
+                dz = (pos[part, 2] - z_slice)[:, None]
+                q = np.sqrt((dxp**2 + dyp**2) / h**2 + dz**2 / hz**2)
+                kernel = cubic_spline(q) / (h**2 * hz)
+            else:
+                q = np.sqrt(dxp**2 + dyp**2) / h
+                kernel = projected_kernel(q) / h**2
+
+            inside = ((px >= 0) & (px < resolution) &
+                      (py >= 0) & (py < resolution) & (q < 1))
+            pixel = (py * resolution + px)[inside]
+            kernel = kernel[inside]
+            owner = np.broadcast_to(np.arange(len(part))[:, None],
+                                    q.shape)[inside]
+
+            for j in range(len(columns)):
+                images[j] += np.bincount(
+                    pixel, weights=kernel * coefficients[j, part][owner],
+                    minlength=resolution * resolution)
+
+    for name in average:
+        j = names.index(name)
+        images[j] = np.divide(images[j], images[-1],
+                              out=np.zeros_like(images[j]),
+                              where=images[-1] > 0)
+
+    return dict((name, images[j].reshape(resolution, resolution))
+                for j, name in enumerate(names))
@@ -0,0 +1,428 @@
+#!/usr/bin/env python
+"""
+A pure numpy SPH sightline integrator.
+
+This is a lightweight alternative to rays.make_ray for axis-aligned
+sightlines. The gas particles are read directly from the Gadget HDF5
+snapshot and the SPH kernel is integrated along many sightlines at once.
+The output rays use the same 'grid/dl' and 'grid/*_number_density' layout
+as the trident rays, so they can be used with analysis.calc_DM.
+"""
+from __future__ import print_function, division
+
+import os
+
+import numpy as np
+import h5py
+from tqdm import tqdm
+
+from . import archive
+from . import constants as c
+from .profiling import stage
+from . import gadget
+from .rayfiles import ray_coordinates
+
+#  The snapshot datasets used to calculate the species number densities
+GAS_FIELDS = {
+    "position": "Coordinates",
+    "hsml": "SmoothingLength",
+    "mass": "Mass",
+    "density": "Density",
+    "hydrogen": "ElementAbundance/Hydrogen",
+    "helium": "ElementAbundance/Helium",
+    "HI": "apHI",
+    "HeI": "apHeI",
+    "HeII": "apHeII",
+}
+
+SPECIES = ["H_p0", "H_p1", "He_p0", "He_p1", "He_p2"]
+
+AXES = {"x": 0, "y": 1, "z": 2}
+
+#  The largest number of cells along each side of the sightline index
+MAX_CELLS = 1024
+
+_KERNEL_TABLE_SIZE = 1025
+_kernel_table = None
+
+
+def cubic_spline(q):
+    """
+    The Gadget cubic spline kernel with compact support q = r / h <= 1.
+
+    The kernel is normalised so that the volume integral is 1 / h**3.
+    """
+    q = np.asarray(q, dtype=np.float64)
+    w = np.zeros_like(q)
+    inner = q <= 0.5
+    outer = (q > 0.5) & (q <= 1.0)
+    w[inner] = 1 - 6 * q[inner]**2 + 6 * q[inner]**3
+    w[outer] = 2 * (1 - q[outer])**3
+    return w * 8 / np.pi
+
+
+def projected_kernel(b):
+    """
+    The cubic spline kernel integrated along a line with impact parameter
+    b = r / h.
+
+    The result is in units of 1 / h**2. Values are interpolated from a
+    table that is built the first time this is called.
+    """
+    global _kernel_table
+    if _kernel_table is None:
+        bgrid = np.linspace(0, 1, _KERNEL_TABLE_SIZE)
+        s = np.linspace(0, 1, _KERNEL_TABLE_SIZE)
+        #  Half chord length through the kernel at each impact parameter
+        zmax = np.sqrt(1 - bgrid**2)
+        z = zmax[:, None] * s[None, :]
+        w = cubic_spline(np.sqrt(bgrid[:, None]**2 + z**2))
+        dz = zmax / (_KERNEL_TABLE_SIZE - 1)
+        integral = (w.sum(axis=1) - 0.5 * (w[:, 0] + w[:, -1])) * dz
+        _kernel_table = (bgrid, 2 * integral)
+
+    bgrid, table = _kernel_table
+    return np.interp(b, bgrid, table, right=0.0)
+
+
+def load_gas(snap_file):
+    """
+    Read the gas particles needed to integrate sightlines.
+
+    Parameters
+    ----------
+    snap_file : string
+
+        The path to the snapshot. See gadget.snapshot_files.
+
+    Returns
+    -------
+    gas : dict
+
+        A dictionary containing the particle positions and smoothing
+        lengths (code units), the conversion of code lengths to physical cm,
+        the box size (code units), the particle volumes (cm**3) and the
+        number density of each species (cm**-3).
+    """
+    header = gadget.read_header(snap_file)
+    fields = [GAS_FIELDS["position"], GAS_FIELDS["hsml"]]
+    raw = gadget.read_gas(snap_file, fields)
+    cgs = gadget.read_gas(snap_file, [GAS_FIELDS[key] for key in
+                                      ["mass", "density", "hydrogen",
+                                       "helium", "HI", "HeI", "HeII"]],
+                          cgs=True)
+
+    with h5py.File(gadget.snapshot_files(snap_file)[0], "r") as f:
+        length_to_cm = gadget.cgs_factor(
+            f["PartType0"][GAS_FIELDS["hsml"]], header)
+
+    density = cgs[GAS_FIELDS["density"]]
+    n_H = density * cgs[GAS_FIELDS["hydrogen"]] / c.M_P
+    n_He = density * cgs[GAS_FIELDS["helium"]] / c.M_HE
+    x_HI = cgs[GAS_FIELDS["HI"]]
+    x_HeI = cgs[GAS_FIELDS["HeI"]]
+    x_HeII = cgs[GAS_FIELDS["HeII"]]
+
+    gas = {
+        "position": raw[GAS_FIELDS["position"]],
+        "hsml": raw[GAS_FIELDS["hsml"]],
+        "length_to_cm": length_to_cm,
+        "boxsize": header["BoxSize"],
+        "volume": cgs[GAS_FIELDS["mass"]] / density,
+        "H_p0": n_H * x_HI,
+        "H_p1": n_H * (1 - x_HI),
+        "He_p0": n_He * x_HeI,
+        "He_p1": n_He * x_HeII,
+        "He_p2": n_He * np.clip(1 - x_HeI - x_HeII, 0, 1),
+    }
+    return gas
+
+
+class _CellIndex(object):
+    """
+    A uniform grid of cells over the plane perpendicular to the sightlines.
+
+    The cells are at least as wide as the largest smoothing length, so a
+    sightline only intersects particles in its own and the neighbouring
+    cells. The number of cells is capped at MAX_CELLS along each side and
+    at about one cell per particle, so small smoothing lengths in a large
+    box only make the cells fuller rather than the index larger.
+    """
+
+    def __init__(self, pos_2d, hsml, boxsize):
+        self.boxsize = boxsize
+        ncell = int(boxsize // max(np.max(hsml), boxsize * 1e-6))
+        ncell = min(ncell, MAX_CELLS, max(1, int(np.sqrt(len(hsml)))))
+        self.ncell = ncell if ncell >= 3 else 1
+
+        cell = self.cell_id(pos_2d)
+        self.order = np.argsort(cell, kind="stable")
+        bounds = np.searchsorted(cell[self.order],
+                                 np.arange(self.ncell**2 + 1))
+        self.starts = bounds[:-1]
+        self.counts = np.diff(bounds)
+
+    def cell_coords(self, pos_2d):
+        cell = np.floor(pos_2d / self.boxsize * self.ncell).astype(np.int64)
+        return cell % self.ncell
+
+    def cell_id(self, pos_2d):
+        cell = self.cell_coords(pos_2d)
+        return cell[:, 0] * self.ncell + cell[:, 1]
+
+    def candidates(self, coords):
+        """
+        Return the (ray, particle) index pairs of every particle in the
+        cells neighbouring each sightline.
+        """
+        cell = self.cell_coords(coords)
+        if self.ncell == 1:
+            offsets = [(0, 0)]
+        else:
+            offsets = [(i, j) for i in (-1, 0, 1) for j in (-1, 0, 1)]
+
+        rays, parts = [], []
+        for di, dj in offsets:
+            ncell = ((cell[:, 0] + di) % self.ncell * self.ncell +
+                     (cell[:, 1] + dj) % self.ncell)
+            counts = self.counts[ncell]
+            total = np.sum(counts)
+            if total == 0:
+                continue
+            ray_idx = np.repeat(np.arange(len(coords)), counts)
+            #  Position of each pair within its cell
+            first = np.cumsum(counts) - counts
+            local = np.arange(total) - np.repeat(first, counts)
+            rays.append(ray_idx)
+            parts.append(self.order[np.repeat(self.starts[ncell], counts) +
+                                    local])
+
+        if not rays:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+        return np.concatenate(rays), np.concatenate(parts)
+
+
+def integrate_sightlines(gas, coords, axis="z", chunk_size=256,
+                         verbose=False):
+    """
+    Integrate the SPH kernel along a batch of axis-aligned sightlines.
+
+    Parameters
+    ----------
+    gas : dict
+
+        The gas particles returned by load_gas.
+
+    coords : array_like, shape (n, 2)
+
+        The coordinates of each sightline in the plane perpendicular to
+        the axis, in code length units. For axis 'z' these are (x, y).
+
+    axis : {'x', 'y', 'z'}, optional
+
+        The axis the sightlines travel along. Default: 'z'
+
+    chunk_size : integer, optional
+
+        The number of sightlines integrated together. Larger chunks are
+        faster but use more memory. Default: 256
+
+    verbose : boolean, optional
+
+        If True, print progress information. Default: False
+
+    Yields
+    ------
+    ray : dict
+
+        For each sightline, in order, a dictionary containing the path
+        length 'dl' (cm), the position 'l' along the sightline (cm) and the
+        number density of each species (cm**-3) of every particle the
+        sightline intersects, sorted along the sightline.
+    """
+    coords = np.atleast_2d(np.asarray(coords, dtype=np.float64))
+    los = AXES[axis]
+    perp = [i for i in range(3) if i != los]
+
+    pos = gas["position"]
+    hsml = gas["hsml"]
+    boxsize = gas["boxsize"]
+    to_cm = gas["length_to_cm"]
+    index = _CellIndex(pos[:, perp], hsml, boxsize)
+
+    for first in tqdm(range(0, len(coords), chunk_size),
+                      desc="Integrating Sightlines", disable=not verbose):
+        chunk = coords[first:first + chunk_size]
+        ray_idx, part_idx = index.candidates(chunk)
+
+        #  Periodic impact parameter of each particle
+        delta = pos[part_idx][:, perp] - chunk[ray_idx]
+        delta -= boxsize * np.round(delta / boxsize)
+        b = np.sqrt(np.sum(delta**2, axis=1))
+        h = hsml[part_idx]
+
+        hit = b < h
+        ray_idx, part_idx, b, h = ray_idx[hit], part_idx[hit], b[hit], h[hit]
+
+        # dl = V * W_2D(b) so that sum(n * dl) is the SPH column density
+        dl = (gas["volume"][part_idx] * projected_kernel(b / h) /
+              (h * to_cm)**2)
+        l = pos[part_idx, los] * to_cm
+
+        order = np.lexsort((l, ray_idx))
+        ray_idx, part_idx = ray_idx[order], part_idx[order]
+        dl, l = dl[order], l[order]
+        bounds = np.searchsorted(ray_idx, np.arange(len(chunk) + 1))
+
+        for i in range(len(chunk)):
+            seg = slice(bounds[i], bounds[i + 1])
+            ray = {"dl": dl[seg], "l": l[seg]}
+            for species in SPECIES:
+                ray[species] = gas[species][part_idx[seg]]
+            yield ray
+
+
+def save_sightline(ray, filename, axis, ray_start, ray_end):
+    """
+    Save a sightline to a HDF5 file in the trident ray layout.
+    """
+    with stage("write", ray=filename), h5py.File(filename, "w") as f:
+        grid = f.create_group("grid")
+        grid.create_dataset("dl", data=ray["dl"])
+        grid.create_dataset("l", data=ray["l"])
+        for species in SPECIES:
+            grid.create_dataset("{0}_number_density".format(species),
+                                data=ray[species])
+        f.attrs["axis"] = axis
+        f.attrs["ray_start"] = ray_start
+        f.attrs["ray_end"] = ray_end
+
+
+def make_sightlines(snap_file, n=None, coords=None, axis="z",
+                    output_data_dir="", ray_prefix="Ray", seed=None,
+                    chunk_size=256, archive_file=None, append=False,
+                    overwrite=False, verbose=False):
+    """
+    Generate many axis-aligned rays through a snapshot without yt or trident.
+
+    Parameters
+    ----------
+    snap_file : string
+
+        The path to the snapshot. See gadget.snapshot_files.
+
+    n : integer, optional
+
+        The number of sightlines at random positions to generate. The
+        positions are unique to two decimals (see rayfiles.ray_coordinates).
+        Either n or coords must be given.
+
+    coords : array_like, shape (n, 2), optional
+
+        The unique coordinates of each sightline in the plane
+        perpendicular to the axis, in code length units.
+
+    axis : {'x', 'y', 'z'}, optional
+
+        The axis the rays travel along. Default: 'z'
+
+    output_data_dir : string, optional
+
+        The location on disk where the rays will be saved. Default: ''
+
+    ray_prefix : string, optional
+
+        The first part of the filename of each ray. Default: 'Ray'
+
+    seed : integer, optional
+
+        The seed used to draw the random coordinates. Default: None
+
+    chunk_size : integer, optional
+
+        The number of sightlines integrated together. Default: 256
+
+    archive_file : string, optional
+
+        If given, the rays are written to this ray archive (see
+        archive.write_rays) instead of one file per ray. Default: None
+
+    append : boolean, optional
+
+        If True, add the rays to an existing archive_file. Default: False
+
+    overwrite : boolean, optional
+
+        If True, replace an existing archive_file. If neither append nor
+        overwrite is True and archive_file exists, an IOError is raised.
+        Default: False
+
+    verbose : boolean, optional
+
+        If True, print progress information. Default: False
+
+    Returns
+    -------
+    filenames : list of strings
+
+        The filenames of the saved rays. When writing to an archive, these
+        are the names of the rays in the archive.
+    """
+    if (archive_file is not None and os.path.isfile(archive_file) and
+            not (append or overwrite)):
+        raise IOError("The archive {0} already exists, use append=True or "
+                      "overwrite=True".format(archive_file))
+
+    gas = load_gas(snap_file)
+    width = gas["boxsize"]
+
+    if coords is None:
+        if n is None:
+            raise ValueError("Either n or coords must be given")
+        coords = ray_coordinates(n, width, seed)
+    coords = np.atleast_2d(np.asarray(coords, dtype=np.float64))
+    if len(np.unique(coords, axis=0)) != len(coords):
+        raise ValueError("The sightline coordinates must be unique, as they "
+                         "name the rays")
+
+    los = AXES[axis]
+    xyz = ["x", "y", "z"]
+    xyz.remove(axis)
+
+    if (archive_file is not None and os.path.isfile(archive_file) and
+            not append):
+        os.remove(archive_file)
+
+    filenames = []
+    batch = []
+    rays = integrate_sightlines(gas, coords, axis=axis,
+                                chunk_size=chunk_size, verbose=verbose)
+    for (rand_0, rand_1), ray in zip(coords, rays):
+        ray_start = np.insert([rand_0, rand_1], los, 0.0)
+        ray_end = np.insert([rand_0, rand_1], los, width)
+        filename = os.path.join(output_data_dir, "{0}_{1}_{2}_{3}.h5".format(
+            ray_prefix, "H_He", axis + "axis",
+            "_".join(["{0}{1}".format(xyz[0], rand_0),
+                      "{0}{1}".format(xyz[1], rand_1)])))
+
+        if archive_file is None:
+            save_sightline(ray, filename, axis, ray_start, ray_end)
+            filenames.append(filename)
+            continue
+
+        name = os.path.basename(filename)
+        grid = {"dl": ray["dl"], "l": ray["l"]}
+        for species in SPECIES:
+            grid["{0}_number_density".format(species)] = ray[species]
+        batch.append({"name": name, "axis": axis, "ray_start": ray_start,
+                      "ray_end": ray_end, "seed": -1 if seed is None else seed,
+                      "grid": grid})
+        filenames.append(name)
+        if len(batch) == chunk_size:
+            archive.write_rays(archive_file, batch)
+            batch = []
+
+    if archive_file is not None:
+        archive.write_rays(archive_file, batch)
+
+    return filenames
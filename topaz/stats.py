@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+"""
+Streaming, mergeable statistics of ray-derived quantities.
+"""
+from __future__ import print_function, division
+
+import numpy as np
+
+
+class QuantileSketch(object):
+    """
+    A mergeable KLL quantile sketch.
+
+    The sketch keeps a bounded number of samples in a hierarchy of
+    compactors, where an item at level h stands for 2**h values. The
+    memory used is O(k log(n / k)) and the rank error is about 1 / k.
+
+    Parameters
+    ----------
+    k : integer, optional
+
+        The size of the largest compactor. Default: 200
+
+    seed : integer, optional
+
+        The seed used to choose which half of a compactor is kept.
+        Default: None
+    """
+
+    def __init__(self, k=200, seed=None):
+        self.k = k
+        self.count = 0
+        self.compactors = [np.zeros(0)]
+        self._rng = np.random.RandomState(seed)
+
+    def _capacity(self, level):
+        depth = len(self.compactors) - level - 1
+        return max(2, int(np.ceil(self.k * (2 / 3)**depth)))
+
+    def _compress(self):
+        level = 0
+        while level < len(self.compactors):
+            items = self.compactors[level]
+            if len(items) <= self._capacity(level):
+                level += 1
+                continue
+
+            if level + 1 == len(self.compactors):
+                self.compactors.append(np.zeros(0))
+
+            items = np.sort(items)
+            #  An odd item out stays at this level
+            if len(items) % 2:
+                keep, items = items[-1:], items[:-1]
+            else:
+                keep = items[:0]
+            offset = self._rng.randint(2)
+            self.compactors[level + 1] = np.concatenate(
+                [self.compactors[level + 1], items[offset::2]])
+            self.compactors[level] = keep
+
+    def update(self, values):
+        """
+        Add an array of values to the sketch.
+        """
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[np.isfinite(values)]
+        self.count += len(values)
+        self.compactors[0] = np.concatenate([self.compactors[0], values])
+        self._compress()
+
+    def merge(self, other):
+        """
+        Merge another sketch into this one.
+        """
+        while len(self.compactors) < len(other.compactors):
+            self.compactors.append(np.zeros(0))
+        for level, items in enumerate(other.compactors):
+            self.compactors[level] = np.concatenate([self.compactors[level],
+                                                     items])
+        self.count += other.count
+        self._compress()
+        return self
+
+    def quantile(self, q):
+        """
+        The approximate value at quantile(s) q in [0, 1].
+        """
+        items = np.concatenate(self.compactors)
+        if len(items) == 0:
+            return np.full(np.shape(q), np.nan)
+
+        weights = np.concatenate([np.full(len(c), 2.0**level)
+                                  for level, c in enumerate(self.compactors)])
+        order = np.argsort(items)
+        items, weights = items[order], weights[order]
+        cumulative = np.cumsum(weights) / np.sum(weights)
+        index = np.searchsorted(cumulative, q, side="left")
+        return items[np.minimum(index, len(items) - 1)]
+
+
+class StreamingStats(object):
+    """
+    Running moments, a fixed-bin histogram and a quantile sketch of a
+    stream of values, in constant memory.
+
+    Partial statistics from different workers or jobs can be combined with
+    merge, and saved to and loaded from .npz files.
+
+    Parameters
+    ----------
+    bins : array_like, optional
+
+        The edges of the histogram bins. If None, no histogram is kept.
+        Default: None
+
+    k : integer, optional
+
+        The size of the quantile sketch. See QuantileSketch. Default: 200
+
+    seed : integer, optional
+
+        The seed of the quantile sketch. Default: None
+    """
+
+    def __init__(self, bins=None, k=200, seed=None):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+        if bins is None:
+            self.edges = None
+            self.counts = None
+        else:
+            self.edges = np.asarray(bins, dtype=np.float64)
+            self.counts = np.zeros(len(self.edges) - 1, dtype=np.int64)
+
+        self.sketch = QuantileSketch(k=k, seed=seed)
+
+    def _combine_moments(self, count, mean, m2):
+        """
+        Combine the moments with those of another set of values using the
+        parallel algorithm of Chan et al.
+        """
+        total = self.count + count
+        if total == 0:
+            return
+        delta = mean - self.mean
+        self.m2 += m2 + delta**2 * self.count * count / total
+        self.mean += delta * count / total
+        self.count = total
+
+    def update(self, values):
+        """
+        Add an array of values.
+        """
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[np.isfinite(values)]
+        if len(values) == 0:
+            return
+
+        mean = np.mean(values)
+        self._combine_moments(len(values), mean,
+                              np.sum((values - mean)**2))
+        self.min = min(self.min, np.min(values))
+        self.max = max(self.max, np.max(values))
+
+        if self.edges is not None:
+            self.counts += np.histogram(values, bins=self.edges)[0]
+        self.sketch.update(values)
+
+    def merge(self, other):
+        """
+        Merge the statistics of another StreamingStats into this one.
+        """
+        if self.edges is not None:
+            if (other.edges is None or
+                    not np.array_equal(self.edges, other.edges)):
+                raise ValueError("Can not merge histograms with different bins")
+            self.counts += other.counts
+
+        self._combine_moments(other.count, other.mean, other.m2)
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.sketch.merge(other.sketch)
+        return self
+
+    @property
+    def variance(self):
+        if self.count < 2:
+            return np.nan
+        return self.m2 / (self.count - 1)
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+    def quantile(self, q):
+        """
+        The approximate value at quantile(s) q in [0, 1].
+        """
+        return self.sketch.quantile(q)
+
+    def histogram(self):
+        """
+        Return the histogram counts and bin edges.
+        """
+        return self.counts, self.edges
+
+    def save(self, filename):
+        """
+        Save the statistics to a .npz file.
+        """
+        arrays = {
+            "moments": np.array([self.count, self.mean, self.m2, self.min,
+                                 self.max]),
+            "sketch": np.array([self.sketch.k, self.sketch.count]),
+        }
+        if self.edges is not None:
+            arrays["edges"] = self.edges
+            arrays["counts"] = self.counts
+        for level, items in enumerate(self.sketch.compactors):
+            arrays["level_{0}".format(level)] = items
+        np.savez(filename, **arrays)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Load statistics saved with save.
+        """
+        with np.load(filename) as data:
+            stats = cls(bins=data["edges"] if "edges" in data else None,
+                        k=int(data["sketch"][0]))
+            if "counts" in data:
+                stats.counts = data["counts"]
+            count, stats.mean, stats.m2, stats.min, stats.max = \
+                data["moments"]
+            stats.count = int(count)
+            stats.sketch.count = int(data["sketch"][1])
+            nlevels = len([name for name in data.files
+                           if name.startswith("level_")])
+            stats.sketch.compactors = [data["level_{0}".format(level)]
+                                       for level in range(nlevels)]
+        return stats
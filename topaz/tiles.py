@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+"""
+Tiled, out-of-core projections of a snapshot at high resolution.
+
+The image plane is split into square tiles. The snapshot is streamed once
+and each particle is copied to the tiles its kernel overlaps in a
+temporary HDF5 file. The tiles are then rendered in a process pool and
+written into a chunked HDF5 image, so neither the particles nor the image
+are ever held in memory at once.
+"""
+from __future__ import print_function, division
+
+import os
+import warnings
+import multiprocessing
+
+import numpy as np
+import h5py
+from tqdm import tqdm
+
+from . import frames
+from . import gadget
+from . import profiling
+from . import render
+
+#  The coarsest level of the image pyramid has at least this many pixels
+#  along each side
+PYRAMID_MIN = 256
+
+#  The default largest number of pixels along each side of a tile
+TILE_PIXELS = 1024
+
+
+def _tile_name(row, col):
+    return "tile_{0}_{1}".format(row, col)
+
+
+def _append(dset, data):
+    n = dset.shape[0]
+    dset.resize(n + len(data), axis=0)
+    dset[n:] = data
+
+
+def _bucket_particles(snap_file, bucket_file, qty, box, center, x0, y0,
+                      width, dx, tile_width, ntiles, chunk_size):
+    """
+    Copy the x, y, kernel support, value and volume of each particle (and
+    of its periodic copies, see render.periodic_images) to the tiles its
+    kernel overlaps.
+    """
+    with h5py.File(bucket_file, "w") as f:
+        for gas in gadget.iter_gas(snap_file, frames.map_fields(qty),
+                                   chunk_size=chunk_size):
+            #  render_images makes the footprint of every kernel cover at
+            #  least one pixel, so the tiles it overlaps are found from
+            #  that footprint while the true support is stored
+            hsml = gas["SmoothingLength"]
+            footprint = np.maximum(hsml, dx)
+            pos, index = render.periodic_images(gas["Coordinates"],
+                                                footprint, box, center)
+            x, y, h = pos[:, 0], pos[:, 1], footprint[index]
+            value = frames.map_values(gas, qty)[index]
+            volume = (gas["Mass"] / gas["Density"])[index]
+
+            inside = ((x + h > x0) & (x - h < x0 + width) &
+                      (y + h > y0) & (y - h < y0 + width))
+            x, y, h = x[inside], y[inside], h[inside]
+            if len(x) == 0:
+                continue
+            particles = np.column_stack([x, y, hsml[index][inside],
+                                         value[inside], volume[inside]])
+
+            first_col = np.clip(np.floor((x - h - x0) / tile_width), 0,
+                                ntiles - 1).astype(np.int64)
+            last_col = np.clip(np.floor((x + h - x0) / tile_width), 0,
+                               ntiles - 1).astype(np.int64)
+            first_row = np.clip(np.floor((y - h - y0) / tile_width), 0,
+                                ntiles - 1).astype(np.int64)
+            last_row = np.clip(np.floor((y + h - y0) / tile_width), 0,
+                               ntiles - 1).astype(np.int64)
+            span_col = last_col - first_col
+            span_row = last_row - first_row
+
+            #  Most kernels lie in one tile, so loop over the offsets to the
+            #  other tiles a kernel spans rather than over the tiles
+            for drow in range(span_row.max() + 1):
+                for dcol in range(span_col.max() + 1):
+                    select = np.nonzero((drow <= span_row) &
+                                        (dcol <= span_col))[0]
+                    tile = ((first_row[select] + drow) * ntiles +
+                            first_col[select] + dcol)
+                    order = np.argsort(tile, kind="stable")
+                    tile, select = tile[order], select[order]
+                    bounds = np.nonzero(np.diff(tile))[0] + 1
+                    for part in np.split(np.arange(len(tile)), bounds):
+                        if len(part) == 0:
+                            continue
+                        row, col = divmod(int(tile[part[0]]), ntiles)
+                        name = _tile_name(row, col)
+                        if name not in f:
+                            f.create_dataset(name, shape=(0, 5),
+                                             maxshape=(None, 5),
+                                             chunks=(4096, 5),
+                                             dtype=np.float64)
+                        _append(f[name], particles[select[part]])
+
+
+def _tile_task(args):
+    """
+    Render one tile from its particles in the bucket file.
+    """
+    bucket_file, row, col, x0, y0, tile_width, tile_pixels, average = args
+    try:
+        with h5py.File(bucket_file, "r") as f:
+            name = _tile_name(row, col)
+            particles = f[name][()] if name in f else np.empty((0, 5))
+
+        pos = np.zeros((len(particles), 3))
+        pos[:, :2] = particles[:, :2]
+        center = (x0 + (col + 0.5) * tile_width,
+                  y0 + (row + 0.5) * tile_width)
+        image = render.render_images(pos, particles[:, 2],
+                                     {"tile": particles[:, 3]}, tile_width,
+                                     resolution=tile_pixels, center=center,
+                                     kind="proj", volume=particles[:, 4],
+                                     average=["tile"] if average else None
+                                     )["tile"]
+        return row, col, image.astype(np.float32), None
+    except Exception as error:
+        return row, col, None, "{0}: {1}".format(type(error).__name__, error)
+
+
+def _render_tiles(tasks, nproc):
+    """
+    Render the tiles in turn, or in a process pool yielding them as they
+    finish.
+    """
+    if nproc == 1:
+        for task in tasks:
+            yield _tile_task(task)
+        return
+
+    pool = multiprocessing.Pool(nproc)
+    try:
+        for result in profiling.imap(pool, _tile_task, tasks):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+
+def default_tile_pixels(resolution, max_pixels=TILE_PIXELS):
+    """
+    The largest divisor of resolution that is at most max_pixels, so that
+    the map is covered by whole tiles.
+    """
+    for tile_pixels in range(min(resolution, max_pixels), 0, -1):
+        if resolution % tile_pixels == 0:
+            return tile_pixels
+
+
+def _pyramid_levels(resolution, tile_pixels):
+    """
+    The number of 2x2 mean levels below the full resolution image.
+    """
+    levels = 0
+    while (resolution >> (levels + 1) >= PYRAMID_MIN and
+           tile_pixels % 2**(levels + 1) == 0):
+        levels += 1
+    return levels
+
+
+def tiled_map(snap_file, output_file, qty="rho", resolution=8192,
+              tile_pixels=None, width=None, center=None, pyramid=True,
+              compression=None, chunk_size=2**20, nproc=None,
+              verbose=False):
+    """
+    Render a high resolution projection of a snapshot tile by tile into an
+    HDF5 file.
+
+    The projection is written to the dataset 'image', indexed [y, x] and
+    chunked by tile. If pyramid is True, 'pyramid/1', 'pyramid/2', ...
+    hold the image averaged over 2x2, 4x4, ... pixels, down to at least
+    PYRAMID_MIN pixels along each side, for fast zoomed out previews. The
+    attributes of the file give the width, center, quantity, resolution
+    and redshift of the map.
+
+    Parameters
+    ----------
+    snap_file : string
+
+        The path to the snapshot. See gadget.snapshot_files.
+
+    output_file : string
+
+        The HDF5 file to write the map to. It is overwritten.
+
+    qty : string, optional
+
+        'rho' for the surface density, or an [X/H] ratio such as 'CXH',
+        whose map is its volume-weighted mean along the line of sight.
+        See frames.snapshot_map. Default: 'rho'
+
+    resolution : integer, optional
+
+        The number of pixels along each side of the map. It must be a
+        multiple of tile_pixels. Default: 8192
+
+    tile_pixels : integer, optional
+
+        The number of pixels along each side of a tile. The memory used by
+        each worker grows with its square. Default: the largest divisor of
+        resolution up to TILE_PIXELS (see default_tile_pixels)
+
+    width : float, optional
+
+        The width of the map in code units. Default: the box size
+
+    center : tuple of floats, optional
+
+        The (x, y) center of the map in code units. Default: the center of
+        the box
+
+    pyramid : boolean, optional
+
+        If True, also write the multi-resolution pyramid. Default: True
+
+    compression : string, optional
+
+        The compression of the image datasets, e.g. 'gzip'. Default: None
+
+    chunk_size : integer, optional
+
+        The number of particles read at a time. Default: 2**20
+
+    nproc : integer, optional
+
+        The number of worker processes. If None, use all available cores.
+        Default: None
+
+    verbose : boolean, optional
+
+        If True, show a progress bar. Default: False
+
+    Returns
+    -------
+    output_file : string
+
+        The HDF5 file the map was written to.
+    """
+    if tile_pixels is None:
+        tile_pixels = default_tile_pixels(resolution)
+    if resolution % tile_pixels != 0:
+        raise ValueError("The resolution ({0}) must be a multiple of "
+                         "tile_pixels ({1})".format(resolution, tile_pixels))
+    if nproc is None:
+        nproc = multiprocessing.cpu_count()
+
+    header = gadget.read_header(snap_file)
+    box = float(header["BoxSize"])
+    if width is None:
+        width = box
+    if center is None:
+        center = (box / 2, box / 2)
+
+    ntiles = resolution // tile_pixels
+    dx = width / resolution
+    tile_width = width / ntiles
+    x0 = center[0] - width / 2
+    y0 = center[1] - width / 2
+    levels = _pyramid_levels(resolution, tile_pixels) if pyramid else 0
+
+    bucket_file = output_file + ".particles.tmp"
+    try:
+        _bucket_particles(snap_file, bucket_file, qty, box, center, x0, y0,
+                          width, dx, tile_width, ntiles, chunk_size)
+
+        with h5py.File(output_file, "w") as out:
+            out.attrs["qty"] = qty
+            out.attrs["kind"] = "proj"
+            out.attrs["width"] = width
+            out.attrs["center"] = center
+            out.attrs["resolution"] = resolution
+            out.attrs["tile_pixels"] = tile_pixels
+            out.attrs["redshift"] = float(header["Redshift"])
+
+            images = [out.create_dataset(
+                "image", shape=(resolution, resolution), dtype=np.float32,
+                chunks=(tile_pixels, tile_pixels), compression=compression)]
+            for level in range(1, levels + 1):
+                size = tile_pixels >> level
+                images.append(out.create_dataset(
+                    "pyramid/{0}".format(level),
+                    shape=(resolution >> level, resolution >> level),
+                    dtype=np.float32, chunks=(size, size),
+                    compression=compression))
+
+            average = qty != "rho"
+            tasks = [(bucket_file, row, col, x0, y0, tile_width, tile_pixels,
+                      average)
+                     for row in range(ntiles) for col in range(ntiles)]
+            results = _render_tiles(tasks, nproc)
+            for row, col, image, error in tqdm(results, total=len(tasks),
+                                               desc="Tiles",
+                                               disable=not verbose):
+                if error is not None:
+                    warnings.warn("Could not render tile ({0}, {1}): {2}"
+                                  .format(row, col, error))
+                    continue
+
+                for level, dset in enumerate(images):
+                    if level > 0:
+                        size = len(image) // 2
+                        image = image.reshape(size, 2, size, 2).mean(
+                            axis=(1, 3))
+                    size = len(image)
+                    dset[row * size:(row + 1) * size,
+                         col * size:(col + 1) * size] = image
+    finally:
+        if os.path.isfile(bucket_file):
+            os.remove(bucket_file)
+
+    return output_file
+
+
+def read_tiled_map(map_file, max_pixels=2048):
+    """
+    Read the most detailed level of a tiled map that has at most
+    max_pixels along each side (or the coarsest level).
+
+    Returns
+    -------
+    image : numpy.ndarray
+
+        The map, indexed [y, x].
+
+    width : float
+
+        The width of the map in code units.
+    """
+    with h5py.File(map_file, "r") as f:
+        dset = f["image"]
+        if "pyramid" in f:
+            for level in sorted(f["pyramid"], key=int):
+                if dset.shape[0] <= max_pixels:
+                    break
+                dset = f["pyramid"][level]
+        return dset[()], float(f.attrs["width"])